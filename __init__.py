@@ -4,12 +4,16 @@ from piRichards.geometry.vtk import writeVTK
 from piRichards.geometry.stl import createCell
 
 from piRichards import solver
-from piRichards.solver import field
-from piRichards.solver.linalg import run_Steady, run_Unsteady
+from piRichards.solver import field, activeField
+from piRichards.solver.linalg import run_Steady, run_Unsteady, Stats, createDecomposition, closeDecompositions
+from piRichards.solver.stencil import Stencil, ActiveStencil, createStencil, createJacobian
+from piRichards.solver.multigrid import Multigrid
+from piRichards.solver.ensemble import ensembleField, stackFields, run_Ensemble
+from piRichards.solver.timestep import simulate, History
 from piRichards.solver import Carsel
 from piRichards.solver import ETmodel
 from piRichards.solver.ETmodel import ETcModule
 
 from piRichards import dataAssimilation
 from piRichards.dataAssimilation import Individual, Individual_withoutH
-from piRichards.dataAssimilation.model import PF, MPF, BLX_alpha, BLX_alpha_withoutH
\ No newline at end of file
+from piRichards.dataAssimilation.model import PF, MPF, BLX_alpha, BLX_alpha_withoutH, EnKF
\ No newline at end of file
@@ -1,6 +1,7 @@
 import numpy as np
 import copy
 import sys
+from piRichards.dataAssimilation.likelihood import ObservationError
 
 """
 process : 個体に関するクラス
@@ -30,6 +31,22 @@ class Individual:
 			etcModule = self.etcModule.copy()
 			return type(self)(params, field, etcModule)
 
+	"""
+	process : リサンプリング用の複製 (copy on write)
+	output : <Individual class>
+	Note :
+	-- fieldはfield.shareで複製する。voxel等の形状とパラメータの物理場は共有し、hは最初に書き込む時点(field.own or 代入)でコピーする
+	-- copyを継承している場合はcopyで複製する (copyで追加した独自の状態を失わないため)。copy on writeにする場合はshareも継承すること
+	"""
+	def share(self):
+		if type(self).copy is not Individual.copy:
+			return self.copy()
+
+		params = copy.deepcopy(self.params)
+		field = self.field.share()
+		etcModule = None if (self.etcModule is None) else self.etcModule.copy()
+		return type(self)(params, field, etcModule)
+
 	"""
 	process : スカラー倍
 	input : val -> <float>
@@ -109,14 +126,60 @@ class Individual:
 	output : <float> 尤度
 	"""
 	def calcLikelihood(self, y, R):
+		return np.exp(self.calcLogLikelihood(y, R))
+
+	"""
+	process : 対数尤度の計算
+	input :
+		y -> <ndarray> センサデータセット。(N, )なshape
+		R -> <ndarray> 観測の分散共分散行列 or <ObservationError class> 分解済みの観測誤差
+	output : <float> 対数尤度。計算エラー、制約違反のときは-np.inf
+	Note : 多数の個体を計算する場合はPF.getLogLikelihoods (Rの分解を1回のみ行う)を用いる
+	"""
+	def calcLogLikelihood(self, y, R):
+		h = self.observeValid()
+		if h is None:
+			return -np.inf
+
+		error = R if isinstance(R, ObservationError) else ObservationError(R)
+		try:
+			return float(error.logLikelihood(y, h))
+		except:
+			return -np.inf
+
+	"""
+	process : 尤度の計算(calcLikelihood or calcLogLikelihood)を継承して独自に定義しているか確認
+	output : <bool>
+	"""
+	def customLikelihood(self):
+		return (type(self).calcLikelihood is not Individual.calcLikelihood) or (type(self).calcLogLikelihood is not Individual.calcLogLikelihood)
+
+	"""
+	process : 継承して定義した尤度による対数尤度の計算
+	input : calcLikelihoodと同じ
+	output : <float> 対数尤度
+	Note :
+	-- calcLogLikelihoodを継承している場合はcalcLogLikelihood、calcLikelihoodのみ継承している場合はlog(calcLikelihood)
+	-- PF.getLogLikelihoodsは、customLikelihood() == Trueの個体を含む場合のみ個体毎にこのメソッドで計算する (それ以外はobserveValidの結果から一括で計算)
+	"""
+	def calcCustomLogLikelihood(self, y, R):
+		if type(self).calcLogLikelihood is not Individual.calcLogLikelihood:
+			return self.calcLogLikelihood(y, R)
+
+		with np.errstate(divide = "ignore"):
+			return np.log(self.calcLikelihood(y, R))
+
+	"""
+	process : 有効な個体のみデータ観測
+	output : <np array> observeの結果。計算エラー、制約違反、観測の失敗のときはNone
+	"""
+	def observeValid(self):
 		if self.field.dead_flag or (self.checkConstraints() == False):
-			return 0.
-		else:
-			try:
-				h = self.observe(); R_inv = np.linalg.inv(R)
-				return np.exp(-0.5*((y-h).reshape((1, -1))@R_inv)@(y-h).reshape((-1, 1)))[0,0]
-			except:
-				return 0.
+			return None
+		try:
+			return np.asarray(self.observe(), dtype = float)
+		except:
+			return None
 
 	"""
 	process : fieldクラスの作成
@@ -133,6 +196,15 @@ class Individual:
 	def createETcModule(self):
 		pass
 
+	"""
+	process : 予測 (次の観測時刻までfieldを計算)
+	Note : 引数は任意。piRichards.dataAssimilation.model.PF.forecastの引数がそのまま渡される
+	"""
+	def forecast(self, *args, **kwargs):
+		print("Error@piRichards.dataAssimilation.__init__.Individuals.forecast")
+		print("function <forecast> should be overwritten.")
+		sys.exit()
+
 	"""
 	observe : データ観測
 	Note : 引数は無し
@@ -150,6 +222,49 @@ class Individual:
 	def checkConstraints(self):
 		return True
 
+	"""
+	process : 統計量の計算に用いる状態
+	output : (params, h) -> <np array> パラメータリスト、マトリックポテンシャル
+	"""
+	def getState(self):
+		return np.asarray(self.params, dtype = float), self.field.getH()
+
+	"""
+	process : 状態を更新 (アンサンブルカルマンフィルタの解析)
+	input :
+		params -> <np array> パラメータリスト
+		h -> <np array> マトリックポテンシャル
+	"""
+	def setState(self, params, h):
+		self.rebuild(params, h)
+
+	"""
+	process : パラメータとhから個体を作り直す (type(self)(params)にcreateField(h)したものと同じ)
+	input :
+		params -> <np array> パラメータリスト
+		h -> <np array> マトリックポテンシャル
+	Note : Individual_withoutHでもhを与えた値で作成する (交叉で親のhを継承する場合に用いる)
+	"""
+	def rebuild(self, params, h):
+		self.params = params; self.etcModule = None
+		self.createField(h)
+		self.createETcModule()
+
+	"""
+	process : 統計量(平均、分散等)から個体を作成
+	input :
+		params -> <np array> パラメータリスト
+		h -> <np array> マトリックポテンシャル
+		base -> <Individual class> 個体群の先頭の個体
+	output : <Individual class>
+	"""
+	def fromState(self, params, h, base = None):
+		new_individual = type(self)(params)
+		new_individual.createField(h)
+		new_individual.createETcModule()
+
+		return new_individual
+
 
 
 """
@@ -162,6 +277,18 @@ Note :
 -- このクラスを直接用いることはできない。継承し、利用者自らカスタムする必要がある。
 """
 class Individual_withoutH(Individual):
+	"""
+	process : 統計量(平均、分散等)から個体を作成。hは先頭の個体の値を継承
+	"""
+	def fromState(self, params, h, base = None):
+		return Individual.fromState(self, params, (self if (base is None) else base).field.getH())
+
+	"""
+	process : 状態を更新。hは更新せず現在の値を継承
+	"""
+	def setState(self, params, h):
+		self.rebuild(params, self.field.getH())
+
 	"""
 	process : スカラー倍
 	input : val -> <float>
@@ -0,0 +1,72 @@
+import numpy as np
+
+#####アンサンブルカルマンフィルタの解析法。"enkf" : 摂動観測法(確率的EnKF), "etkf" : アンサンブル変換カルマンフィルタ(平方根フィルタ)
+KALMAN_METHODS = ("enkf", "etkf")
+
+
+"""
+process : Gaspari-Cohnの局所化関数 (5次の区分多項式)
+input :
+	d -> <np array> 距離
+	c -> <float> 局所化半径。2*c以上の距離では0
+output : <np array> dと同じshapeの重み (0 ~ 1)
+"""
+def gaspariCohn(d, c):
+	r = np.abs(d)/c
+	rho = np.zeros(r.shape)
+	near = r <= 1.; far = (r > 1.)*(r < 2.)
+	rn = r[near]; rf = r[far]
+	rho[near] = -0.25*rn**5+0.5*rn**4+0.625*rn**3-5./3.*rn**2+1.
+	rho[far] = rf**5/12.-0.5*rf**4+0.625*rf**3+5./3.*rf**2-5.*rf+4.-2./(3.*rf)
+	return rho
+
+
+"""
+process : 状態変数と観測点の距離による局所化の重み
+input :
+	coords -> <np array> (M, 3)なshape。状態変数の座標 [m]。np.nanの行(パラメータ等の位置を持たない変数)は局所化しない
+	sensors -> <np array> (n, 3)なshape。観測点の座標 [m]
+	radius -> <float> 局所化半径 [m]
+output : <np array> (M, n)なshape
+"""
+def localize(coords, sensors, radius):
+	d = np.sqrt(np.sum((coords[:, np.newaxis, :]-sensors[np.newaxis, :, :])**2, axis = -1))
+	rho = gaspariCohn(d, radius)
+	rho[np.isnan(d)] = 1.
+	return rho
+
+
+"""
+process : 局所化したカルマンゲインを状態変数の一部(行)について計算
+	K = (rho_xy*P_xy)(rho_yy*P_yy+R)^-1
+input :
+	A -> <np array> (N, M)なshape。状態のアンサンブル偏差
+	Yp -> <np array> (N, n)なshape。観測空間のアンサンブル偏差
+	G -> <np array> (n, n)なshape。(rho_yy*P_yy+R)^-1
+	rho -> <np array> (M, n)なshape。局所化の重み。if None -> 局所化しない
+output : <np array> (M, n)なshape
+"""
+def gain(A, Yp, G, rho = None):
+	P_xy = A.T@Yp/(len(A)-1.)
+	return (P_xy if (rho is None) else rho*P_xy)@G
+
+
+"""
+process : ETKFの重み (局所化なし)
+input :
+	Yp -> <np array> (N, n)なshape。観測空間のアンサンブル偏差
+	innovation -> <np array> (n, )なshape。y-観測空間のアンサンブル平均
+	error -> <ObservationError class> 観測誤差 (R^-1/2による白色化に用いる)
+output : <np array> (N, N)なshape。解析アンサンブル = 平均+偏差^T@W の重み (平均の重みを各列に含む)
+Note : 対称平方根 W = sqrt((N-1)*Pa)を用いるため、解析アンサンブルの平均は更新後の平均と一致する
+"""
+def transform(Yp, innovation, error):
+	N = len(Yp)
+	S = Yp*error.scale if error.diagonal else Yp@error.scale.T #<np array> 白色化した偏差
+	d = innovation*error.scale if error.diagonal else error.scale@innovation
+	eigval, eigvec = np.linalg.eigh((N-1.)*np.eye(N)+S@S.T)
+	Pa = (eigvec/eigval)@eigvec.T
+	w_mean = Pa@(S@d)
+	W = (eigvec*np.sqrt((N-1.)/eigval))@eigvec.T
+
+	return W+w_mean[:, np.newaxis]
@@ -0,0 +1,73 @@
+import numpy as np
+import sys
+
+"""
+class : 観測誤差(正規分布)による対数尤度の計算
+	log p(y|h) = -0.5*(y-h)^T R^-1 (y-h)  (定数項は除く)
+att :
+	R -> <np array> 観測データの分散共分散行列。(n, n)なshape (作成時のコピー)
+	diagonal -> <bool> Rが対角行列の場合True
+	scale -> <np array> 対角の場合は1/sqrt(diag(R)) ((n, )なshape)、それ以外はL^-1 ((n, n)なshape。R = L*L^T)
+	log_det -> <float> log|R|
+Note :
+-- Rの分解は作成時に1回だけ行い、以降の全個体の計算で使い回す
+-- 対角の場合は要素毎の除算のみで計算する
+"""
+class ObservationError:
+	def __init__(self, R):
+		self.R = np.array(R, dtype = float) #呼び出し側でRが書き換えられても分解と一致するようにコピーを保持
+		self.diagonal = np.count_nonzero(self.R-np.diag(np.diag(self.R))) == 0
+		try:
+			if self.diagonal:
+				var = np.diag(self.R)
+				if np.any(var <= 0.):
+					raise np.linalg.LinAlgError
+				self.scale = 1./np.sqrt(var); self.log_det = np.sum(np.log(var))
+			else:
+				L = np.linalg.cholesky(self.R)
+				self.scale = np.linalg.inv(L); self.log_det = 2.*np.sum(np.log(np.diag(L)))
+		except np.linalg.LinAlgError:
+			print("Error@piRichards.dataAssimilation.likelihood.ObservationError")
+			print("R must be symmetric positive definite.")
+			sys.exit()
+
+	"""
+	process : Rが同じ行列か確認
+	input : R -> <np array>
+	output : <bool>
+	Note : 同じ配列をその場で書き換えて渡す場合もあるため、値で比較する
+	"""
+	def match(self, R):
+		return np.array_equal(R, self.R)
+
+	"""
+	process : 対数尤度を一括で計算
+	input :
+		y -> <np array> 観測データ。(n, )なshape
+		obsv -> <np array> 各個体のobserve結果。(N, n)なshape (or (n, ))
+		normalized -> <bool> True -> 正規分布の定数項 -0.5*(n*log(2*pi)+log|R|)を含める
+	output : <np array> (N, )なshape (or <float>)。obsvにnp.nanを含む個体は-np.inf
+	"""
+	def logLikelihood(self, y, obsv, normalized = False):
+		d = np.asarray(y, dtype = float)-np.asarray(obsv, dtype = float)
+		z = d*self.scale if self.diagonal else d@self.scale.T #<np array> 白色化した残差 L^-1 (y-h)
+		log_likelihood = -0.5*np.sum(z**2, axis = -1)
+		if normalized:
+			log_likelihood = log_likelihood-0.5*(d.shape[-1]*np.log(2.*np.pi)+self.log_det)
+
+		return np.where(np.isfinite(log_likelihood), log_likelihood, -np.inf)
+
+
+"""
+process : 対数重みを正規化した重みに変換 (log-sum-exp)
+input : log_weights -> <np array> (N, )なshape
+output : <np array> (N, )なshape。全て-np.infの場合は一様
+"""
+def normalize(log_weights):
+	log_weights = np.where(np.isnan(log_weights), -np.inf, log_weights)
+	log_max = np.max(log_weights)
+	if not np.isfinite(log_max):
+		return 1./len(log_weights)*np.ones(len(log_weights))
+
+	weights = np.exp(log_weights-log_max)
+	return weights/np.sum(weights)
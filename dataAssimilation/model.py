@@ -1,84 +1,353 @@
 import numpy as np
 import math
 import sys
+from piRichards.dataAssimilation.pool import createPool
+from piRichards.dataAssimilation.likelihood import ObservationError, normalize
+from piRichards.dataAssimilation.statistics import Summary, accumulate, summarize
+from piRichards.dataAssimilation.resampling import resampleIndex, checkResampling
+from piRichards.dataAssimilation import kalman
 
 """
 process : Particle Filter
 att : 
 	inidividuals -> <list:Individual>
+	pool -> <ProcessPool class> or <ThreadPool class> 並列計算のプール。if None -> 逐次計算
+	log_weights -> <np array> (N, )なshape。窓内で累積した各個体の対数重み (assimilate)
+	ess_threshold -> <float> 有効粒子数(ESS)がess_threshold*N未満になったら窓の途中でもリサンプリング
+	lag -> <int> 固定ラグ平滑化で保持する過去の観測時刻数
+	cache -> <dict> 観測時刻 -> 各個体のobserve結果 ((N, n)なshape)
+	history -> <list of tuple> 固定ラグ平滑化用の(観測時刻, 各個体のobserve結果)
+	error -> <ObservationError class> 直前に用いた観測誤差。Rが同じ間はRの分解を使い回す
+	resampling -> <str> リサンプリング法 (piRichards.dataAssimilation.resampling.RESAMPLING_METHODS)
+	sampling_threshold -> <float> samplingでESSがsampling_threshold*N以上ならリサンプリングを省略。if None -> 毎回リサンプリング
+	custom_likelihood -> <bool> 尤度の計算を継承して定義した個体(Individual.customLikelihood)を含む場合True
+Note :
+-- startで並列計算を開始すると、粒子はプールの各プロセスに常駐する。以降のforecast, getProbs, sampling, observe_mean, observe_varはプール上で計算する
+-- プール使用中のindividualsは各プロセスから集めた粒子のコピー。individualsへの代入はプールへの再分配となる
+-- assimilateは複数の観測時刻に渡って対数重みを累積し、窓の終わり(end == True)もしくはESSの低下時のみリサンプリングする。samplingは毎回リサンプリングする従来の方法
 """
 class PF:
 	def __init__(self, individuals):
+		self.pool = None
+		self.ess_threshold = 0.5
+		self.lag = 0
+		self.error = None
+		self.resampling = "multinomial"
+		self.sampling_threshold = None
 		self.individuals = individuals
 
 	def __len__(self):
-		return len(self.individuals)
+		return len(self.pool) if (self.pool is not None) else len(self.individuals)
+
+	@property
+	def individuals(self):
+		return self.pool.gather() if (self.pool is not None) else self._individuals
+
+	@individuals.setter
+	def individuals(self, individuals):
+		if self.pool is not None:
+			self.pool.put(individuals)
+		else:
+			self._individuals = individuals
+		self.log_weights = np.zeros(len(individuals)); self.cache = {}; self.history = []
+		self.custom_likelihood = any(individual.customLikelihood() for individual in individuals)
 
 	"""
-	process : 各個体の尤度を計算
+	process : 粒子の並列計算を開始
+	input :
+		workers -> <int> プロセス数 (スレッド数)。if None -> CPU数
+		executor -> <str> "process" : 粒子をプロセスに常駐させる, "thread" : スレッドで計算
+	"""
+	def start(self, workers = None, executor = "process"):
+		if self.pool is None:
+			self.pool = createPool(self._individuals, workers, executor)
+			self._individuals = None
+
+	"""
+	process : 粒子の並列計算を終了し、粒子を親プロセスに集める
+	"""
+	def close(self):
+		if self.pool is not None:
+			individuals = self.pool.gather()
+			self.pool.close(); self.pool = None
+			self._individuals = individuals
+
+	"""
+	process : 全個体のメソッドを呼ぶ (プール使用中は並列計算)
+	input : name -> <str> メソッド名, args, kwargs -> メソッドの引数
+	output : <list> 各個体の結果
+	"""
+	def call(self, name, *args, **kwargs):
+		if self.pool is not None:
+			return self.pool.call(name, *args, **kwargs)
+		else:
+			return [getattr(individual, name)(*args, **kwargs) for individual in self.individuals]
+
+	"""
+	process : 全個体のメソッドを個体毎の引数で呼ぶ (プール使用中は並列計算)
+	input : name -> <str> メソッド名, args -> <list of tuple> 各個体の引数
+	output : <list> 各個体の結果
+	"""
+	def map(self, name, args):
+		if self.pool is not None:
+			return self.pool.map(name, args)
+		else:
+			return [getattr(individual, name)(*arg) for individual, arg in zip(self.individuals, args)]
+
+	"""
+	process : 各個体の予測 (Individual.forecast)
+	input : args, kwargs -> Individual.forecastの引数
+	"""
+	def forecast(self, *args, **kwargs):
+		self.call("forecast", *args, **kwargs)
+		self.cache = {}
+
+	"""
+	process : 各個体の尤度から正規化した重みを計算
 	input :
 		y -> <np array> 観測データ。 (N, )なshape
 		R -> <np array> 観測データの分散共分散行列。(N, N)なshape
+	Note : 対数尤度をlog-sum-expで正規化するため、センサ数が多く尤度がアンダーフローする場合も重みが求まる。全個体が無効な場合は一様
 	"""
 	def getProbs(self, y, R):
-		likelihoods = np.array([individual.calcLikelihood(y, R) for individual in self.individuals])
-		if np.sum(likelihoods) == 0.:
-			return 1./len(self)*np.ones(len(self))
+		return normalize(self.getLogLikelihoods(y, R, None if self.custom_likelihood else self.observeAll()))
+
+	"""
+	process : 番号sample_indexの個体を複製した個体群に更新
+	input : sample_index -> <np array> 複製元の個体の番号
+	output : <np array> 更新後の各個体の複製元の番号
+	Note : individualsへの代入と同様に、累積した対数重み、observeのキャッシュ及び平滑化の履歴を破棄する (引き継ぐ場合はassimilateのように複製元の番号で並べ替える)
+	"""
+	def resample(self, sample_index):
+		if self.pool is not None:
+			ancestry = self.pool.resample(sample_index)
+			self.log_weights = np.zeros(len(self)); self.cache = {}; self.history = []
+			return ancestry
 		else:
-			likelihoods = np.array([individual.calcLikelihood(y, R) for individual in self.individuals])
-			return likelihoods/np.sum(likelihoods)
+			self.individuals = [self.individuals[si].share() for si in sample_index] #hは最初の書き込み時にコピー
+			return np.asarray(sample_index)
+
+	"""
+	process : 重みを基に個体群を更新
+	input : prob -> <np array> (N, )なshape。各個体の重み
+	output : <np array> 更新後の各個体の複製元の番号。複製でない個体(交叉等)を含む場合はNone
+	"""
+	def reproduce(self, prob):
+		sample_index = resampleIndex(prob, len(self), self.resampling)
+
+		return self.resample(sample_index)
 
 	"""
 	process : 各個体の尤度を基にサンプリング
 	input :
 		y -> <np array> 観測データ
 		R -> <np array> 観測データの分散共分散行列
+	output : <bool> リサンプリングした場合True
+	Note : sampling_threshold is not Noneの場合、ESSが十分な間は重みを累積し(assimilate)、個体の複製を行わない
 	"""
 	def sampling(self, y, R):
-		prob = self.getProbs(y, R)
-		sample_index = np.random.choice(np.arange(len(self)), size = len(self), p = prob)
+		if self.sampling_threshold is None:
+			self.reproduce(self.getProbs(y, R))
+			self.log_weights = np.zeros(len(self))
+			return True
+
+		return self.assimilate(y, R, threshold = self.sampling_threshold)
+
+	"""
+	process : リサンプリングの設定
+	input :
+		method -> <str> "multinomial" : 多項リサンプリング, "systematic" : 系統リサンプリング, "stratified" : 層化リサンプリング, "residual" : 残差リサンプリング
+		ess_threshold -> <float> samplingでESSがess_threshold*N以上の場合はリサンプリング(個体の複製)を省略し、重みを次の観測に持ち越す。if None -> 毎回リサンプリング
+	"""
+	def setResampling(self, method = "multinomial", ess_threshold = None):
+		checkResampling(method)
+		self.resampling = method
+		self.sampling_threshold = ess_threshold
+
+	"""
+	process : 窓による同化の設定
+	input :
+		ess_threshold -> <float> ESSがess_threshold*N未満になったら窓の途中でもリサンプリング。0 -> 窓の終わりのみ
+		lag -> <int> 固定ラグ平滑化で保持する過去の観測時刻数。0 -> 平滑化しない
+	"""
+	def setWindow(self, ess_threshold = 0.5, lag = 0):
+		self.ess_threshold = ess_threshold
+		self.lag = lag
+
+	"""
+	process : 各個体のobserve結果を取得 (観測時刻毎にキャッシュ)
+	input : time -> 観測時刻 (キャッシュのキー)。if None -> キャッシュしない
+	output : <np array> (N, n)なshape。無効な個体(Individual.observeValid is None)の行はnp.nan
+	Note : キャッシュはforecast, リサンプリング, individualsへの代入で破棄する
+	"""
+	def observeAll(self, time = None):
+		if (time is not None) and (time in self.cache):
+			return self.cache[time]
 
-		self.individuals = [self.individuals[si].copy() for si in sample_index]
+		obsv = self.call("observeValid")
+		n = max([len(ob) for ob in obsv if ob is not None], default = 0)
+		obsv = np.array([np.full(n, np.nan) if (ob is None) else ob for ob in obsv])
+		if time is not None:
+			self.cache[time] = obsv
+
+		return obsv
+
+	"""
+	process : 各個体の対数尤度を計算
+	input :
+		y -> <np array> 観測データ。(n, )なshape
+		R -> <np array> 観測データの分散共分散行列。(n, n)なshape
+		obsv -> <np array> (N, n)なshape。各個体のobserve結果 (observeAll)。if None -> observeAll()
+	output : <np array> (N, )なshape。無効な個体は-np.inf
+	Note :
+	-- Rの分解(ObservationError)はRが変わった場合のみ行う
+	-- 尤度の計算を継承して定義した個体を含む場合(custom_likelihood)は、個体毎にIndividual.calcCustomLogLikelihoodで計算する
+	"""
+	def getLogLikelihoods(self, y, R, obsv = None):
+		if self.custom_likelihood:
+			log_likelihoods = np.array(self.call("calcCustomLogLikelihood", y, R), dtype = float)
+			return np.where(np.isnan(log_likelihoods), -np.inf, log_likelihoods)
+
+		obsv = self.observeAll() if (obsv is None) else obsv
+		if (self.error is None) or (not self.error.match(R)):
+			self.error = ObservationError(R)
+
+		return self.error.logLikelihood(y, obsv)
+
+	"""
+	process : 累積した対数重みから正規化した重みを計算
+	output : <np array> (N, )なshape。全個体が無効な場合は一様
+	"""
+	def getWeights(self):
+		return normalize(self.log_weights)
+
+	"""
+	process : 有効粒子数 1/sum(w^2)
+	output : <float>
+	"""
+	def getESS(self):
+		return 1./np.sum(self.getWeights()**2)
+
+	"""
+	process : 窓による同化。観測時刻毎に対数重みを累積し、窓の終わりもしくはESSの低下時にリサンプリング
+	input :
+		y -> <np array> 観測データ
+		R -> <np array> 観測データの分散共分散行列
+		time -> 観測時刻 (observeのキャッシュのキー)。if None -> キャッシュしない
+		end -> <bool> True -> 窓の終わり。累積した重みでリサンプリングする
+		threshold -> <float> ESSの閾値。if None -> ess_threshold
+	output : <bool> リサンプリングした場合True
+	"""
+	def assimilate(self, y, R, time = None, end = False, threshold = None):
+		obsv = self.observeAll(time)
+		self.log_weights = self.log_weights+self.getLogLikelihoods(y, R, obsv)
+		self.log_weights[np.isnan(self.log_weights)] = -np.inf
+		if self.lag > 0:
+			self.history = (self.history+[(time, obsv)])[-(self.lag+1):]
+
+		threshold = self.ess_threshold if (threshold is None) else threshold
+		if (not end) and (self.getESS() >= threshold*len(self)):
+			return False
+
+		history = self.history; cache = self.cache
+		ancestry = self.reproduce(self.getWeights())
+		self.log_weights = np.zeros(len(self))
+		if ancestry is not None: #複製のみの場合、過去のobserve結果は複製元の値を引き継ぐ
+			self.history = [(t, ob[ancestry]) for t, ob in history]
+			self.cache = {t : ob[ancestry] for t, ob in cache.items()}
+		else:
+			self.history = []; self.cache = {}
+
+		return True
+
+	"""
+	process : 固定ラグ平滑化。保持している過去の観測時刻のobserve結果の、現在の重みによる加重平均
+	output : <list of tuple> (観測時刻, 加重平均 (n, )なshape)の古い順のリスト
+	Note :
+	-- 過去の時刻の推定に、その時刻以降lag時刻分の観測を反映した重みを用いる
+	-- 交叉等で個体が複製でなくなった場合(MPF, BLX_alpha)は、リサンプリング時に履歴を破棄する
+	"""
+	def smooth(self):
+		weights = self.getWeights()
+		return [(t, weights[weights > 0.]@ob[weights > 0.]) for t, ob in self.history]
+
+	"""
+	process : 個体群の統計量を計算
+	input :
+		weighted -> <bool> True -> 累積した重み(getWeights)による重み付き統計量
+		q -> <list of float> 分位。if None -> 分位点は計算しない
+	output : <Summary class> パラメータ及びhの平均、分散、分位点
+	Note :
+	-- 各個体の(params, h)からWelford法で直接計算する (Individualの四則演算は用いない)
+	-- 平均・分散は各個体の状態を1つずつ集計するため、全個体の状態を同時に保持しない。プール使用中は各プロセスで集計した結果を合わせる
+	-- 分位点を計算する場合のみ全個体の状態を集める
+	"""
+	def statistics(self, weighted = False, q = None):
+		weights = self.getWeights() if weighted else None
+		if q is not None:
+			return summarize(self.call("getState"), weights, q)
+
+		if self.pool is None:
+			params, h = accumulate((individual.getState() for individual in self.individuals), weights)
+		else:
+			params, h = self.pool.accumulate(weights)
+
+		return Summary(params.mean, params.var(), h.mean, h.var())
+
+	"""
+	process : 累積した重みが一様でないか確認
+	output : <bool> True -> 窓の途中等でリサンプリング前の重みが残っている
+	"""
+	def isWeighted(self):
+		return bool(np.any(self.log_weights != self.log_weights[0]))
 
 	"""
 	process : 個体群の平均を返す
 	output : <Individual class>
+	Note : 重みが一様でない場合(isWeighted)は重み付き平均
 	"""
 	def mean(self):
-		mean_individual = self.individuals[0].truediv(len(self))
-		for individual in self.individuals[1:]:
-			mean_individual += individual.truediv(len(self))
-
-		return mean_individual
+		summary = self.statistics(self.isWeighted())
+		base = self.individuals[0] if (self.pool is None) else self.pool.get(0)
+		return base.fromState(summary.params_mean, summary.h_mean, base)
 
 	"""
 	process : 個体群の分散を返す
 	output : <Individual class>
+	Note : 重みが一様でない場合(isWeighted)は重み付き分散
 	"""
 	def var(self):
-		mean_individual = self.mean()
-		var_individual = (self.individuals[0] - mean_individual)*(self.individuals[0] - mean_individual).truediv(len(self))
-		for individual in self.individuals[1:]:
-			var_individual += (individual - mean_individual)*(individual - mean_individual).truediv(len(self))
-
-		return var_individual
+		summary = self.statistics(self.isWeighted())
+		base = self.individuals[0] if (self.pool is None) else self.pool.get(0)
+		return base.fromState(summary.params_var, summary.h_var, base)
 
 	"""
 	process : 個体群のobserve結果の平均を返す
 	output : <np array>
+	Note : 重みが一様でない場合(isWeighted)は重み付き平均。重み0の個体は除く
 	"""
 	def observe_mean(self):
-		obsv = [individual.observe() for individual in self.individuals]
-		return np.mean(obsv, axis = 0)
+		obsv = np.array(self.call("observe"), dtype = float)
+		if not self.isWeighted():
+			return np.mean(obsv, axis = 0)
+
+		weights = self.getWeights()
+		return weights[weights > 0.]@obsv[weights > 0.]
 
 	"""
 	process : 個体群のobserve結果の分散を返す
 	output : <np array>
+	Note : 重みが一様でない場合(isWeighted)は重み付き分散。重み0の個体は除く
 	"""
 	def observe_var(self):
-		obsv = [individual.observe() for individual in self.individuals]
-		obsv_mean = np.mean(obsv, axis = 0)
-		return np.mean([np.power(ob-obsv_mean, 2.) for ob in obsv], axis = 0)
+		obsv = np.array(self.call("observe"), dtype = float)
+		if not self.isWeighted():
+			obsv_mean = np.mean(obsv, axis = 0)
+			return np.mean([np.power(ob-obsv_mean, 2.) for ob in obsv], axis = 0)
+
+		weights = self.getWeights()
+		weights, obsv = weights[weights > 0.], obsv[weights > 0.]
+		return weights@np.power(obsv-weights@obsv, 2.)
 
 """
 process : Merging Particle Filter
@@ -91,22 +360,25 @@ class MPF(PF):
 		super().__init__(individuals)
 		self.a = np.array([3./4., (math.sqrt(13.)+1.)/8., -(math.sqrt(13.)-1.)/8.]) if (a is None) else a
 
-	def sampling(self, y, R):
-		prob = self.getProbs(y, R)
-		sample_index = np.random.choice(np.arange(len(self)), size = 3*len(self), p = prob)
+	def reproduce(self, prob):
+		sample_index = resampleIndex(prob, 3*len(self), self.resampling)
 
-		individuals = np.array([self.individuals[si].copy() for si in sample_index]).reshape((-1, 3))
+		parents = self.individuals #プール使用中は一度だけ集める
+		individuals = np.array([parents[si].share() for si in sample_index]).reshape((-1, 3))
 		individuals1 = [individual.mul(self.a[0]) for individual in individuals[:,0]]
 		individuals2 = [individual.mul(self.a[1]) for individual in individuals[:,1]]
 		individuals3 = [individual.mul(self.a[2]) for individual in individuals[:,2]]
 
-		self.individuals = []
+		new_individuals = []
 
 		for ind1, ind2, ind3 in zip(individuals1, individuals2, individuals3):
 			ind = ind1+ind2+ind3
-			ind.field.h[ind.field.h > 0.] = 0.
+			h = ind.field.own(); h[h > 0.] = 0.
 
-			self.individuals.append(ind)
+			new_individuals.append(ind)
+
+		self.individuals = new_individuals
+		return None
 
 
 """
@@ -114,52 +386,48 @@ process : BLX_alpha
 att : 
 	inidividuals -> <list:Individual>
 	alpha -> <float> 重み。
+	crossH -> <bool> True -> hも交叉する。False -> hは親の値を継承
 Note:
 ---個体数について---
 個体数は偶数でなければならない。
+---計算について---
+親の組を(N/2, 2, D)なパラメータ、(N/2, 2, Nx, Ny, Nz)なhの配列に積み、全ての組の交叉を1回の配列演算で行う。
+子の個体は交叉後にまとめてIndividual.rebuildで作成する (プール使用中は各プロセスで作成)。
 """
 class BLX_alpha(PF):
+	crossH = True
+
 	def __init__(self, individuals, alpha = 0.5):
 		super().__init__(individuals)
 		self.alpha = alpha
 
-	def sampling(self, y, R):
-		prob = self.getProbs(y, R)
-		sample_index = np.random.choice(np.arange(len(self)), size = len(self), p = prob)
-		individuals = np.array([self.individuals[si].copy() for si in sample_index]).reshape((-1, 2))
-		self.individuals = []
-
-		for i in range(len(individuals)):
-			param1 = individuals[i,0].params
-			param2 = individuals[i,1].params
-			h1 = individuals[i,0].field.getH()
-			h2 = individuals[i,1].field.getH()
-
-			d = np.abs(param1 - param2) #(D, )
-
-			param_mean = 0.5*(param1 + param2) #(D, )
-			param_max = param_mean + (0.5 + self.alpha)*d
-			param_min = param_mean - (0.5 + self.alpha)*d
-
-			new_param1 = param_min + (param_max - param_min)*np.random.rand(len(d))
-			new_param2 = param_min + (param_max - param_min)*np.random.rand(len(d))
+	"""
+	process : BLX-alpha交叉
+	input : X -> <np array> (N/2, 2, ...)なshape。親の組
+	output : <np array> (N/2, 2, ...)なshape。各組の2個体の子
+	"""
+	def crossover(self, X):
+		d = np.abs(X[:,0]-X[:,1])
+		X_mean = 0.5*(X[:,0]+X[:,1])
+		X_max = X_mean + (0.5 + self.alpha)*d
+		X_min = X_mean - (0.5 + self.alpha)*d
 
-			dh = np.abs(h1-h2)
-			h_mean = 0.5*(h1 + h2)
-			h_max = h_mean + (0.5 + self.alpha)*dh
-			h_min = h_mean - (0.5 + self.alpha)*dh
-			new_h1 = h_min + (h_max - h_min)*np.random.rand(dh.shape[0], dh.shape[1], dh.shape[2])
-			new_h2 = h_min + (h_max - h_min)*np.random.rand(dh.shape[0], dh.shape[1], dh.shape[2])
+		return X_min[:,np.newaxis] + (X_max - X_min)[:,np.newaxis]*np.random.rand(*X.shape)
 
-			new_ind1 = type(individuals[i,0])(new_param1)
-			new_ind1.createField(new_h1)
-			new_ind2 = type(individuals[i,1])(new_param2)
-			new_ind2.createField(new_h2)
+	def reproduce(self, prob):
+		sample_index = resampleIndex(prob, len(self), self.resampling).reshape((-1, 2))
+		states = self.call("getState")
+		params = np.stack([p for p, h in states])[sample_index] #(N/2, 2, D)
+		h = np.stack([h for p, h in states])[sample_index] #(N/2, 2, Nx, Ny, Nz)
+		del states
 
-			new_ind1.field.h[new_ind1.field.h > 0.] = 0.
-			new_ind2.field.h[new_ind2.field.h > 0.] = 0.
+		new_params = self.crossover(params)
+		new_h = np.minimum(self.crossover(h), 0.) if self.crossH else h #h > 0は0にクリップ (voidセルのnp.nanはそのまま)
 
-			self.individuals.append(new_ind1); self.individuals.append(new_ind2)
+		N = len(self)
+		self.map("rebuild", list(zip(new_params.reshape((N, -1)), new_h.reshape((N,)+h.shape[2:]))))
+		self.log_weights = np.zeros(N); self.cache = {}; self.history = []
+		return None
 
 """
 process : BLX_alpha_withoutH。ただしhの交叉はなし。
@@ -171,29 +439,122 @@ Note:
 個体数は偶数でなければならない。
 """
 class BLX_alpha_withoutH(BLX_alpha):
+	crossH = False #hは片方の親の値を継承
+
+
+"""
+process : アンサンブルカルマンフィルタ (EnKF, ETKF)
+att :
+	inidividuals -> <list:Individual>
+	method -> <str> "enkf" : 摂動観測法, "etkf" : アンサンブル変換カルマンフィルタ
+	sensors -> <np array> (n, 3)なshape。観測点のセル番号 (i, j, k)。局所化に用いる
+	radius -> <float> 局所化半径 [m] (Gaspari-Cohn)。if None -> 局所化しない
+	inflation -> <float> 解析前にアンサンブル偏差に掛ける乗法的インフレーション
+	chunk -> <int> カルマンゲインを1度に計算する状態変数の数
+Note :
+-- 状態変数は各個体のparamsとhの活性セルの値 (Individual.getState)。観測はIndividual.observeValid
+-- 解析後の状態はIndividual.setStateで各個体に反映し、h > 0は0にクリップする (Individual_withoutHはparamsのみ更新)
+-- 局所化はセル中心と観測点の距離による重みをカルマンゲインの共分散に掛ける。paramsは局所化しない
+-- method == "etkf"で局所化する場合、偏差の更新はETKFの変換行列の代わりに局所化したゲインの1/2を用いる (DEnKF, Sakov and Oke 2008)
+-- 無効な個体(計算エラー等)は有効な個体の複製で置き換えてから解析する
+"""
+class EnKF(PF):
+	def __init__(self, individuals, method = "etkf", sensors = None, radius = None, inflation = 1., chunk = 65536):
+		super().__init__(individuals)
+		if method not in kalman.KALMAN_METHODS:
+			print("Error@piRichards.dataAssimilation.model.EnKF")
+			print("method <" + str(method) + "> is not supported.")
+			sys.exit()
+
+		if (radius is not None) and (sensors is None):
+			print("Error@piRichards.dataAssimilation.model.EnKF")
+			print("localization requires sensors.")
+			sys.exit()
+
+		self.method = method
+		self.sensors = None if (sensors is None) else np.asarray(sensors)
+		self.radius = radius
+		self.inflation = inflation
+		self.chunk = chunk
+
+	"""
+	process : 状態変数の座標 (セル中心) [m]
+	input : base -> <Individual class>, D -> <int> パラメータ数
+	output : <np array> (D+活性セル数, 3)なshape。paramsの行はnp.nan
+	"""
+	def getCoords(self, base, D):
+		f = base.field
+		coords = f.cells.coords if hasattr(f, "cells") else np.nonzero(f.voxel)
+		coords = np.stack(coords, axis = -1)*np.asarray(f.size, dtype = float)
+		return np.concatenate((np.full((D, 3), np.nan), coords))
+
+	"""
+	process : 観測による解析 (各個体の状態を更新)
+	input :
+		y -> <np array> 観測データ。(n, )なshape
+		R -> <np array> 観測データの分散共分散行列。(n, n)なshape
+	"""
+	def analysis(self, y, R):
+		Y = self.observeAll()
+		valid = np.all(np.isfinite(Y), axis = 1)
+		if not np.any(valid):
+			return
+		if not np.all(valid): #無効な個体は有効な個体の複製で置き換える
+			sample_index = np.arange(len(self))
+			sample_index[~valid] = np.random.choice(np.flatnonzero(valid), size = np.count_nonzero(~valid))
+			self.resample(sample_index); Y = Y[sample_index]
+
+		base = self.individuals[0] if (self.pool is None) else self.pool.get(0)
+		states = self.call("getState")
+		D = len(states[0][0])
+		X = np.stack([np.concatenate((p, base.field.toActive(h))) for p, h in states]) #<np array> (N, D+活性セル数)
+		N = len(X)
+
+		x_mean = np.mean(X, axis = 0); A = (X-x_mean)*self.inflation
+		y_mean = np.mean(Y, axis = 0); Yp = (Y-y_mean)*self.inflation
+		if (self.error is None) or (not self.error.match(R)):
+			self.error = ObservationError(R)
+
+		if (self.method == "etkf") and (self.radius is None):
+			T = kalman.transform(Yp, y-y_mean, self.error)
+			X = x_mean+T.T@A
+		else:
+			rho_yy = None
+			coords = None
+			if self.radius is not None:
+				coords = self.getCoords(base, D)
+				sensors = self.sensors*np.asarray(base.field.size, dtype = float)
+				rho_yy = kalman.localize(sensors, sensors, self.radius)
+
+			P_yy = Yp.T@Yp/(N-1.)
+			G = np.linalg.inv((P_yy if (rho_yy is None) else rho_yy*P_yy)+R)
+			if self.method == "enkf":
+				L = np.linalg.cholesky(R)
+				innovation = y+np.random.randn(N, len(y))@L.T-(y_mean+Yp) #<np array> 摂動観測との差
+				X = x_mean+A
+			else: #DEnKF : 平均はゲインで、偏差はゲインの1/2で更新
+				innovation = (y-y_mean)[np.newaxis]-0.5*Yp
+				X = x_mean+A
+
+			for start in range(0, X.shape[1], self.chunk):
+				rows = slice(start, min(start+self.chunk, X.shape[1]))
+				rho = None if (coords is None) else kalman.localize(coords[rows], sensors, self.radius)
+				X[:, rows] += innovation@kalman.gain(A[:, rows], Yp, G, rho).T
+
+		args = []
+		for x in X:
+			if hasattr(base.field, "cells"):
+				h = x[D:].copy()
+			else:
+				h = np.full(base.field.shape, np.nan); h[base.field.voxel] = x[D:]
+			args.append((x[:D], np.minimum(h, 0.)))
+		self.map("setState", args)
+		self.log_weights = np.zeros(len(self)); self.cache = {}; self.history = []
+
+	"""
+	process : 観測による解析 (PF.samplingと同じ呼び出し方)
+	output : <bool> 常にTrue
+	"""
 	def sampling(self, y, R):
-		prob = self.getProbs(y, R)
-		sample_index = np.random.choice(np.arange(len(self)), size = len(self), p = prob)
-		individuals = np.array([self.individuals[si].copy() for si in sample_index]).reshape((-1, 2))
-		self.individuals = []
-
-		for i in range(len(individuals)):
-			param1 = individuals[i,0].params
-			param2 = individuals[i,1].params
-			h1 = individuals[i,0].field.getH() #hは片方の親の値を継承
-			h2 = individuals[i,1].field.getH() #hは片方の親の値を継承
-
-			d = np.abs(param1 - param2) #(D, )
-			param_mean = 0.5*(param1 + param2) #(D, )
-			param_max = param_mean + (0.5 + self.alpha)*d
-			param_min = param_mean - (0.5 + self.alpha)*d
-
-			new_param1 = param_min + (param_max - param_min)*np.random.rand(len(d))
-			new_param2 = param_min + (param_max - param_min)*np.random.rand(len(d))
-
-			new_ind1 = type(individuals[i,0])(new_param1)
-			new_ind1.createField(h1)
-			new_ind2 = type(individuals[i,1])(new_param2)
-			new_ind2.createField(h2)
-
-			self.individuals.append(new_ind1); self.individuals.append(new_ind2)
\ No newline at end of file
+		self.analysis(y, R)
+		return True
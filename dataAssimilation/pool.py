@@ -0,0 +1,270 @@
+import numpy as np
+import multiprocessing as mp
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from piRichards.dataAssimilation.statistics import Welford, accumulate
+
+#####粒子の並列計算の方式。"process" : 粒子をプロセスに常駐させる, "thread" : スレッドで計算 (粒子は親プロセスに保持)
+EXECUTORS = ("process", "thread")
+
+
+"""
+process : 各プロセスで担当する粒子を保持し、コマンドを実行する
+input :
+	conn -> <Connection> 親プロセスとの通信
+Note :
+-- 最初に受け取るコマンドは("put", 粒子のリスト)
+-- ("call", name, args, kwargs) -> 全粒子のメソッドnameを呼び、結果のリストを返す
+-- ("map", name, args) -> 各粒子のメソッドnameを粒子毎の引数argsで呼び、結果のリストを返す
+-- ("get", local) -> 番号localの粒子を返す
+-- ("accumulate", weights) -> 全粒子の状態(Individual.getState)を1つずつWelford法で集計し、(params, h)のWelfordを返す
+-- ("resample", keep, incoming) -> 自身の粒子keepを複製(Individual.share)し、受け取った粒子incomingと合わせて新しい粒子群とする
+"""
+def worker(conn):
+	particles = []
+	while True:
+		command = conn.recv()
+		if command[0] == "stop":
+			break
+
+		try:
+			if command[0] == "put":
+				particles = command[1]; result = None
+			elif command[0] == "call":
+				name, args, kwargs = command[1:]
+				result = [getattr(particle, name)(*args, **kwargs) for particle in particles]
+			elif command[0] == "map":
+				name, args = command[1:]
+				result = [getattr(particle, name)(*arg) for particle, arg in zip(particles, args)]
+			elif command[0] == "get":
+				result = [particles[i] for i in command[1]]
+			elif command[0] == "accumulate":
+				result = accumulate((particle.getState() for particle in particles), command[1])
+			elif command[0] == "resample":
+				keep, incoming = command[1:]
+				seen = set() #同じ粒子の複製は1回のpickleで同一オブジェクトとして届くため、2回目以降は複製する
+				for j, particle in enumerate(incoming):
+					if id(particle) in seen:
+						incoming[j] = particle.share()
+					seen.add(id(particle))
+				particles = [particles[i].share() for i in keep]+incoming; result = None
+			conn.send(("done", result))
+		except (Exception, SystemExit) as e:
+			conn.send(("error", repr(e)))
+
+
+"""
+class : 粒子を複数プロセスに常駐させて並列計算するプール
+att :
+	workers -> <int> プロセス数
+	counts -> <np array> (workers, )なshape。各プロセスの粒子数
+	offsets -> <np array> (workers+1, )なshape。各プロセスの粒子の通し番号の開始位置
+Note :
+-- 粒子の通し番号はプロセス0の粒子、プロセス1の粒子、...の順
+-- 粒子の状態(field等)はプロセス内に保持し、プロセス間で送受信するのはメソッドの引数と結果、リサンプリングの番号のみ
+-- リサンプリングでは複製元の粒子を持つプロセスで複製する。複製数がプロセスの粒子数を超えた分のみ、他のプロセスへ粒子を送る
+-- Individualのサブクラスはimport可能なモジュール (or if __name__ == "__main__"で保護したスクリプト)で定義する必要がある
+"""
+class ProcessPool:
+	"""
+	input :
+		individuals -> <list of Individual class>
+		workers -> <int> プロセス数
+	"""
+	def __init__(self, individuals, workers = 2):
+		self.workers = max(min(workers, len(individuals)), 1)
+		#####numbaのスレッドプール起動後のforkは安全でないため、forkserver (無い場合はspawn)でプロセスを起動
+		context = mp.get_context("forkserver" if ("forkserver" in mp.get_all_start_methods()) else "spawn")
+		self.conns = []; self.processes = []
+		for w in range(self.workers):
+			conn, child = context.Pipe()
+			process = context.Process(target = worker, args = (child, ), daemon = True)
+			process.start(); child.close()
+			self.conns.append(conn); self.processes.append(process)
+
+		self.put(individuals)
+
+	def __len__(self):
+		return int(self.offsets[-1])
+
+	"""
+	process : 各プロセスにコマンドを送り、結果を受け取る
+	input : commands -> <list of tuple> 各プロセスへのコマンド
+	output : <list> 各プロセスの結果
+	"""
+	def command(self, commands):
+		for conn, command in zip(self.conns, commands):
+			conn.send(command)
+
+		results = []
+		for conn in self.conns:
+			status, result = conn.recv()
+			if status != "done":
+				raise RuntimeError("particle worker failed (" + result + ")")
+			results.append(result)
+
+		return results
+
+	"""
+	process : 粒子群を各プロセスに分配
+	input : individuals -> <list of Individual class>
+	"""
+	def put(self, individuals):
+		chunks = np.array_split(np.arange(len(individuals)), self.workers)
+		self.counts = np.array([len(chunk) for chunk in chunks])
+		self.offsets = np.concatenate(([0], np.cumsum(self.counts)))
+		self.command([("put", [individuals[i] for i in chunk]) for chunk in chunks])
+
+	"""
+	process : 全粒子のメソッドを呼ぶ
+	input : name -> <str> メソッド名, args, kwargs -> メソッドの引数
+	output : <list> 各粒子の結果 (通し番号順)
+	"""
+	def call(self, name, *args, **kwargs):
+		return [result for results in self.command([("call", name, args, kwargs)]*self.workers) for result in results]
+
+	"""
+	process : 全粒子のメソッドを粒子毎の引数で呼ぶ
+	input : name -> <str> メソッド名, args -> <list of tuple> 各粒子の引数 (通し番号順)
+	output : <list> 各粒子の結果 (通し番号順)
+	"""
+	def map(self, name, args):
+		commands = [("map", name, args[self.offsets[w]:self.offsets[w+1]]) for w in range(self.workers)]
+		return [result for results in self.command(commands) for result in results]
+
+	"""
+	process : 全粒子の状態をWelford法で集計 (piRichards.dataAssimilation.statistics.accumulate)
+	input : weights -> <np array> (N, )なshape。if None -> 一様
+	output : (params, h) -> <Welford class>
+	Note : 各プロセスで担当する粒子の状態を集計し、親プロセスには集計結果のみ送る
+	"""
+	def accumulate(self, weights = None):
+		commands = [("accumulate", None if (weights is None) else weights[self.offsets[w]:self.offsets[w+1]]) for w in range(self.workers)]
+		params = Welford(); h = Welford()
+		for params_w, h_w in self.command(commands):
+			params.merge(params_w); h.merge(h_w)
+
+		return params, h
+
+	"""
+	process : 全粒子を親プロセスに集める
+	output : <list of Individual class> (通し番号順)
+	"""
+	def gather(self):
+		return [particle for particles in self.command([("get", list(range(count))) for count in self.counts]) for particle in particles]
+
+	"""
+	process : 通し番号iの粒子を親プロセスに取得
+	output : <Individual class>
+	"""
+	def get(self, i):
+		w = int(np.searchsorted(self.offsets, i, side = "right"))-1
+		self.conns[w].send(("get", [int(i-self.offsets[w])]))
+		status, result = self.conns[w].recv()
+		if status != "done":
+			raise RuntimeError("particle worker failed (" + result + ")")
+
+		return result[0]
+
+	"""
+	process : 番号sample_indexの粒子を複製した粒子群に更新
+	input : sample_index -> <np array> (N, )なshape。複製元の粒子の通し番号
+	output : <np array> (N, )なshape。リサンプリング後の各粒子の複製元の通し番号
+	Note : 粒子の並び順はsample_indexの順とは限らない (リサンプリング後の粒子は等価であるため)
+	"""
+	def resample(self, sample_index):
+		sample_index = np.asarray(sample_index)
+		owner = np.searchsorted(self.offsets, sample_index, side = "right")-1 #<np array> 複製元の粒子を持つプロセス
+		local = sample_index-self.offsets[owner]
+
+		keep = []; overflow = []
+		for w in range(self.workers):
+			sources = np.sort(local[owner == w])
+			keep.append(sources[:self.counts[w]].tolist()); overflow.append(sources[self.counts[w]:].tolist())
+
+		#####複製数が粒子数を超えた分は、粒子数に空きのあるプロセスへ送る
+		outgoing = self.command([("get", sources) for sources in overflow]) if (sum(len(sources) for sources in overflow) > 0) else [[]]*self.workers
+		outgoing = [particle for particles in outgoing for particle in particles]
+		sources = [self.offsets[w]+i for w in range(self.workers) for i in overflow[w]] #<list> 送る粒子の通し番号
+		incoming = []; ancestry = []
+		for w in range(self.workers):
+			n = self.counts[w]-len(keep[w])
+			incoming.append(outgoing[:n]); outgoing = outgoing[n:]
+			ancestry += [self.offsets[w]+i for i in keep[w]]+sources[:n]; sources = sources[n:]
+
+		self.command([("resample", keep[w], incoming[w]) for w in range(self.workers)])
+		return np.array(ancestry, dtype = int)
+
+	"""
+	process : プロセスを終了
+	"""
+	def close(self):
+		for conn, process in zip(self.conns, self.processes):
+			try:
+				conn.send(("stop", ))
+			except (BrokenPipeError, OSError):
+				pass
+			process.join(timeout = 10)
+			if process.is_alive():
+				process.terminate()
+
+
+"""
+class : 粒子をスレッドで並列計算するプール (ProcessPoolと同じ呼び出し方)
+att :
+	individuals -> <list of Individual class>
+	executor -> <ThreadPoolExecutor>
+Note : 粒子は親プロセスに保持する。numpyの演算がGILを解放する区間のみ並列化される
+"""
+class ThreadPool:
+	def __init__(self, individuals, workers = 2):
+		self.workers = max(workers, 1)
+		self.executor = ThreadPoolExecutor(max_workers = self.workers)
+		self.put(individuals)
+
+	def __len__(self):
+		return len(self.individuals)
+
+	def put(self, individuals):
+		self.individuals = list(individuals)
+
+	def call(self, name, *args, **kwargs):
+		return list(self.executor.map(lambda particle: getattr(particle, name)(*args, **kwargs), self.individuals))
+
+	def map(self, name, args):
+		return list(self.executor.map(lambda particle, arg: getattr(particle, name)(*arg), self.individuals, args))
+
+	def accumulate(self, weights = None):
+		return accumulate((particle.getState() for particle in self.individuals), weights)
+
+	def gather(self):
+		return list(self.individuals)
+
+	def get(self, i):
+		return self.individuals[i]
+
+	def resample(self, sample_index):
+		self.individuals = [self.individuals[i].share() for i in sample_index]
+		return np.asarray(sample_index)
+
+	def close(self):
+		self.executor.shutdown()
+
+
+"""
+process : 粒子の並列計算のプールを作成
+input :
+	individuals -> <list of Individual class>
+	workers -> <int> プロセス数 (スレッド数)。if None -> CPU数
+	executor -> <str> "process" or "thread"
+output : <ProcessPool class> or <ThreadPool class>
+"""
+def createPool(individuals, workers = None, executor = "process"):
+	if executor not in EXECUTORS:
+		print("Error@piRichards.dataAssimilation.pool.createPool")
+		print("executor <" + str(executor) + "> is not supported.")
+		sys.exit()
+
+	workers = os.cpu_count() if (workers is None) else workers
+	return ProcessPool(individuals, workers) if (executor == "process") else ThreadPool(individuals, workers)
@@ -0,0 +1,62 @@
+import numpy as np
+import sys
+
+#####リサンプリング法。"multinomial" : 多項リサンプリング (従来), "systematic" : 系統リサンプリング, "stratified" : 層化リサンプリング, "residual" : 残差リサンプリング
+RESAMPLING_METHODS = ("multinomial", "systematic", "stratified", "residual")
+
+
+"""
+process : リサンプリング法の指定を確認
+input : method -> <str> RESAMPLING_METHODSのいずれか
+"""
+def checkResampling(method):
+	if method not in RESAMPLING_METHODS:
+		print("Error@piRichards.dataAssimilation.resampling.checkResampling")
+		print("resampling <" + str(method) + "> is not supported.")
+		sys.exit()
+
+
+"""
+process : 累積重みに対する一様乱数の位置から番号を取得
+input :
+	prob -> <np array> (N, )なshape。正規化した重み
+	u -> <np array> (M, )なshape。昇順の[0, 1)の値
+output : <np array> (M, )なshape
+"""
+def invertCDF(prob, u):
+	cdf = np.cumsum(prob)
+	cdf[-1] = 1. #丸め誤差で1未満になるのを防ぐ
+	return np.minimum(np.searchsorted(cdf, u, side = "right"), len(prob)-1)
+
+
+"""
+process : 重みに従い複製元の番号を抽出
+input :
+	prob -> <np array> (N, )なshape。正規化した重み
+	size -> <int> 抽出数。if None -> N
+	method -> <str> RESAMPLING_METHODSのいずれか
+output : <np array> (size, )なshape。複製元の番号
+Note :
+-- "systematic", "stratified", "residual"は多項リサンプリングより複製数のばらつき(モンテカルロ誤差)が小さく、O(N)で計算する
+-- 多項リサンプリング以外は番号がまとまって並ぶため、ランダムに並べ替えて返す (MPF, BLX_alphaで組を作るため)
+"""
+def resampleIndex(prob, size = None, method = "multinomial"):
+	N = len(prob); size = N if (size is None) else size
+	if method == "multinomial":
+		return np.random.choice(np.arange(N), size = size, p = prob)
+
+	if method == "systematic":
+		index = invertCDF(prob, (np.arange(size)+np.random.rand())/size)
+	elif method == "stratified":
+		index = invertCDF(prob, (np.arange(size)+np.random.rand(size))/size)
+	elif method == "residual":
+		counts = np.floor(size*prob).astype(int) #<np array> 確定的な複製数
+		index = np.repeat(np.arange(N), counts)
+		rest = size-len(index)
+		if rest > 0:
+			residual = size*prob-counts
+			index = np.concatenate((index, np.random.choice(np.arange(N), size = rest, p = residual/np.sum(residual))))
+	else:
+		checkResampling(method)
+
+	return np.random.permutation(index)
@@ -0,0 +1,157 @@
+import numpy as np
+
+"""
+class : Welford法による逐次的な平均・分散の計算 (重み付き可)
+att :
+	count -> <int> 追加した標本数
+	weight -> <float> 重みの合計
+	mean -> <np array> 平均
+	m2 -> <np array> 偏差平方和 sum(w*(x-mean)^2)
+Note :
+-- 標本を1つずつ追加するため、全標本を1つの配列に積む必要がない
+-- 別々に標本を追加したWelfordはmergeで合わせられる (プールの各プロセスで計算した結果の集約)
+-- 分散は標本数(重みの合計)で割った値 (PF.varと同じ)
+-- np.nanの要素(voidセル)はnp.nanのまま
+"""
+class Welford:
+	def __init__(self):
+		self.count = 0
+		self.weight = 0.
+		self.mean = None
+		self.m2 = None
+
+	"""
+	process : 標本の追加
+	input : x -> <np array> 標本, w -> <float> 重み
+	"""
+	def update(self, x, w = 1.):
+		x = np.asarray(x, dtype = float)
+		if self.mean is None:
+			self.mean = np.zeros(x.shape); self.m2 = np.zeros(x.shape)
+
+		self.count += 1
+		if w <= 0.:
+			return
+
+		self.weight += w
+		delta = x-self.mean
+		self.mean += (w/self.weight)*delta
+		self.m2 += w*delta*(x-self.mean)
+
+	"""
+	process : 別のWelfordの標本を合わせる (Chanらの並列アルゴリズム)
+	input : other -> <Welford class>
+	"""
+	def merge(self, other):
+		if other.mean is None:
+			return
+
+		if self.mean is None:
+			self.mean = np.zeros(other.mean.shape); self.m2 = np.zeros(other.m2.shape)
+
+		self.count += other.count
+		if other.weight <= 0.:
+			return
+
+		weight = self.weight+other.weight
+		delta = other.mean-self.mean
+		self.mean += (other.weight/weight)*delta
+		self.m2 += other.m2+delta**2*(self.weight*other.weight/weight)
+		self.weight = weight
+
+	def var(self):
+		return self.m2/self.weight if (self.weight > 0.) else np.full(self.m2.shape, np.nan)
+
+
+"""
+process : 各個体の状態をWelford法で逐次集計
+input :
+	states -> <iterable of tuple> 各個体の(params, h) (Individual.getState)。ジェネレータでもよい
+	weights -> <np array> (N, )なshape。if None -> 一様
+output : (params, h) -> <Welford class> パラメータ及びhの集計
+Note : statesを1つずつ取り出して集計するため、ジェネレータを渡せば全個体の状態を同時に保持しない
+"""
+def accumulate(states, weights = None):
+	params = Welford(); h = Welford()
+	for i, (p, x) in enumerate(states):
+		w = 1. if (weights is None) else weights[i]
+		params.update(p, w); h.update(x, w)
+
+	return params, h
+
+
+"""
+process : 重み付き分位点 (標本の0軸に沿って計算)
+input :
+	X -> <np array> (N, ...)なshape。標本を積んだ配列
+	q -> <float> or <list of float> 分位 (0 <= q <= 1)
+	weights -> <np array> (N, )なshape。if None -> 一様
+output : <np array> (len(q), ...)なshape (qがfloatの場合は(...)なshape)
+Note : 累積重みがq以上となる最小の標本値 (重みが一様のときnp.quantile(method = "inverted_cdf")と同じ)
+"""
+def quantile(X, q, weights = None):
+	X = np.asarray(X, dtype = float)
+	weights = np.ones(len(X)) if (weights is None) else np.asarray(weights, dtype = float)
+	order = np.argsort(X, axis = 0) #np.nanは末尾
+	X_sorted = np.take_along_axis(X, order, axis = 0)
+	cw = np.cumsum(weights[order], axis = 0) #<np array> 累積重み
+	cw /= cw[-1]
+
+	qs = np.atleast_1d(q)
+	result = np.empty((len(qs),)+X.shape[1:])
+	for i, qi in enumerate(qs):
+		index = np.minimum(np.sum(cw < qi-1e-12, axis = 0), len(X)-1)
+		result[i] = np.take_along_axis(X_sorted, index[np.newaxis], axis = 0)[0]
+
+	return result if (np.ndim(q) > 0) else result[0]
+
+
+"""
+class : 個体群の統計量
+att :
+	params_mean, params_var -> <np array> (D, )なshape。パラメータの平均、分散
+	h_mean, h_var -> <np array> (Nx, Ny, Nz)なshape。マトリックポテンシャルの平均、分散 (voidセルはnp.nan)
+	q -> <list of float> 分位
+	params_quantile -> <np array> (len(q), D)なshape。if q is None -> None
+	h_quantile -> <np array> (len(q), Nx, Ny, Nz)なshape。if q is None -> None
+"""
+class Summary:
+	def __init__(self, params_mean, params_var, h_mean, h_var, q = None, params_quantile = None, h_quantile = None):
+		self.params_mean = params_mean
+		self.params_var = params_var
+		self.h_mean = h_mean
+		self.h_var = h_var
+		self.q = q
+		self.params_quantile = params_quantile
+		self.h_quantile = h_quantile
+
+	@property
+	def params_std(self):
+		return np.sqrt(self.params_var)
+
+	@property
+	def h_std(self):
+		return np.sqrt(self.h_var)
+
+
+"""
+process : 個体群の統計量を計算
+input :
+	states -> <iterable of tuple> 各個体の(params, h) (Individual.getState)。q is Noneの場合はジェネレータでもよい
+	weights -> <np array> (N, )なshape。if None -> 一様
+	q -> <list of float> 分位。if None -> 分位点は計算しない
+output : <Summary class>
+Note : 平均・分散はWelford法で逐次計算する(accumulate)。分位点を計算する場合のみ全個体の配列を積む
+"""
+def summarize(states, weights = None, q = None):
+	if q is not None:
+		states = list(states)
+
+	params, h = accumulate(states, weights)
+	summary = Summary(params.mean, params.var(), h.mean, h.var())
+	if q is not None:
+		summary.q = list(np.atleast_1d(q))
+		summary.params_quantile = quantile(np.stack([p for p, x in states]), summary.q, weights)
+		summary.h_quantile = quantile(np.stack([x for p, x in states]), summary.q, weights)
+
+	return summary
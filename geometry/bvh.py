@@ -0,0 +1,291 @@
+import numpy as np
+
+#####葉ノードが持つ三角形の数
+LEAF_SIZE = 8
+#####問い合わせで一度に処理する点(光線)の数
+QUERY_CHUNK = 1 << 14
+
+
+"""
+process : 三角形が参照点に張る符号付き立体角
+input : triangles -> <np array> (..., 3, 3)なshape。参照点を原点とした三角形の頂点
+output : <np array> (...)なshape。外向きの三角形を内側から見ると正 (閉じたメッシュの内側で和が4π)
+"""
+def solidAngle(triangles):
+	A = triangles[..., 0, :]; B = triangles[..., 1, :]; C = triangles[..., 2, :]
+	a = np.sqrt(np.sum(A**2, axis = -1)); b = np.sqrt(np.sum(B**2, axis = -1)); c = np.sqrt(np.sum(C**2, axis = -1))
+	det = np.sum(A*np.cross(B, C), axis = -1)
+	return 2.*np.arctan2(det, a*b*c+c*np.sum(A*B, axis = -1)+a*np.sum(B*C, axis = -1)+b*np.sum(C*A, axis = -1))
+
+
+"""
+process : 点と三角形の距離
+input :
+	X -> <np array> (N, 3)なshape。点
+	triangles -> <np array> (N, 3, 3)なshape。三角形の頂点
+output : <np array> (N, )なshape
+Note : 平面への射影が三角形内にあれば平面までの距離、それ以外は3辺までの距離の最小値
+"""
+def pointTriangleDistance(X, triangles):
+	A = triangles[:, 0]; B = triangles[:, 1]; C = triangles[:, 2]
+	n = np.cross(B-A, C-A); nn = np.sum(n**2, axis = -1)
+	with np.errstate(divide = "ignore", invalid = "ignore"):
+		s = np.sum(n*(X-A), axis = -1)/nn
+		P = X-s[:, np.newaxis]*n #<np array> 平面への射影
+		inside = (nn > 0.)*(np.sum(np.cross(B-A, P-A)*n, axis = -1) >= 0.)*(np.sum(np.cross(C-B, P-B)*n, axis = -1) >= 0.)*(np.sum(np.cross(A-C, P-C)*n, axis = -1) >= 0.)
+		d = np.where(inside, np.abs(s)*np.sqrt(nn), np.inf)
+
+	for U, V in ((A, B), (B, C), (C, A)):
+		E = V-U
+		t = np.clip(np.sum((X-U)*E, axis = -1)/np.maximum(np.sum(E**2, axis = -1), 1e-300), 0., 1.)
+		d = np.minimum(d, np.sqrt(np.sum((X-U-t[:, np.newaxis]*E)**2, axis = -1)))
+
+	return d
+
+
+"""
+process : 光線と三角形の交点までの距離 (Moller-Trumbore法)
+input :
+	O -> <np array> (N, 3)なshape。光線の始点
+	D -> <np array> (N, 3)なshape。光線の方向
+	triangles -> <np array> (N, 3, 3)なshape。三角形の頂点
+output : <np array> (N, )なshape。交点の光線パラメータt (交点 = O+t*D)。交わらない場合はnp.inf
+"""
+def rayTriangle(O, D, triangles):
+	A = triangles[:, 0]; E1 = triangles[:, 1]-A; E2 = triangles[:, 2]-A
+	P = np.cross(D, E2); det = np.sum(E1*P, axis = -1)
+	with np.errstate(divide = "ignore", invalid = "ignore"):
+		inv = 1./det
+		S = O-A; u = np.sum(S*P, axis = -1)*inv
+		Q = np.cross(S, E1); v = np.sum(D*Q, axis = -1)*inv
+		t = np.sum(E2*Q, axis = -1)*inv
+		hit = (det != 0.)*(u >= 0.)*(v >= 0.)*(u+v <= 1.)*(t >= 0.)
+
+	return np.where(hit, t, np.inf)
+
+
+"""
+process : 10bitの整数の各bitを3bit間隔に広げる (Mortonコード用)
+input : v -> <np array> 0 ~ 1023の整数
+output : <np array:uint64>
+"""
+def expandBits(v):
+	v = v.astype(np.uint64)
+	v = (v*np.uint64(0x00010001)) & np.uint64(0xFF0000FF)
+	v = (v*np.uint64(0x00000101)) & np.uint64(0x0F00F00F)
+	v = (v*np.uint64(0x00000011)) & np.uint64(0xC30C30C3)
+	v = (v*np.uint64(0x00000005)) & np.uint64(0x49249249)
+	return v
+
+
+"""
+process : 点のMortonコード (z-order曲線上の位置)
+input :
+	points -> <np array> (N, 3)なshape
+	lo, hi -> <np array> (3, )なshape。点を含む箱
+output : <np array:uint64> (N, )なshape
+"""
+def mortonCode(points, lo, hi):
+	q = np.clip(((points-lo)/np.maximum(hi-lo, 1e-300)*1023.).astype(np.int64), 0, 1023)
+	return (expandBits(q[:, 0]) << np.uint64(2)) | (expandBits(q[:, 1]) << np.uint64(1)) | expandBits(q[:, 2])
+
+
+"""
+class : 三角形メッシュのバウンディングボリューム階層 (BVH)
+att :
+	leaf_size -> <int> 葉ノードが持つ三角形の数
+	order -> <np array> (T, )なshape。並び替えた三角形の元の番号
+	triangles -> <np array> (T, 3, 3)なshape。Mortonコード順に並び替えた三角形の頂点
+	n_leaf -> <int> 葉ノードの数 (2のべき乗)
+	lo, hi -> <np array> (2*n_leaf, 3)なshape。各ノードの箱 (三角形を持たないノードはlo = np.inf, hi = -np.inf)
+	count -> <np array> (2*n_leaf, )なshape。各ノードの三角形の数
+	area -> <np array> (2*n_leaf, )なshape。各ノードの三角形の面積の和
+	area_vector -> <np array> (2*n_leaf, 3)なshape。各ノードの面積ベクトル(法線*面積)の和
+	center -> <np array> (2*n_leaf, 3)なshape。各ノードの三角形の面積重心
+	radius -> <np array> (2*n_leaf, )なshape。centerを中心とし、ノードの三角形を全て含む球の半径
+	rep -> <np array> (2*n_leaf, 3)なshape。各ノードの三角形の頂点の1つ (最近傍距離の上界に用いる)
+Note :
+-- 三角形を重心のMortonコード順に並べ、leaf_size個ずつ葉とした完全二分木 (ノード1が根、ノードiの子は2i, 2i+1、葉はn_leaf ~ 2*n_leaf-1)
+-- 構築、問い合わせとも木の段毎に全ノード(全ての点とノードの組)をまとめて配列演算で処理する
+-- 三角形の頂点はメッシュの外向き法線の向きに並んでいるとする (STLの規約)
+"""
+class BVH:
+	"""
+	input :
+		triangles -> <np array> (T, 3, 3)なshape。三角形の頂点
+		leaf_size -> <int> 葉ノードが持つ三角形の数
+	"""
+	def __init__(self, triangles, leaf_size = LEAF_SIZE):
+		triangles = np.asarray(triangles, dtype = float).reshape((-1, 3, 3))
+		T = len(triangles); self.leaf_size = leaf_size
+
+		#####三角形をMortonコード順に並び替え
+		centroids = np.mean(triangles, axis = 1)
+		self.order = np.argsort(mortonCode(centroids, np.min(centroids, axis = 0), np.max(centroids, axis = 0)), kind = "stable") if (T > 0) else np.zeros(0, dtype = int)
+		self.triangles = triangles[self.order]; centroids = centroids[self.order]
+
+		self.n_leaf = 1
+		while self.n_leaf*leaf_size < T:
+			self.n_leaf *= 2
+		N = 2*self.n_leaf #<int> ノード数 (0番は使わない)
+		self.lo = np.full((N, 3), np.inf); self.hi = np.full((N, 3), -np.inf)
+		self.count = np.zeros(N, dtype = int); self.area = np.zeros(N); self.area_vector = np.zeros((N, 3))
+		self.center = np.zeros((N, 3)); self.radius = np.zeros(N); self.rep = np.zeros((N, 3))
+
+		##########葉ノード
+		if T > 0:
+			starts = np.arange(0, T, leaf_size); leaves = self.n_leaf+np.arange(len(starts))
+			self.count[leaves] = np.diff(np.append(starts, T))
+			self.lo[leaves] = np.minimum.reduceat(np.min(self.triangles, axis = 1), starts, axis = 0)
+			self.hi[leaves] = np.maximum.reduceat(np.max(self.triangles, axis = 1), starts, axis = 0)
+			area_vector = 0.5*np.cross(self.triangles[:, 1]-self.triangles[:, 0], self.triangles[:, 2]-self.triangles[:, 0])
+			area = np.sqrt(np.sum(area_vector**2, axis = -1))
+			self.area_vector[leaves] = np.add.reduceat(area_vector, starts, axis = 0)
+			self.area[leaves] = np.add.reduceat(area, starts)
+			#####面積が0の葉は三角形の重心の平均
+			weighted = np.add.reduceat(area[:, np.newaxis]*centroids, starts, axis = 0); mean = np.add.reduceat(centroids, starts, axis = 0)/self.count[leaves][:, np.newaxis]
+			with np.errstate(divide = "ignore", invalid = "ignore"):
+				self.center[leaves] = np.where(self.area[leaves][:, np.newaxis] > 0., weighted/self.area[leaves][:, np.newaxis], mean)
+			spread = np.max(np.sqrt(np.sum((self.triangles-np.repeat(self.center[leaves], self.count[leaves], axis = 0)[:, np.newaxis, :])**2, axis = -1)), axis = 1)
+			self.radius[leaves] = np.maximum.reduceat(spread, starts)
+			self.rep[leaves] = self.triangles[starts, 0]
+
+		##########内部ノード (下の段から)
+		level = self.n_leaf//2
+		while level >= 1:
+			nodes = np.arange(level, 2*level); left = 2*nodes; right = left+1
+			self.lo[nodes] = np.minimum(self.lo[left], self.lo[right]); self.hi[nodes] = np.maximum(self.hi[left], self.hi[right])
+			self.count[nodes] = self.count[left]+self.count[right]
+			self.area[nodes] = self.area[left]+self.area[right]
+			self.area_vector[nodes] = self.area_vector[left]+self.area_vector[right]
+			with np.errstate(divide = "ignore", invalid = "ignore"):
+				weighted = (self.area[left, np.newaxis]*self.center[left]+self.area[right, np.newaxis]*self.center[right])/self.area[nodes, np.newaxis]
+			self.center[nodes] = np.where(self.area[nodes, np.newaxis] > 0., weighted, np.where(self.count[left, np.newaxis] > 0, self.center[left], self.center[right]))
+			r_left = np.where(self.count[left] > 0, np.sqrt(np.sum((self.center[left]-self.center[nodes])**2, axis = -1))+self.radius[left], 0.)
+			r_right = np.where(self.count[right] > 0, np.sqrt(np.sum((self.center[right]-self.center[nodes])**2, axis = -1))+self.radius[right], 0.)
+			self.radius[nodes] = np.maximum(r_left, r_right)
+			self.rep[nodes] = np.where(self.count[left, np.newaxis] > 0, self.rep[left], self.rep[right])
+			level //= 2
+
+	"""
+	process : 葉ノードの組を、葉の三角形との組に展開
+	input : p -> <np array> 点の番号, node -> <np array> 葉ノードの番号
+	output : <tuple of np array> (点の番号, 並び替えた三角形の番号)
+	"""
+	def leafPairs(self, p, node):
+		count = self.count[node]
+		tri = np.repeat((node-self.n_leaf)*self.leaf_size, count)+np.arange(np.sum(count))-np.repeat(np.cumsum(count)-count, count)
+		return np.repeat(p, count), tri
+
+	"""
+	process : 内部ノードの組を、子ノードとの組に展開
+	input : p -> <np array> 点の番号, node -> <np array> 内部ノードの番号
+	output : <tuple of np array> (点の番号, 子ノードの番号)
+	"""
+	def childPairs(self, p, node):
+		return np.repeat(p, 2), (2*node[:, np.newaxis]+np.array([0, 1])).ravel()
+
+	"""
+	process : 一般化巻き数の近似計算 (Barnes-Hut法)
+	input :
+		X -> <np array> (P, 3)なshape。参照点
+		beta -> <float> ノードの中心までの距離がbeta*radiusより大きい場合、ノードの三角形を1つの双極子で近似する
+	output : <np array> (P, )なshape。オブジェクト内側で1、外側で0
+	Note : 近いノードは子ノードに分け、葉では三角形の立体角を厳密に計算する。betaを大きくすると精度が上がり、計算量が増える
+	"""
+	def windingNumber(self, X, beta = 2.):
+		X = np.asarray(X, dtype = float).reshape((-1, 3))
+		winding_number = np.zeros(len(X))
+		for s in range(0, len(X), QUERY_CHUNK):
+			p = np.arange(s, min(s+QUERY_CHUNK, len(X))); node = np.ones(len(p), dtype = int)
+			while len(p) > 0:
+				keep = self.count[node] > 0; p = p[keep]; node = node[keep]
+				R = self.center[node]-X[p]; d = np.sqrt(np.sum(R**2, axis = -1))
+
+				#####遠いノードは双極子近似 n*(c-X)/(4π|c-X|^3)
+				far = d > beta*self.radius[node]
+				np.add.at(winding_number, p[far], np.sum(self.area_vector[node[far]]*R[far], axis = -1)/(4.*np.pi*d[far]**3))
+
+				#####近い葉は厳密に計算
+				leaf = (~far)*(node >= self.n_leaf)
+				lp, tri = self.leafPairs(p[leaf], node[leaf])
+				np.add.at(winding_number, lp, solidAngle(self.triangles[tri]-X[lp][:, np.newaxis, :])/(4.*np.pi))
+
+				inner = (~far)*(node < self.n_leaf)
+				p, node = self.childPairs(p[inner], node[inner])
+
+		return winding_number
+
+	"""
+	process : 点がオブジェクト内側にあるかどうか判定
+	input : X -> <np array> (P, 3)なshape, beta -> <float> windingNumberの近似の閾値
+	output : <np array:bool> (P, )なshape
+	"""
+	def contains(self, X, beta = 2.):
+		return self.windingNumber(X, beta) >= 0.5
+
+	"""
+	process : 光線と最初に交わる三角形
+	input :
+		origins -> <np array> (P, 3)なshape。光線の始点
+		directions -> <np array> (P, 3)なshape (or (3, ))。光線の方向
+	output :
+		t -> <np array> (P, )なshape。交点の光線パラメータ (交点 = origins+t*directions)。交わらない場合はnp.inf
+		index -> <np array> (P, )なshape。三角形の元の番号 (STL.trianglesの番号)。交わらない場合は-1
+	Note : 箱と交わらないノード、見つかった交点より遠いノードは探索しない
+	"""
+	def intersect(self, origins, directions):
+		O = np.asarray(origins, dtype = float).reshape((-1, 3)); D = np.broadcast_to(np.asarray(directions, dtype = float), O.shape)
+		t_best = np.full(len(O), np.inf); index = np.full(len(O), -1)
+		for s in range(0, len(O), QUERY_CHUNK):
+			p = np.arange(s, min(s+QUERY_CHUNK, len(O))); node = np.ones(len(p), dtype = int)
+			while len(p) > 0:
+				#####slab法による箱との交差判定
+				with np.errstate(divide = "ignore", invalid = "ignore"):
+					inv = 1./D[p]
+					t1 = (self.lo[node]-O[p])*inv; t2 = (self.hi[node]-O[p])*inv
+				t_min = np.max(np.fmin(t1, t2), axis = -1); t_max = np.min(np.fmax(t1, t2), axis = -1)
+				hit = (self.count[node] > 0)*(t_max >= np.maximum(t_min, 0.))*(t_min <= t_best[p])
+				p = p[hit]; node = node[hit]
+
+				leaf = node >= self.n_leaf
+				lp, tri = self.leafPairs(p[leaf], node[leaf])
+				t = rayTriangle(O[lp], D[lp], self.triangles[tri])
+				np.minimum.at(t_best, lp, t)
+				found = (t == t_best[lp])*np.isfinite(t)
+				index[lp[found]] = self.order[tri[found]]
+
+				p, node = self.childPairs(p[~leaf], node[~leaf])
+
+		return t_best, index
+
+	"""
+	process : 最も近い三角形までの距離
+	input : X -> <np array> (P, 3)なshape
+	output :
+		distance -> <np array> (P, )なshape
+		index -> <np array> (P, )なshape。最も近い三角形の元の番号 (STL.trianglesの番号)
+	Note : ノードの箱までの距離(下界)が、それまでの最短距離(ノードの頂点repまでの距離を含む上界)より遠いノードは探索しない
+	"""
+	def distance(self, X):
+		X = np.asarray(X, dtype = float).reshape((-1, 3))
+		distance = np.full(len(X), np.inf); bound = np.full(len(X), np.inf); index = np.full(len(X), -1)
+		for s in range(0, len(X), QUERY_CHUNK):
+			p = np.arange(s, min(s+QUERY_CHUNK, len(X))); node = np.ones(len(p), dtype = int)
+			while len(p) > 0:
+				keep = self.count[node] > 0; p = p[keep]; node = node[keep]
+				np.minimum.at(bound, p, np.sqrt(np.sum((self.rep[node]-X[p])**2, axis = -1)))
+				lower = np.sqrt(np.sum(np.maximum(np.maximum(self.lo[node]-X[p], X[p]-self.hi[node]), 0.)**2, axis = -1))
+				near = lower <= bound[p]*(1.+1e-9)
+				p = p[near]; node = node[near]
+
+				leaf = node >= self.n_leaf
+				lp, tri = self.leafPairs(p[leaf], node[leaf])
+				d = pointTriangleDistance(X[lp], self.triangles[tri])
+				np.minimum.at(distance, lp, d); np.minimum.at(bound, lp, d)
+				found = d == distance[lp]
+				index[lp[found]] = self.order[tri[found]]
+
+				p, node = self.childPairs(p[~leaf], node[~leaf])
+
+		return distance, index
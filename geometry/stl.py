@@ -1,7 +1,23 @@
 import numpy as np
 import os
+import re
 import sys
-import struct
+from piRichards.geometry.bvh import BVH, solidAngle
+
+#####ボクセルの内外判定法。"winding" : 一般化巻き数 (閉じていないメッシュにも頑健), "scanline" : z方向の光線と三角形の交点の偶奇 (閉じたメッシュ用、高速)
+#####"bvh" : BVHを用いた一般化巻き数の近似 (Barnes-Hut法)
+VOXEL_METHODS = ("winding", "scanline", "bvh")
+#####内外判定で一度に計算する点と三角形の組の数
+WINDING_CHUNK = 1 << 20
+#####ascii形式を読み込む単位 [byte]
+ASCII_CHUNK = 1 << 24
+#####ascii形式の各行の正規表現
+#####(キーワードで始まるパターンとし、正規表現の検索を高速化。solidはendsolidにも一致するため読み込み時に除く)
+ASCII_SOLID = re.compile(rb"solid([^\r\n]*)")
+ASCII_FACET = re.compile(rb"normal[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)")
+ASCII_VERTEX = re.compile(rb"vertex[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)")
+#####binary形式の三角形1つ分のデータ (法線ベクトル12 byte + 頂点36 byte + 属性2 byte = 50 byte)
+BINARY_RECORD = np.dtype([("normal", "<f4", (3, )), ("vertex", "<f4", (3, 3)), ("attribute", "<u2")])
 
 """
 process : STLファイルから計算領域に関するデータを作成
@@ -11,31 +27,40 @@ input :
 	scale -> <str> STLファイルで採用されている長さ単位
 	delimiter -> <str> STLファイルで採用されている区切り文字
 	filetype -> <str: "ascii" or "binary"> ファイルタイプ
+	chunk -> <int> 内外判定で一度に計算する点と三角形の組の数 (メモリ使用量の上限)
+	method -> <str> VOXEL_METHODSのいずれか
 output :
 	voxel -> <ndarray:bool> ボクセル情報。(Nx, Ny, Nz)なshape。
 		if voxel[i, j, k] == True -> オブジェクト内側 (流体領域)
 	top_cell -> <list of list> topCellの出力
 	bottom_cell -> <list of list> bottomCellの出力
+Note :
+-- "winding" -> 各ボクセルの中心点の内外判定はSTL.isInで一括して計算する
+-- "bvh" -> 各ボクセルの中心点の一般化巻き数をSTL.bvhで近似計算する
+-- "scanline" -> (x, y)の列毎にz方向の光線を1本だけ飛ばし、STL.scanlineで交点の間を偶奇で埋める。メッシュが閉じている(watertight)必要がある
 """
-def createCell(size, filename, scale = "mm", delimiter = " ", filetype = "binary"):
+def createCell(size, filename, scale = "mm", delimiter = " ", filetype = "binary", chunk = WINDING_CHUNK, method = "winding"):
+	if method not in VOXEL_METHODS:
+		print("Error@piRichards.geometry.stl.createCell")
+		print("method <" + str(method) + "> is not supported.")
+		sys.exit()
+
 	getometry = STL(filename, scale, delimiter, filetype) #<STL>
 	x_ran, y_ran, z_ran = getometry.getSize() #<tuple> 各軸のmin-max
-	if scale == "mm":
-		x_ran = (x_ran[0]/1000., x_ran[1]/1000.); y_ran = (y_ran[0]/1000., y_ran[1]/1000.); z_ran = (z_ran[0]/1000., z_ran[1]/1000.)
+	unit = 1000. if (scale == "mm") else 1. #<float> [m]からSTLの長さ単位への換算
+	x_ran = (x_ran[0]/unit, x_ran[1]/unit); y_ran = (y_ran[0]/unit, y_ran[1]/unit); z_ran = (z_ran[0]/unit, z_ran[1]/unit)
 
-	#####ボクセルshape計算。ボクセル作成。
+	#####ボクセルshape計算。
 	shape = (int((x_ran[1]-x_ran[0])/size[0]), int((y_ran[1]-y_ran[0])/size[1]), int((z_ran[1]-z_ran[0])/size[2]))
-	voxel = np.zeros(shape).astype(bool)
-
-	#####各ボクセルに対して流体領域かどうかを確認
-	for ix in range(shape[0]):
-		x = (ix+0.5)*size[0]+x_ran[0]
-		for iy in range(shape[1]):
-			y = (iy+0.5)*size[1]+y_ran[0]
-			for iz in range(shape[2]):
-				z = (iz+0.5)*size[2]+z_ran[0]
-				voxel[ix, iy, iz] = getometry.isIn(np.array([x, y, z]))
-				
+
+	#####各ボクセルの中心点に対して流体領域かどうかを確認 (STLの長さ単位で判定)
+	x = (np.arange(shape[0])+0.5)*size[0]+x_ran[0]; y = (np.arange(shape[1])+0.5)*size[1]+y_ran[0]; z = (np.arange(shape[2])+0.5)*size[2]+z_ran[0]
+	if method == "scanline":
+		voxel = getometry.scanline(x*unit, y*unit, z*unit, chunk)
+	else:
+		X = np.stack(np.meshgrid(x, y, z, indexing = "ij"), axis = -1).reshape((-1, 3))
+		voxel = (getometry.bvh.contains(X*unit) if (method == "bvh") else getometry.isIn(X*unit, chunk)).reshape(shape)
+
 	return voxel, topCell(voxel), bottomCell(voxel)
 
 
@@ -79,6 +104,8 @@ class : STLファイルデータを格納したクラス
 att :
 	scale -> <str> stlで採用されている長さ単位
 	patches -> <list of dictionary> stlファイルに書かれているPatchのリスト
+	triangles -> <np array> (T, 3, 3)なshape。全Patchの三角形の頂点
+	bvh -> <BVH class> trianglesのバウンディングボリューム階層 (内外判定、光線との交差、最近傍距離の高速な計算に用いる)
 """
 class STL:
 	"""
@@ -89,84 +116,200 @@ class STL:
 	filetype -> <str: "ascii" or "binary"> ファイルタイプ
 	"""
 	def __init__(self, filename, scale = "mm", delimiter = " ", filetype = "binary"):
-		self.patches = []; self.scale = scale
+		self.patches = []; self.scale = scale; self.delimiter = delimiter
 
 		##########ファイル読み込み
 		if filetype == "ascii":
 			#####ascii形式の場合
-			with open(filename, "r") as file:
-				for f in file:
-
-					#####行を文字で区切る
-					f = f[:-1].split(self.delimiter); f = [s for s in f if s != ""]
-					
-					#####新しくPatchを追加
-					if "solid" in f:
-						patch = {"name" : f[-1], "facet_normal" : None, "vertex" : None}
-						self.patches.append(patch)
-					#####facet_normal情報追加
-					elif f[0] == "facet":
-						x, y, z = float(f[2]), float(f[3]), float(f[4]) #<float> ベクトル値
-						self.patches[-1]["facet_normal"] = np.array([[x, y, z]]) if (self.patches[-1]["facet_normal"] is None) else np.concatenate((self.patches[-1]["facet_normal"], np.array([[x, y, z]])), axis = 0)
-					#####vertex情報追加
-					elif f[0] == "vertex":
-						x, y, z = float(f[1]), float(f[2]), float(f[3])
-						self.patches[-1]["vertex"] = np.array([[x, y, z]]) if (self.patches[-1]["vertex"] is None) else np.concatenate((self.patches[-1]["vertex"], np.array([[x, y, z]])), axis = 0)
-					else: pass #EOF等
-
-
-				#####vertexのshapeを(Nt, 3, 3)に修正
-				for p in self.patches:
-					p["vertex"] = np.expand_dims(p["vertex"], axis = 1).reshape((-1, 3, 3))
-
+			self.readAscii(filename)
 		else:
 			#####binary形式の場合
-			filesize = os.path.getsize(filename) #<int> ファイルサイズ (or 未読のファイルデータ数)
-			with open(filename, "rb") as file:
-
-				#####未読ファイルデータ数がゼロになるまで(=EOFまで)
-				while filesize > 0:
-					#####Patchを追加
-					patch = {"name" : file.read(80).decode(), "facet_normal" : None, "vertex" : None}
-					self.patches.append(patch); filesize -= 80
-					tri_num = struct.unpack("I", file.read(4))[0]; filesize -= 4 #<int> Patchの三角形の数
-
-					for itri in range(tri_num):
-						#####facet_normal情報読み込み
-						xyz = [struct.unpack("f", file.read(4))[0] for i in range(3)]; filesize -= 12
-						self.patches[-1]["facet_normal"] = np.array([xyz]) if (self.patches[-1]["facet_normal"] is None) else np.concatenate((self.patches[-1]["facet_normal"], np.array([xyz])), axis = 0)
-
-						#####vertex情報読み込み
-						tri1 = np.array([struct.unpack("f", file.read(4))[0] for i in range(3)])
-						tri2 = np.array([struct.unpack("f", file.read(4))[0] for i in range(3)])
-						tri3 = np.array([struct.unpack("f", file.read(4))[0] for i in range(3)]); filesize -= 36
-						tri = np.stack((tri1, tri2, tri3), axis = 0); tri = np.expand_dims(tri, axis = 0)
-						self.patches[-1]["vertex"] = tri if (self.patches[-1]["vertex"] is None) else np.concatenate((self.patches[-1]["vertex"], tri), axis = 0)
-
-						unknown = file.read(2); filesize -= 2
+			self.readBinary(filename)
+
+		self.triangles = np.concatenate([patch["vertex"] for patch in self.patches], axis = 0) if (len(self.patches) > 0) else np.zeros((0, 3, 3))
+		self.bvh = BVH(self.triangles)
+
+	"""
+	process : ascii形式のSTLファイルを読み込み、Patchを追加
+	input : filename -> <str> ファイル名
+	Note :
+	-- ASCII_CHUNK byte毎に行単位で読み込み、各チャンクのfacet normal, vertexの数値を正規表現で一括して抽出する
+	-- チャンク毎の配列をPatch毎に溜め、最後に1回だけ結合する (三角形数に対して線形時間)
+	-- solid行毎に新しいPatchを追加する
+	"""
+	def readAscii(self, filename):
+		normals = []; vertices = [] #<list of list of np array> Patch毎のチャンク毎の配列
+
+		with open(filename, "rb") as file:
+			rest = b"" #<bytes> 前のチャンクの最後の行の途中
+			while True:
+				chunk = file.read(ASCII_CHUNK)
+				if chunk == b"":
+					text = rest
+				else:
+					end = chunk.rfind(b"\n")+1
+					if end == 0:
+						rest += chunk; continue
+					text = rest+chunk[:end]; rest = chunk[end:]
+
+				if self.delimiter.strip() != "":
+					text = text.replace(self.delimiter.encode(), b" ")
+
+				#####solid行で区切り、区切った各部分は直前のPatchに追加
+				solids = [m for m in ASCII_SOLID.finditer(text) if text[max(m.start()-3, 0):m.start()] != b"end"]
+				starts = [0]+[m.start() for m in solids]; ends = [m.start() for m in solids]+[len(text)]
+				for n, (start, end) in enumerate(zip(starts, ends)):
+					if n > 0:
+						name = solids[n-1].group(1).split()
+						self.patches.append({"name" : name[-1].decode() if (len(name) > 0) else "solid", "facet_normal" : None, "vertex" : None})
+						normals.append([]); vertices.append([])
+
+					normal = ASCII_FACET.findall(text, start, end); vertex = ASCII_VERTEX.findall(text, start, end)
+					if (len(normal) == 0) and (len(vertex) == 0):
+						continue
+					if len(self.patches) == 0:
+						print("Error@piRichards.geometry.stl.STL.readAscii")
+						print("file <" + str(filename) + "> has facets before solid.")
+						sys.exit()
+					normals[-1].append(np.array(normal).astype(float).reshape((-1, 3)))
+					vertices[-1].append(np.array(vertex).astype(float).reshape((-1, 3)))
+
+				if chunk == b"":
+					break
+
+		#####vertexのshapeを(Nt, 3, 3)に修正
+		for patch, normal, vertex in zip(self.patches, normals, vertices):
+			patch["facet_normal"] = np.concatenate(normal, axis = 0) if (len(normal) > 0) else np.zeros((0, 3))
+			vertex = np.concatenate(vertex, axis = 0) if (len(vertex) > 0) else np.zeros((0, 3))
+			if len(vertex) != 3*len(patch["facet_normal"]):
+				print("Error@piRichards.geometry.stl.STL.readAscii")
+				print("patch <" + patch["name"] + "> does not have 3 vertices per facet.")
+				sys.exit()
+			patch["vertex"] = vertex.reshape((-1, 3, 3))
+
+	"""
+	process : binary形式のSTLファイルを読み込み、Patchを追加
+	input : filename -> <str> ファイル名
+	Note :
+	-- ファイル全体を1回で読み込み、各Patchの三角形をBINARY_RECORD (50 byte)のdtypeで一括して解釈する
+	-- 1ファイルに複数のPatch(ヘッダ80 byte + 三角形数4 byte + 三角形データ)が続く場合にも対応
+	"""
+	def readBinary(self, filename):
+		with open(filename, "rb") as file:
+			buffer = file.read()
+
+		offset = 0 #<int> 読み込み位置
+		while offset < len(buffer):
+			if len(buffer)-offset < 84:
+				print("Error@piRichards.geometry.stl.STL.readBinary")
+				print("file <" + str(filename) + "> is truncated.")
+				sys.exit()
+
+			name = buffer[offset:offset+80].decode(errors = "replace")
+			tri_num = int(np.frombuffer(buffer, dtype = "<u4", count = 1, offset = offset+80)[0]) #<int> Patchの三角形の数
+			offset += 84
+			if len(buffer)-offset < tri_num*BINARY_RECORD.itemsize:
+				print("Error@piRichards.geometry.stl.STL.readBinary")
+				print("file <" + str(filename) + "> is truncated.")
+				sys.exit()
+
+			records = np.frombuffer(buffer, dtype = BINARY_RECORD, count = tri_num, offset = offset)
+			offset += tri_num*BINARY_RECORD.itemsize
+			self.patches.append({"name" : name, "facet_normal" : records["normal"].astype(float), "vertex" : records["vertex"].astype(float)})
 
 	"""
 	process : 領域サイズを抽出
 	output : <list of tuple>
 	"""
 	def getSize(self):
-		points = np.concatenate([patch["vertex"].reshape((-1, 3)) for patch in self.patches], axis = 0)
-		x = points[:,0]; y = points[:,1]; z = points[:,2]
+		lo = self.bvh.lo[1]; hi = self.bvh.hi[1] #<np array> BVHの根ノードの箱
+
+		return [(lo[0], hi[0]), (lo[1], hi[1]), (lo[2], hi[2])]
+
+	"""
+	process : 参照点に対する一般化巻き数 (各三角形の立体角の和/4π)
+	input :
+		X -> <ndarray> (P, 3)なshape。参照点
+		chunk -> <int> 一度に計算する点と三角形の組の数 (メモリ使用量の上限)
+	output : <ndarray> (P, )なshape。オブジェクト内側で1、外側で0
+	Note : 点と三角形の組をchunk個ずつまとめて配列演算で計算する
+	"""
+	def windingNumber(self, X, chunk = WINDING_CHUNK):
+		X = np.asarray(X, dtype = float).reshape((-1, 3))
+		T = max(len(self.triangles), 1)
+		n_point = max(chunk//T, 1); n_tri = min(T, chunk) #<int> 一度に計算する点、三角形の数
+
+		winding_number = np.zeros(len(X))
+		for p in range(0, len(X), n_point):
+			for t in range(0, len(self.triangles), n_tri):
+				winding_number[p:p+n_point] += np.sum(solidAngle(self.triangles[np.newaxis, t:t+n_tri]-X[p:p+n_point, np.newaxis, np.newaxis, :]), axis = 1)
 
-		return [(np.min(x), np.max(x)), (np.min(y), np.max(y)), (np.min(z), np.max(z))]
+		return winding_number/(4.*np.pi)
 
 	"""
 	process : Xがオブジェクト内側にあるかどうか判定
 	input : 
-		X -> <ndarray> 参照点
-	output : <bool>
+		X -> <ndarray> 参照点。(3, )なshape、または複数点の(P, 3)なshape
+		chunk -> <int> 一度に計算する点と三角形の組の数
+	output : <bool> (Xが(P, 3)なshapeの場合は(P, )なshapeの<ndarray:bool>)
+	Note : 一般化巻き数が0.5以上の点を内側とする (閉じていないメッシュ、丸め誤差に対して頑健)
 	"""
-	def isIn(self, X):
-		triangles = np.concatenate([patch["vertex"] for patch in self.patches], axis = 0) - X
-		norm = np.sqrt(np.sum(triangles ** 2, axis = 2))
-		
-		winding_number = 0.
-		for (A, B, C), (a, b, c) in zip(triangles, norm):
-			winding_number += np.arctan2(np.linalg.det(np.array([A, B, C])), (a * b * c) + c * np.dot(A, B) + a * np.dot(B, C) + b * np.dot(C, A))
-
-		return winding_number >= (2.*np.pi - 1e-10)
\ No newline at end of file
+	def isIn(self, X, chunk = WINDING_CHUNK):
+		inside = self.windingNumber(X, chunk) >= 0.5
+		return inside if (np.ndim(X) > 1) else bool(inside[0])
+
+	"""
+	process : z方向の光線と三角形の交点の偶奇により格子点の内外を判定
+	input :
+		x, y, z -> <ndarray> 昇順の格子点の座標
+		chunk -> <int> 一度に計算する列と三角形の組の数 (メモリ使用量の上限)
+	output : <ndarray:bool> (len(x), len(y), len(z))なshape。if True -> オブジェクト内側
+	Note :
+	-- 各三角形をxy面のバウンディングボックスが覆う列(x, y)に割り当て、列毎の光線との交点のzを求める
+	-- 交点より上の格子点の交点数を累積し、奇数の格子点を内側とする
+	-- 三角形の辺・頂点上を通る光線はtop-left規則で一方の三角形のみと交わるとし、二重に数えない
+	-- 閉じていないメッシュでは列全体が誤判定となりうるため、windingNumber(isIn)を用いる
+	"""
+	def scanline(self, x, y, z, chunk = WINDING_CHUNK):
+		x = np.asarray(x, dtype = float); y = np.asarray(y, dtype = float); z = np.asarray(z, dtype = float)
+		P = self.triangles[:, :, :2]; Z = self.triangles[:, :, 2]
+
+		#####xy面で面積を持つ三角形のみ。各三角形が覆う列の番号の範囲
+		area = (P[:, 1, 0]-P[:, 0, 0])*(P[:, 2, 1]-P[:, 0, 1])-(P[:, 1, 1]-P[:, 0, 1])*(P[:, 2, 0]-P[:, 0, 0])
+		tris = np.nonzero(area != 0.)[0]
+		ix0 = np.searchsorted(x, np.min(P[tris, :, 0], axis = 1), side = "left"); ix1 = np.searchsorted(x, np.max(P[tris, :, 0], axis = 1), side = "right")
+		iy0 = np.searchsorted(y, np.min(P[tris, :, 1], axis = 1), side = "left"); iy1 = np.searchsorted(y, np.max(P[tris, :, 1], axis = 1), side = "right")
+		nx = np.maximum(ix1-ix0, 0); ny = np.maximum(iy1-iy0, 0)
+		counts = nx*ny #<np array> 各三角形と組になる列の数
+
+		#####交点の数を各格子点の直上に加算し、z方向に累積
+		crossing = np.zeros((len(x), len(y), len(z)+1), dtype = np.int64)
+		cum = np.cumsum(counts)
+		blocks = np.concatenate(([0], np.searchsorted(cum, np.arange(chunk, cum[-1], chunk), side = "right"), [len(tris)])) if (len(tris) > 0) else [0]
+		for start, end in zip(blocks[:-1], blocks[1:]):
+			c = counts[start:end]
+			if np.sum(c) == 0:
+				continue
+			tri = np.repeat(np.arange(start, end), c) #<np array> 組の三角形 (trisの番号)
+			local = np.arange(len(tri))-np.repeat(np.cumsum(c)-c, c)
+			ix = ix0[tri]+local//ny[tri]; iy = iy0[tri]+local%ny[tri]
+
+			#####辺関数 e_i = (p_{i+1}-p_i)x(q-p_i)。三角形の向きをそろえ、0の場合はtop-left規則
+			p = P[tris[tri]]; qx = x[ix]; qy = y[iy]
+			sign = np.sign(area[tris[tri]])
+			inside = np.ones(len(tri), dtype = bool); e = []
+			for i in range(3):
+				d = (p[:, (i+1)%3]-p[:, i])*sign[:, np.newaxis]
+				ei = (p[:, (i+1)%3, 0]-p[:, i, 0])*(qy-p[:, i, 1])-(p[:, (i+1)%3, 1]-p[:, i, 1])*(qx-p[:, i, 0])
+				top_left = (d[:, 1] < 0.)+((d[:, 1] == 0.)*(d[:, 0] > 0.))
+				inside *= (ei*sign > 0.)+((ei == 0.)*top_left)
+				e.append(ei)
+
+			#####交点のz (重心座標による補間)
+			zt = Z[tris[tri]]
+			zc = (e[0]*zt[:, 2]+e[1]*zt[:, 0]+e[2]*zt[:, 1])/area[tris[tri]]
+			k = np.searchsorted(z, zc[inside], side = "right")
+			np.add.at(crossing, (ix[inside], iy[inside], k), 1)
+
+		return (np.cumsum(crossing[:, :, :-1], axis = 2)%2).astype(bool)
+
@@ -1,6 +1,7 @@
 import numpy as np
 import copy
 import sys
+from piRichards.solver.stencil import SLICES
 
 """
 class : Richards式を解くためのクラス
@@ -57,13 +58,52 @@ class field:
 		self.p = None if (p is None) else np.where(self.voxel, p, np.nan)
 
 
+	"""
+	process : マトリックポテンシャル (share()で作成した複製間では書き込み時にコピー)
+	Note :
+	-- 共有中のhの読み出しはコピーせず、書き込み不可のviewを返す。in-placeに書き換える場合は先にownを呼ぶ (呼ばずに書き込むとValueError)
+	-- 代入(field.h = ...)は共有を解除する。get*は共有したまま読み出す
+	"""
+	@property
+	def h(self):
+		if getattr(self, "_h_shared", False):
+			h = self._h.view(); h.setflags(write = False)
+			return h
+		return self._h
+
+	@h.setter
+	def h(self, h):
+		self._h = h; self._h_shared = False
+
+	"""
+	process : hをin-placeに書き換える前に呼ぶ。share()で作成した複製間で共有している場合はコピーする
+	output : <np array> 書き込み可能なh
+	Note : ソルバ(piRichards.solver.linalg.solveStencil)は反復の前に呼ぶ
+	"""
+	def own(self):
+		if getattr(self, "_h_shared", False):
+			self._h = self._h.copy(); self._h_shared = False
+		return self._h
+
+	"""
+	process : 物理場の配列を共有した複製を作成 (copy on write)
+	output : <field class> (selfと同じクラス)
+	Note :
+	-- voxel, topNode, bottomNode, size, cells及びパラメータの物理場(k, theta_s, ...)は複製間で共有する。これらは作成後に変更しないこと
+	-- hは複製元、複製ともに最初に書き込む時点(own or 代入)でコピーする。それまでfield.hは書き込み不可のview
+	"""
+	def share(self):
+		new = copy.copy(self)
+		self._h_shared = True; new._h_shared = True
+		return new
+
 	"""
 	process : fieldクラスのコピーを作成
 	output : <field class>
 	"""
 	def copy(self):
 		voxel = copy.deepcopy(self.voxel); topNode = copy.deepcopy(self.topNode); bottomNode = copy.deepcopy(self.bottomNode)
-		size = copy.deepcopy(self.size); h = copy.deepcopy(self.h); k = copy.deepcopy(self.k)
+		size = copy.deepcopy(self.size); h = copy.deepcopy(self._h); k = copy.deepcopy(self.k)
 		theta_s = copy.deepcopy(self.theta_s); theta_r = copy.deepcopy(self.theta_r); alpha = copy.deepcopy(self.alpha)
 		n = copy.deepcopy(self.n); m = copy.deepcopy(self.m); l = copy.deepcopy(self.l); B = copy.deepcopy(self.B)
 		a = None if (self.a0 is None) else copy.deepcopy(np.stack((self.a0, self.a1, self.a2, self.a3), axis = -1))
@@ -71,19 +111,22 @@ class field:
 		return type(self)(voxel, topNode, bottomNode, size, h, k, theta_s, theta_r, alpha, n, m, l, B, a)
 
 	def getH(self, ghost = np.nan):
-		return np.where(self.voxel, self.h, ghost)
+		return np.where(self.voxel, self._h, ghost)
 
 	def getSe(self, ghost = np.nan):
-		return np.where(self.voxel, vanGenuchten_Se(self.h, self.alpha, self.n, self.m), ghost)
+		return np.where(self.voxel, vanGenuchten_Se(self._h, self.alpha, self.n, self.m), ghost)
 	
 	def getK(self, ghost = np.nan):
-		return np.where(self.voxel, vanGenuchten_K(self.h, self.k, self.alpha, self.n, self.m, self.l), ghost)
+		return np.where(self.voxel, vanGenuchten_K(self._h, self.k, self.alpha, self.n, self.m, self.l), ghost)
 	
+	def getdK(self, ghost = np.nan):
+		return np.where(self.voxel, vanGenuchten_dK(self._h, self.k, self.alpha, self.n, self.m, self.l), ghost)
+
 	def getCw(self, ghost = np.nan):
-		return np.where(self.voxel, vanGenuchten_Cw(self.alpha, self.n, self.theta_s, self.theta_r, self.h), ghost)
+		return np.where(self.voxel, vanGenuchten_Cw(self.alpha, self.n, self.theta_s, self.theta_r, self._h), ghost)
 	
 	def getTheta(self, ghost = np.nan):
-		return np.where(self.voxel, vanGenuchten_Theta(self.h, self.alpha, self.n, self.m, self.theta_s, self.theta_r), ghost)
+		return np.where(self.voxel, vanGenuchten_Theta(self._h, self.alpha, self.n, self.m, self.theta_s, self.theta_r), ghost)
 	
 	"""
 	/*******************/
@@ -96,13 +139,232 @@ class field:
 			return np.where(self.voxel, 0., ghost)
 		else:
 			if self.a0 is None:
-				F = np.where(self.voxel, S_Shaped(self.h, self.h50, self.p), ghost)
+				F = np.where(self.voxel, S_Shaped(self._h, self.h50, self.p), ghost)
 			else:
-				F = np.where(self.voxel, Feddes(self.h, self.a0, self.a1, self.a2, self.a3), ghost)
+				F = np.where(self.voxel, Feddes(self._h, self.a0, self.a1, self.a2, self.a3), ghost)
 			
 			Tp = np.stack([Tp]*self.shape[2], axis = -1)
 			return -F*Tp*self.B
 
+	"""
+	process : 活性セルのみを1次元配列で保持するactiveFieldを作成
+	output : <activeField class>
+	"""
+	def compact(self):
+		a = None if (self.a0 is None) else np.stack((self.a0, self.a1, self.a2, self.a3), axis = -1)
+		return activeField(self.voxel, self.topNode, self.bottomNode, self.size, self._h, self.k, self.theta_s, self.theta_r, self.alpha, self.n, self.m, self.l, self.B, a, self.h50, self.p)
+
+	"""
+	process : 物理場の配列を(Nx, Ny, Nz)なshapeで取得
+	input : X -> <np array> fieldと同じレイアウトの配列, ghost -> voidセルの値
+	"""
+	def toDense(self, X, ghost = np.nan):
+		return np.where(self.voxel, X, ghost)
+
+	"""
+	process : 物理場の配列の活性セルの値を1次元配列で取得
+	input : X -> <np array> fieldと同じレイアウトの配列
+	"""
+	def toActive(self, X):
+		return X[self.voxel]
+
+"""
+class : 活性セル(voxel == True)の番号付けと隣接セルの番号表
+att :
+	voxel -> <np array> (Nx, Ny, Nz)なshape
+	shape -> <tuple> 格子数
+	N -> <int> 活性セル数
+	index -> <np array> (N, )なshape。活性セルのflat index (C order)
+	coords -> <tuple of np array> 活性セルの(i, j, k)
+	order -> <np array> (Nx, Ny, Nz)なshape。活性セル番号。voidセルは-1
+	top, bottom -> <np array> 上面セル、底面セルの活性セル番号
+	topGhost, bottomGhost -> <np array> 上面セルの上、底面セルの下のゴーストセル番号
+	neighbor -> <np array> (6, N)なshape。各方向(DIRECTIONS)の隣接セル番号
+	mask -> <np array> (N, )なshape。全てTrue
+Note :
+-- ゴーストセル付き配列(pad)は(N+1+T+B, )なshape。番号Nはvoidセル及び計算領域外、N+1以降は上面、底面のDirichlet境界のゴーストセル
+-- ゴーストセルの位置は(Nx, Ny, Nz)な配列のゴーストセル(extend)と同じであり、密な配列と同じ係数が得られる
+"""
+class Cells:
+	def __init__(self, voxel, topNode, bottomNode):
+		self.voxel = voxel
+		self.shape = voxel.shape
+		self.index = np.flatnonzero(voxel)
+		self.N = len(self.index)
+		self.coords = np.unravel_index(self.index, self.shape)
+		self.mask = np.ones(self.N, dtype = bool)
+
+		T = len(topNode[0]); B = len(bottomNode[0])
+		self.size_pad = self.N+1+T+B
+		itype = np.int32 if (self.size_pad < 2**31) else np.int64 #<dtype> 番号表の型
+
+		self.order = np.full(self.shape, -1, dtype = itype); self.order[voxel] = np.arange(self.N)
+		self.top = self.order[topNode[0], topNode[1], topNode[2]]
+		self.bottom = self.order[bottomNode[0], bottomNode[1], bottomNode[2]]
+		self.topGhost = np.arange(self.N+1, self.N+1+T, dtype = itype)
+		self.bottomGhost = np.arange(self.N+1+T, self.size_pad, dtype = itype)
+
+		#####隣接セル番号表
+		order_pad = np.full(tuple(n+2 for n in self.shape), self.N, dtype = itype)
+		order_pad[1:-1, 1:-1, 1:-1] = np.where(voxel, self.order, self.N)
+		order_pad[np.array(topNode[0])+1, np.array(topNode[1])+1, np.array(topNode[2])] = self.topGhost
+		order_pad[np.array(bottomNode[0])+1, np.array(bottomNode[1])+1, np.array(bottomNode[2])] = self.bottomGhost
+		self.neighbor = np.stack([order_pad[SLICES[d]][voxel] for d in range(6)])
+
+	"""
+	process : 活性セルの配列にゴーストセルを追加
+	input : X -> <np array> (N, )なshape, ghost -> ゴーストセルの値
+	output : <np array> (N+1+T+B, )なshape
+	"""
+	def pad(self, X, ghost = np.nan):
+		X_pad = np.full(self.size_pad, ghost, dtype = np.result_type(X, ghost))
+		X_pad[:self.N] = X
+		return X_pad
+
+	"""
+	process : 各方向の隣接セルの値を取得
+	input : X -> <np array> (N, )なshape, ghost -> voidセル及びゴーストセルの値
+	output : <list of np array> DIRECTIONSの順
+	"""
+	def neighbors(self, X, ghost = np.nan):
+		X_pad = self.pad(X, ghost)
+		return [X_pad[self.neighbor[d]] for d in range(6)]
+
+	"""
+	process : スカラー、(Nx, Ny, Nz, ...)もしくは(N, ...)なshapeの配列を(N, ...)なshapeに変換
+	"""
+	def toActive(self, X):
+		if np.ndim(X) == 0:
+			return np.full(self.N, X, dtype = float)
+
+		X = np.asarray(X)
+		return X[self.voxel] if (X.shape[:3] == self.shape) else X
+
+	"""
+	process : (N, ...)なshapeの配列を(Nx, Ny, Nz, ...)なshapeに変換
+	input : X -> <np array>, ghost -> voidセルの値
+	"""
+	def toDense(self, X, ghost = np.nan):
+		X_dense = np.full(self.shape + np.shape(X)[1:], ghost, dtype = np.result_type(X, ghost))
+		X_dense[self.voxel] = X
+		return X_dense
+
+
+"""
+class : 活性セルのみを1次元配列で保持するfield
+att :
+	cells -> <Cells class> 活性セルの番号付け
+	h, k, theta_s, ... -> <np array> (N, )なshape。fieldと同じ物理場の活性セルの値
+	その他はfieldと同じ
+Note :
+-- voidセルの多い計算領域(STL由来の形状等)で、メモリとステンシル計算量を活性セル数に比例させる
+-- 物理場の入力は(Nx, Ny, Nz)なshape、(N, )なshape及びスカラーのいずれでもよい
+-- get*は(N, )なshapeの配列を返す。密な配列はtoDenseで必要な時だけ作成する
+-- cellsはcopyしたactiveField間で共有する
+"""
+class activeField(field):
+	def __init__(self, voxel, topNode, bottomNode, size, h, k, theta_s, theta_r, alpha, n, m = None, l = None, B = None, a = None, h50 = None, p = None, cells = None):
+		self.voxel = voxel
+		self.topNode = topNode
+		self.bottomNode = bottomNode
+		self.size = size
+		self.shape = voxel.shape
+		self.dead_flag = False
+		self.cells = Cells(voxel, topNode, bottomNode) if (cells is None) else cells
+		active = self.cells.toActive
+
+		self.h = active(h).astype(float)
+		self.k = active(k)
+		self.theta_s = active(theta_s)
+		self.theta_r = active(theta_r)
+		self.alpha = active(alpha)
+		self.n = active(n)
+		self.m = 1.-1./self.n if (m is None) else active(m)
+		self.l = np.full(self.cells.N, 0.5) if (l is None) else active(l)
+		self.B = None if (B is None) else active(B)
+
+		if a is None:
+			self.a0 = None; self.a1 = None; self.a2 = None; self.a3 = None
+		else:
+			a = active(a)
+			self.a0 = a[:,0]; self.a1 = a[:,1]; self.a2 = a[:,2]; self.a3 = a[:,3]
+
+		self.h50 = None if (h50 is None) else active(h50)
+		self.p = None if (p is None) else active(p)
+
+	"""
+	process : activeFieldクラスのコピーを作成
+	output : <activeField class>
+	"""
+	def copy(self):
+		a = None if (self.a0 is None) else np.stack((self.a0, self.a1, self.a2, self.a3), axis = -1)
+		B = None if (self.B is None) else self.B.copy()
+		h50 = None if (self.h50 is None) else self.h50.copy()
+		p = None if (self.p is None) else self.p.copy()
+
+		return type(self)(self.voxel, self.topNode, self.bottomNode, self.size, self._h.copy(), self.k.copy(), self.theta_s.copy(), self.theta_r.copy(),
+			self.alpha.copy(), self.n.copy(), self.m.copy(), self.l.copy(), B, a, h50, p, self.cells)
+
+	"""
+	process : (Nx, Ny, Nz)なshapeの配列を持つfieldを作成
+	output : <field class>
+	"""
+	def expand(self):
+		dense = self.toDense
+		a = None if (self.a0 is None) else dense(np.stack((self.a0, self.a1, self.a2, self.a3), axis = -1))
+		B = None if (self.B is None) else dense(self.B)
+		h50 = None if (self.h50 is None) else dense(self.h50)
+		p = None if (self.p is None) else dense(self.p)
+		new = field(self.voxel, self.topNode, self.bottomNode, self.size, dense(self._h), dense(self.k), dense(self.theta_s), dense(self.theta_r),
+			dense(self.alpha), dense(self.n), dense(self.m), dense(self.l), B, a, h50, p)
+		new.dead_flag = self.dead_flag
+
+		return new
+
+	def compact(self):
+		return self
+
+	def toDense(self, X, ghost = np.nan):
+		return self.cells.toDense(X, ghost)
+
+	def toActive(self, X):
+		return self.cells.toActive(X)
+
+	def getH(self, ghost = np.nan):
+		return self._h.copy()
+
+	def getSe(self, ghost = np.nan):
+		return vanGenuchten_Se(self._h, self.alpha, self.n, self.m)
+
+	def getK(self, ghost = np.nan):
+		return vanGenuchten_K(self._h, self.k, self.alpha, self.n, self.m, self.l)
+
+	def getdK(self, ghost = np.nan):
+		return vanGenuchten_dK(self._h, self.k, self.alpha, self.n, self.m, self.l)
+
+	def getCw(self, ghost = np.nan):
+		return vanGenuchten_Cw(self.alpha, self.n, self.theta_s, self.theta_r, self._h)
+
+	def getTheta(self, ghost = np.nan):
+		return vanGenuchten_Theta(self._h, self.alpha, self.n, self.m, self.theta_s, self.theta_r)
+
+	"""
+	process : ソース項の計算
+	input : Tp -> <np:float:(Nx, Ny)> 蒸散分布 [m/s]
+	"""
+	def getS(self, Tp = None, ghost = np.nan):
+		if Tp is None:
+			return np.zeros(self.cells.N)
+		else:
+			if self.a0 is None:
+				F = S_Shaped(self._h, self.h50, self.p)
+			else:
+				F = Feddes(self._h, self.a0, self.a1, self.a2, self.a3)
+
+			Tp = np.asarray(Tp)[self.cells.coords[0], self.cells.coords[1]]
+			return -F*Tp*self.B
+
+
 """
 process : van Genuchtenモデルに従い、実飽和率[-]を計算。
 input : h, alpha, n, m
@@ -139,6 +401,25 @@ def vanGenuchten_K(h, k, alpha, n, m, l):
 	
 	return k*(Se**l)*(1.-(1.-Se**(1./m))**m)**2
 
+"""
+process : van Genuchtenモデルに従い、透過率のマトリックポテンシャル微分dK/dh[1/s]を計算。
+input : h, k, alpha, n, m, l
+	h -> <float> マトリックポテンシャル[m]。
+	k -> <float> 飽和透過率 [m/s]
+	alpha, n, m, l -> <float> van Genuchtenモデルのパラメータ。
+output : <float> dK/dh [1/s]。 h >= 0では0
+"""
+def vanGenuchten_dK(h, k, alpha, n, m, l):
+	with np.errstate(divide = "ignore", invalid = "ignore", over = "ignore"):
+		x = np.abs(alpha*h)**n
+		dSe = m*n*alpha*(np.abs(alpha*h)**(n-1.))*((1.+x)**(-m-1.)) #<float> dSe/dh (h < 0)
+		Se = (1.+x)**(-m)
+		u = Se**(1./m)
+		g = 1.-(1.-u)**m
+		dK = k*(Se**(l-1.))*g*(l*g+2.*u*((1.-u)**(m-1.)))*dSe
+
+	return np.where(h < 0., dK, 0.)
+
 """
 process : van Genuchtenモデルに従い、水分容量を計算。
 input : h, k, alpha, n, m, l
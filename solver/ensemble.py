@@ -0,0 +1,190 @@
+import numpy as np
+import sys
+import time
+from piRichards.solver import field
+from piRichards.solver.stencil import Stencil, createStencil
+from piRichards.solver.linalg import Stats
+
+#####アンサンブルの一括計算で利用できる解法。"jacobi" : ヤコビ法, "rbgs" : red-black Gauss-Seidel法, "sor" : red-black SOR法
+ENSEMBLE_METHODS = ("jacobi", "rbgs", "sor")
+
+
+"""
+class : 同じvoxel, topNode, bottomNodeを共有するM個のfieldをまとめたクラス
+att :
+	fieldと同じ。ただしh, k, ...の物理場は(M, Nx, Ny, Nz)なshape
+	M -> <int> メンバー数
+	dead_flag -> <np array> (M, )なshape。計算エラーとなったメンバーはTrue
+Note :
+-- van Genuchtenモデル等の計算は要素毎であるため、fieldのgetK, getCw, getTheta, getSをそのまま用いる
+-- 密な配列(field)のみ対応。activeFieldは対象外
+"""
+class ensembleField(field):
+	"""
+	input : fieldと同じ。h, k, ...は(M, Nx, Ny, Nz)なshape (aは(M, Nx, Ny, Nz, 4)なshape)
+	"""
+	def __init__(self, voxel, topNode, bottomNode, size, h, k, theta_s, theta_r, alpha, n, m = None, l = None, B = None, a = None, h50 = None, p = None):
+		field.__init__(self, voxel, topNode, bottomNode, size, h, k, theta_s, theta_r, alpha, n, m, l, B, None, h50, p)
+		self.M = len(self.h)
+		self.dead_flag = np.zeros(self.M, dtype = bool)
+
+		if a is not None:
+			self.a0 = np.where(self.voxel, a[...,0], np.nan); self.a1 = np.where(self.voxel, a[...,1], np.nan)
+			self.a2 = np.where(self.voxel, a[...,2], np.nan); self.a3 = np.where(self.voxel, a[...,3], np.nan)
+
+	def __len__(self):
+		return self.M
+
+	"""
+	process : 各メンバーの計算結果(h, dead_flag)をfieldに書き戻す
+	input : fields -> <list of field class> stackFieldsの入力と同じ順番
+	"""
+	def scatter(self, fields):
+		for i, f in enumerate(fields):
+			f.h = self.h[i].copy()
+			f.dead_flag = f.dead_flag or bool(self.dead_flag[i])
+
+	"""
+	process : メンバーiのStencilを取り出す
+	input : stencil -> <Stencil class> アンサンブルのStencil, i -> <int> メンバー番号
+	output : <Stencil class>
+	"""
+	def member(self, stencil, i):
+		b = np.broadcast_to(stencil.b, stencil.diag.shape)
+		return Stencil(self.voxel, stencil.a[:, i], stencil.diag[i], b[i])
+
+
+"""
+process : fieldのリストからensembleFieldを作成
+input : fields -> <list of field class> voxel, topNode, bottomNode, sizeが同じfield
+output : <ensembleField class>
+Note : 既にdead_flagがTrueのメンバーはensembleFieldでもdead_flagをTrueとする
+"""
+def stackFields(fields):
+	base = fields[0]
+	for f in fields[1:]:
+		if (not np.array_equal(f.voxel, base.voxel)) or (tuple(f.size) != tuple(base.size)) or (not np.array_equal(f.topNode, base.topNode)) or (not np.array_equal(f.bottomNode, base.bottomNode)):
+			print("Error@piRichards.solver.ensemble.stackFields")
+			print("all fields must share voxel, topNode, bottomNode and size.")
+			sys.exit()
+
+	def stack(name):
+		X = [getattr(f, name) for f in fields]
+		return None if (X[0] is None) else np.stack(X)
+
+	a = None if (base.a0 is None) else np.stack([np.stack((f.a0, f.a1, f.a2, f.a3), axis = -1) for f in fields])
+	ensemble = ensembleField(base.voxel, base.topNode, base.bottomNode, base.size, stack("h"), stack("k"), stack("theta_s"), stack("theta_r"), stack("alpha"), stack("n"),
+		stack("m"), stack("l"), stack("B"), a, stack("h50"), stack("p"))
+	ensemble.dead_flag[:] = [f.dead_flag for f in fields]
+
+	return ensemble
+
+
+"""
+process : 計算エラーとなったメンバーのdead_flagをTrueにする
+input : ensemble -> <ensembleField class>
+"""
+def checkDead(ensemble):
+	h = np.where(ensemble.voxel, ensemble.h, 0.)
+	axes = tuple(range(1, h.ndim))
+	dead = (~np.all(np.isfinite(h), axis = axes))+(np.min(h, axis = axes) < -1e+100)
+	ensemble.dead_flag[dead] = True
+
+
+"""
+process : アンサンブルのStencilの連立一次方程式を反復法で解く
+input :
+	ensemble -> <ensembleField class>
+	stencil -> <Stencil class> 係数が(6, M, Nx, Ny, Nz)なshape
+	iteration, lr, method, tol, check, stats, omega -> piRichards.solver.linalg.solveStencilと同じ
+Note :
+-- tolはdead_flagがFalseの全メンバーが満たした時点で反復を終了する。stats.residualはメンバー毎の相対残差ノルム
+-- 反復中に発散したメンバーも収束判定から除くため、残差の確認毎にcheckDeadでdead_flagを更新する
+-- red-black法はvoxelの色のマスクで各色の更新値をまとめて計算する (ヤコビ法の2倍の演算量)
+-- method == "sor"でomega is Noneの場合、最初の生存メンバーのStencilから推定したomegaを全メンバーに用いる
+"""
+def solveEnsemble(ensemble, stencil, iteration, lr, method, tol, check, stats, omega = None):
+	checkDead(ensemble)
+	if method == "jacobi":
+		h_next = np.empty_like(ensemble.h) #<np array> ヤコビ法の更新値の格納先。ensemble.hと交互に使う
+	else:
+		if method == "rbgs":
+			omega = 1.
+		elif omega is None:
+			omega = ensemble.member(stencil, int(np.argmax(~ensemble.dead_flag))).estimateOmega()
+		x, y, z = np.indices(ensemble.shape)
+		parity = ((x+y+z)%2 == 0)
+		colors = (parity, ~parity)
+
+	for itr in range(iteration):
+		if method == "jacobi":
+			stencil.jacobiSweep(ensemble.h, h_next, lr)
+			ensemble.h, h_next = h_next, ensemble.h
+		else:
+			for color in colors:
+				h_new = (1.-omega)*ensemble.h+omega*stencil.jacobi(ensemble.h)
+				np.copyto(ensemble.h, np.minimum(h_new, 0.), where = color)
+		stats.iterations += 1
+
+		if (tol is not None) and ((itr+1)%check == 0):
+			checkDead(ensemble)
+			stats.residual = stencil.residualNorm(ensemble.h)
+			stats.history.append((stats.iterations, stats.residual))
+			if np.all(stats.residual[~ensemble.dead_flag] < tol):
+				stats.converged = True
+				break
+
+	if not stats.converged:
+		stats.residual = stencil.residualNorm(ensemble.h)
+
+
+"""
+process : アンサンブルの一括計算 (非定常解析、dt is None -> 定常解析)
+input :
+	ensemble -> <ensembleField class>
+	dt -> <float> 時間刻み。if None -> 定常解析
+	q -> <ndarray> 地表面フラックス。(Nx, Ny)なshape (全メンバー共通) or (M, Nx, Ny)なshape
+	top, bottom -> piRichards.solver.linalg.run_Unsteadyと同じ
+	Tp -> <np array> 蒸散量。(Nx, Ny)なshape (全メンバー共通) or (M, Nx, Ny)なshape
+	iteration, lr, tol, check, omega -> piRichards.solver.linalg.run_Unsteadyと同じ
+	method -> <str> "jacobi", "rbgs" or "sor"
+	nl_iteration -> <int> Picard法の非線形反復の最大回数
+	nl_tol -> <float> 非線形反復の収束判定値。dead_flagがFalseの全メンバーでmax|h_next-h| < nl_tol [m]
+output : <Stats class> ensembleのattが更新。residual, incrementはメンバー毎の値 ((M, )なshape)
+Note :
+-- M個のfieldを(M, Nx, Ny, Nz)なshapeの配列として1回のベクトル化した計算で更新する。各メンバーの結果はrun_Unsteady (run_Steady)をメンバー毎に呼んだ場合と一致する
+-- 発散したメンバーはdead_flagがTrueになる。メンバー間の計算は独立であるため、他のメンバーの計算には影響しない
+"""
+def run_Ensemble(ensemble, dt = None, q = None, top = "flux", bottom = "free", Tp = None, iteration = 20, lr = 0.9, method = "jacobi", tol = None, check = 10, nl_iteration = 1, nl_tol = 1e-5, omega = None):
+	if method not in ENSEMBLE_METHODS:
+		print("Error@piRichards.solver.ensemble.run_Ensemble")
+		print("method <" + str(method) + "> is not supported.")
+		sys.exit()
+
+	stats = Stats(method); start = time.perf_counter()
+
+	try:
+		with np.errstate(all = "ignore"):
+			theta_before = None if (dt is None) else ensemble.getTheta() #現時刻の体積含水率
+			for nl_itr in range(nl_iteration):
+				h_old = ensemble.h.copy() #<np array> 非線形反復の現在値
+				stencil = createStencil(ensemble, q, top, bottom, Tp, dt, h_old) #<Stencil> 現在値で線形化
+				if dt is not None:
+					stencil.b -= (ensemble.getTheta()-theta_before)/dt
+
+				solveEnsemble(ensemble, stencil, iteration, lr, method, tol, check, stats, omega)
+				checkDead(ensemble)
+				stats.nl_iterations += 1
+				stats.increment = np.nanmax(np.abs(np.where(ensemble.voxel, ensemble.h-h_old, np.nan)), axis = (1, 2, 3))
+				if np.all(stats.increment[~ensemble.dead_flag] < nl_tol):
+					stats.nl_converged = True
+					break
+
+	except:
+		ensemble.dead_flag[:] = True
+
+	checkDead(ensemble)
+	stats.time = time.perf_counter()-start
+	stats.time_per_iteration = stats.time/max(stats.iterations, 1)
+
+	return stats
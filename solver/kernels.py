@@ -0,0 +1,237 @@
+import numpy as np
+import sys
+from piRichards.solver.stencil import padK, boundaryIndex, kernelIndex, layoutStencil
+
+try:
+	import numba
+except ImportError:
+	numba = None #numbaが無い場合、backend == "numba"はnumpyで計算
+
+#####計算バックエンド。"numpy" : ベクトル化したnumpy, "numba" : numbaでコンパイルしたfused kernel (セル毎の並列ループ)
+BACKENDS = ("numpy", "numba")
+
+
+"""
+process : 計算バックエンドの指定を確認
+input : backend -> <str> "numpy" or "numba"
+output : <str> 実際に用いるバックエンド。numbaが無い場合は"numpy"
+"""
+def checkBackend(backend = "numpy"):
+	if backend not in BACKENDS:
+		print("Error@piRichards.solver.kernels.checkBackend")
+		print("backend <" + str(backend) + "> is not supported.")
+		sys.exit()
+
+	return "numpy" if (numba is None) else backend
+
+
+if numba is not None:
+	"""
+	process : 係数の作成 (界面透過率の平均、各面の係数、重力項及び境界フラックス、時間項)を1回のセル毎ループで計算
+	input :
+		K_pad -> <np array> ゴーストセル付きの透過率 (flat)
+		index, index_pad, nb -> kernelIndexの出力
+		spacing -> <np array> DIRECTIONS順の格子幅
+		dz -> <float> z方向の格子幅
+		S, Cw, h_before -> <np array> fieldと同じレイアウト (flat)
+		dt -> <float> 時間刻み。0 -> 定常解析 (Cw, h_beforeは参照しない)
+		q_top -> <np array> (N, )なshape。上面のフラックス境界のセルのみq、それ以外はnp.nan
+		is_bottom -> <np array> (N, )なshape。底面セルのときTrue
+		a, diag, b -> <np array> 出力先。fieldと同じレイアウト (aは(6, -1)、それ以外はflat)
+	Note : createStencilと同じ演算順序で計算する
+	"""
+	@numba.njit(parallel = True, cache = True)
+	def fusedStencil(K_pad, index, index_pad, nb, spacing, dz, S, Cw, h_before, dt, q_top, is_bottom, a, diag, b):
+		for i in numba.prange(len(index)):
+			o = index[i]
+			K = K_pad[index_pad[i]]
+			s = 0.
+			for d in range(6):
+				a_d = (K_pad[nb[d, i]]+K)/2./(spacing[d]**2)
+				if np.isnan(a_d):
+					a_d = 0.
+				a[d, o] = a_d
+				s += a_d
+
+			b_up = (K_pad[nb[4, i]]+K)/2./dz
+			if np.isnan(b_up):
+				b_up = 0.
+			if not np.isnan(q_top[i]):
+				b_up = q_top[i]/dz
+
+			b_down = -(K_pad[nb[5, i]]+K)/2./dz
+			if np.isnan(b_down):
+				b_down = 0.
+			if is_bottom[i]:
+				b_down = -K/dz
+
+			if dt > 0.:
+				c = Cw[o]/dt
+				diag[o] = c+s
+				b[o] = c*h_before[o]+(S[o]+b_up+b_down)
+			else:
+				diag[o] = s
+				b[o] = S[o]+b_up+b_down
+
+	"""
+	process : 緩和付きヤコビ法をsweeps回更新 (隣接セルの寄与、緩和、クリップを1回のセル毎ループで計算)
+	input :
+		h_pad, work_pad -> <np array> ゴーストセル付きのh (flat)。ゴーストセル及びvoidセルは0
+		index_pad, nb -> kernelIndexの出力
+		a, diag, b -> <np array> (6, N), (N, ), (N, )なshapeの活性セルの係数
+		lr -> <float> 緩和係数
+		clip -> <bool> True -> h > 0を0にする
+		sweeps -> <int> スイープ数
+	output : <np array> 最新のhを格納したh_padもしくはwork_pad
+	"""
+	@numba.njit(parallel = True, cache = True)
+	def fusedJacobi(h_pad, work_pad, index_pad, nb, a, diag, b, lr, clip, sweeps):
+		for sweep in range(sweeps):
+			for i in numba.prange(len(index_pad)):
+				s = 0.
+				for d in range(6):
+					s += a[d, i]*h_pad[nb[d, i]]
+
+				h_new = (1.-lr)*h_pad[index_pad[i]]+lr*((s+b[i])/diag[i])
+				if clip and (h_new > 0.):
+					h_new = 0.
+				work_pad[index_pad[i]] = h_new
+
+			h_pad, work_pad = work_pad, h_pad
+
+		return h_pad
+
+	"""
+	process : red-black順序のGauss-Seidel法(SOR法)をsweeps回更新
+	input :
+		h_pad -> <np array> ゴーストセル付きのh (flat)。直接更新される
+		colors -> <tuple of np array> 各色の活性セル番号 (0, ..., N-1)。この順に更新する
+		index_pad, nb, a, diag, b -> fusedJacobiと同じ
+		omega -> <float> 緩和係数
+		clip -> <bool> True -> h > 0を0にする
+		sweeps -> <int> スイープ数
+	"""
+	@numba.njit(parallel = True, cache = True)
+	def fusedRedblack(h_pad, colors, index_pad, nb, a, diag, b, omega, clip, sweeps):
+		for sweep in range(sweeps):
+			for color in colors:
+				for c in numba.prange(len(color)):
+					i = color[c]
+					s = b[i]
+					for d in range(6):
+						s += a[d, i]*h_pad[nb[d, i]]
+
+					h_new = (1.-omega)*h_pad[index_pad[i]]+omega*s/diag[i]
+					if clip and (h_new > 0.):
+						h_new = 0.
+					h_pad[index_pad[i]] = h_new
+
+
+"""
+process : fused kernelによりfieldからStencilを作成
+input : createStencilと同じ
+output : <Stencil class> activeFieldの場合は<ActiveStencil class>
+Note : numbaが無い場合はcreateStencil(backend = "numpy")と同じ
+"""
+def createStencil(field, q = None, top = "flux", bottom = "free", Tp = None, dt = None, h_before = None):
+	if numba is None:
+		from piRichards.solver.stencil import createStencil as createStencil_numpy
+		return createStencil_numpy(field, q, top, bottom, Tp, dt, h_before)
+
+	dx, dy, dz = field.size #計算格子サイズ
+	spacing = np.array([dx, dx, dy, dy, dz, dz], dtype = float)
+	layout = field.cells if hasattr(field, "cells") else field.voxel
+	index, index_pad, nb, size_pad = kernelIndex(layout)
+
+	S = field.getS(Tp); K, K_pad = padK(field, top, bottom)
+
+	#####境界セル
+	q_top = np.full(K.shape, np.nan)
+	if top == "flux":
+		q_top[boundaryIndex(field, "top")[0]] = q[field.topNode[0], field.topNode[1]]
+
+	is_bottom = np.zeros(K.shape, dtype = bool); is_bottom[boundaryIndex(field, "bottom")[0]] = True
+
+	a = np.zeros((6,)+K.shape)
+	diag = np.full(K.shape, np.nan); b = np.full(K.shape, np.nan)
+
+	#####時間項
+	if dt is None:
+		Cw = S; h_before = S; dt = 0. #参照しない
+		diag[:] = 0. #voidセルの対角項はcreateStencilと同じく0
+	else:
+		Cw = field.getCw()
+		h_before = field.h if (h_before is None) else h_before
+
+	fusedStencil(K_pad.reshape(-1), index, index_pad, nb, spacing, dz, S.reshape(-1), np.ascontiguousarray(Cw).reshape(-1), np.ascontiguousarray(h_before).reshape(-1),
+		float(dt), q_top.reshape(-1)[index], is_bottom.reshape(-1)[index], a.reshape((6, -1)), diag.reshape(-1), b.reshape(-1))
+
+	return layoutStencil(field, a, diag, b)
+
+
+"""
+class : Stencilのfused kernelによる反復解法
+att :
+	stencil -> <Stencil class> or <ActiveStencil class>
+	index, index_pad, nb -> kernelIndexの出力
+	a, diag -> <np array> 活性セルの係数 ((6, N), (N, )なshape)
+	h_pad, work_pad -> <np array> ゴーストセル付きのhの作業配列
+	colors -> <tuple of np array> red-black順序の各色の活性セル番号
+Note :
+-- a, diagは作成時に取り出す。以降a, diagを変更しても反映されない (bは毎回参照する)
+-- numbaが必要 (checkBackendの出力が"numba"の場合のみ作成する)
+"""
+class Kernel:
+	def __init__(self, stencil):
+		self.stencil = stencil
+		layout = stencil.cells if hasattr(stencil, "cells") else stencil.voxel
+		self.index, self.index_pad, self.nb, size_pad = kernelIndex(layout)
+		self.a = np.ascontiguousarray(stencil.a.reshape((6, -1))[:, self.index])
+		self.diag = np.ascontiguousarray(stencil.diag.reshape(-1)[self.index])
+		self.h_pad = np.zeros(size_pad); self.work_pad = np.zeros(size_pad)
+
+		coords = stencil.cells.coords if hasattr(stencil, "cells") else np.unravel_index(self.index, stencil.shape)
+		parity = ((coords[0]+coords[1]+coords[2])%2 == 0)
+		self.colors = (np.flatnonzero(parity), np.flatnonzero(~parity))
+
+	"""
+	process : hの活性セルの値を作業配列に書き込み、活性セルのbを取り出す
+	"""
+	def load(self, h):
+		self.h_pad[self.index_pad] = h.reshape(-1)[self.index]
+		return np.ascontiguousarray(np.broadcast_to(self.stencil.b, self.stencil.shape).reshape(-1)[self.index])
+
+	"""
+	process : 作業配列の活性セルの値をhに書き戻す
+	"""
+	def store(self, h):
+		h.reshape(-1)[self.index] = self.h_pad[self.index_pad]
+		return h
+
+	"""
+	process : 緩和付きヤコビ法でsweeps回更新
+	input :
+		h -> <np array> stencilと同じレイアウトの現在値。直接更新される
+		lr -> <float> 緩和係数
+		clip -> <bool> True -> h > 0を0にする
+		sweeps -> <int> スイープ数
+	output : <np array> 更新後のh
+	"""
+	def jacobi(self, h, lr = 1., clip = True, sweeps = 1):
+		b = self.load(h)
+		fusedJacobi(self.h_pad, self.work_pad, self.index_pad, self.nb, self.a, self.diag, b, float(lr), clip, sweeps)
+		if sweeps%2 == 1:
+			self.h_pad, self.work_pad = self.work_pad, self.h_pad
+
+		return self.store(h)
+
+	"""
+	process : red-black順序のGauss-Seidel法(omega > 1 -> SOR法)でsweeps回更新
+	input : h, clip, sweeps -> jacobiと同じ, omega -> <float> 緩和係数
+	output : <np array> 更新後のh
+	"""
+	def redblack(self, h, omega = 1., clip = True, sweeps = 1):
+		b = self.load(h)
+		fusedRedblack(self.h_pad, self.colors, self.index_pad, self.nb, self.a, self.diag, b, float(omega), clip, sweeps)
+
+		return self.store(h)
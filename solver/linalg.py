@@ -1,74 +1,266 @@
 import numpy as np
+import atexit
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import warnings
+from piRichards.solver.stencil import createStencil, createJacobian
+from piRichards.solver.multigrid import Multigrid
+from piRichards.solver import kernels
+
+try:
+	from piRichards.solver import sparse
+except ImportError:
+	sparse = None #scipyが無い場合、疎行列ソルバは利用不可
+
+"""
+class : ソルバの反復に関する統計量
+att :
+	method -> <str> 解法
+	iterations -> <int> 反復回数 (ヤコビ法 : スイープ数, 反復法 : Krylov反復数, LU : 1)
+	residual -> <float> 最終的な相対残差ノルム ||r||/||b||
+	converged -> <bool> tolを満たした場合True。ヤコビ法でtol is None -> 常にFalse
+	time -> <float> 計算時間 [s]
+	time_per_iteration -> <float> 1反復あたりの計算時間 [s]
+	history -> <list of tuple> 残差確認時の(反復回数, 相対残差ノルム)
+	nl_iterations -> <int> 非線形反復(Picard or Newton)の回数
+	nl_converged -> <bool> 非線形反復がnl_tolを満たした場合True
+	increment -> <float> 最後の非線形反復におけるmax|h_next-h| [m]
+"""
+class Stats:
+	def __init__(self, method):
+		self.method = method
+		self.iterations = 0
+		self.residual = np.nan
+		self.converged = False
+		self.time = 0.
+		self.time_per_iteration = np.nan
+		self.history = []
+		self.nl_iterations = 0
+		self.nl_converged = False
+		self.increment = np.nan
+
+	def __repr__(self):
+		return "Stats(method = " + self.method + ", iterations = " + str(self.iterations) + ", residual = " + str(self.residual) + ", converged = " + str(self.converged) + ", nl_iterations = " + str(self.nl_iterations) + ", time = " + str(self.time) + ")"
+
+
+#####Stencilを直接反復する解法。"jacobi" : ヤコビ法, "rbgs" : red-black Gauss-Seidel法, "sor" : red-black SOR法, "mg" : 幾何マルチグリッド法(V-cycle)
+STENCIL_METHODS = ("jacobi", "rbgs", "sor", "mg")
+
+"""
+process : 解法の指定を確認
+input :
+	method -> <str> "jacobi", "rbgs", "sor", "mg", "lu", "cg" or "bicgstab"
+	precond -> <str> None, "ilu", "amg" or "mg"
+"""
+def checkMethod(method, precond = None):
+	if method in STENCIL_METHODS:
+		return
+
+	if sparse is None:
+		print("Error@piRichards.solver.linalg.checkMethod")
+		print("method <" + str(method) + "> requires scipy.")
+		sys.exit()
+
+	sparse.checkMethod(method, precond)
+
+
+"""
+process : 非線形反復法の指定を確認
+input : nonlinear -> <str> "picard" or "newton"
+"""
+def checkNonlinear(nonlinear):
+	if nonlinear not in ("picard", "newton"):
+		print("Error@piRichards.solver.linalg.checkNonlinear")
+		print("nonlinear <" + str(nonlinear) + "> is not supported.")
+		sys.exit()
+
+
+#####作成済みの領域分割。(レイアウトの種類, voxel, workers, backend, プロセス, スレッド)をキーとし、closeDecompositionsまでプロセスを使い回す
+DECOMPOSITIONS = {}
+
+"""
+process : 領域分割による多プロセス計算の準備
+input :
+	field -> <field class> or <activeField class>
+	method -> <str> 解法
+	workers -> <int> プロセス数
+	backend -> <str> "numpy" or "numba"
+output : <Decomposition class> 並列計算しない場合(workers <= 1 or ヤコビ法、red-black法以外)はNone
+Note :
+-- 呼び出す度にプロセスと共有メモリを作成する。使い終わったらDecomposition.closeで終了する
+-- daemonプロセス(PFのプール(piRichards.dataAssimilation.pool)の各プロセス等)は子プロセスを作成できないため、警告を出してNone(workers = 1)とする
+"""
+def createDecomposition(field, method, workers = 1, backend = "numpy"):
+	if (workers is None) or (workers <= 1) or (method not in ("jacobi", "rbgs", "sor")):
+		return None
+
+	if multiprocessing.current_process().daemon:
+		warnings.warn("workers = " + str(workers) + " is ignored in a daemon process (e.g. a particle pool worker); solving with workers = 1.", RuntimeWarning)
+		return None
+
+	from piRichards.solver.parallel import Decomposition
+	return Decomposition(field.cells if hasattr(field, "cells") else field.voxel, workers, backend)
+
+
+"""
+process : 作成済みの領域分割を取得 (無ければ作成してDECOMPOSITIONSに登録)
+input : createDecompositionと同じ
+output : <Decomposition class> or None
+Note :
+-- 同じvoxel(活性セルの配置)のfieldであれば、別のfieldでも同じ領域分割を使い回す (PFの各粒子、simulateの各ステップ等)
+-- 1つの領域分割を複数スレッドから同時に使えないため、スレッド毎に作成する。forkで作成した子プロセスは親プロセスの領域分割を使わない
+-- スイープの失敗で終了した領域分割(Decomposition.closed)は作成し直す
+-- プロセスはcloseDecompositionsで終了する (インタプリタ終了時にも自動で呼ばれる)
+"""
+def getDecomposition(field, method, workers = 1, backend = "numpy"):
+	if (workers is None) or (workers <= 1) or (method not in ("jacobi", "rbgs", "sor")):
+		return None
+
+	voxel = field.cells.voxel if hasattr(field, "cells") else field.voxel
+	key = (hasattr(field, "cells"), voxel.shape, voxel.tobytes(), workers, backend, os.getpid(), threading.get_ident())
+	if (key not in DECOMPOSITIONS) or ((DECOMPOSITIONS[key] is not None) and DECOMPOSITIONS[key].closed):
+		DECOMPOSITIONS[key] = createDecomposition(field, method, workers, backend)
+
+	return DECOMPOSITIONS[key]
+
+
+"""
+process : getDecompositionで作成した全ての領域分割のプロセスを終了し、共有メモリを解放
+Note : forkで親プロセスから引き継いだ領域分割は終了せずに登録のみ削除する
+"""
+def closeDecompositions():
+	while len(DECOMPOSITIONS) > 0:
+		key, decomposition = DECOMPOSITIONS.popitem()
+		if (decomposition is not None) and (key[-2] == os.getpid()):
+			decomposition.close()
+
+atexit.register(closeDecompositions)
+
 
 """
-process : ヤコビ法による定常解析
+process : Stencilの連立一次方程式を解き、field.hを更新
+input :
+	field -> <field class>
+	stencil -> <Stencil class>
+	iteration -> <int> 最大反復回数 (STENCIL_METHODSのみ)
+	lr -> <float> 緩和係数 (method == "jacobi"のみ)
+	method -> <str> 解法
+	precond -> <str> 前処理
+	tol -> <float> 相対残差ノルムの許容値。if None -> iteration回だけ反復
+	check -> <int> 残差を確認するスイープ間隔 (STENCIL_METHODSのみ)
+	stats -> <Stats class> 統計量の格納先
+	omega -> <float> SOR法の緩和係数。if None -> stencil.estimateOmegaで推定
+	backend -> <str> "numpy" or "numba"。"numba" -> ヤコビ法、red-black法をfused kernel (piRichards.solver.kernels.Kernel)で計算
+	decomposition -> <Decomposition class> if not None -> ヤコビ法、red-black法を領域分割による多プロセスで計算 (piRichards.solver.parallel)
+"""
+def solveStencil(field, stencil, iteration, lr, method, precond, tol, check, stats, omega = None, backend = "numpy", decomposition = None):
+	field.own() #hをin-placeに更新するため、共有している場合(field.share)はコピー
+	if method in STENCIL_METHODS:
+		if method == "rbgs":
+			omega = 1.
+		elif (method == "sor") and (omega is None):
+			omega = stencil.estimateOmega()
+		elif method == "mg":
+			mg = Multigrid(stencil); check = 1 #V-cycle毎に残差を確認
+		elif method == "jacobi":
+			h_next = np.empty_like(field.h) #<np array> ヤコビ法の更新値の格納先。field.hと交互に使う
+
+		kernel = None #<Kernel class> or <Decomposition class> 複数スイープをまとめて行う解法
+		if (decomposition is not None) and (method != "mg"):
+			decomposition.load(stencil); kernel = decomposition
+		elif (backend == "numba") and (method != "mg"):
+			kernel = kernels.Kernel(stencil)
+		sweeps = 1 if (kernel is None) else (iteration if (tol is None) else check) #<int> fused kernelで1度に行うスイープ数
+
+		itr = 0
+		while itr < iteration:
+			n = min(sweeps, iteration-itr)
+			if kernel is not None:
+				if method == "jacobi":
+					kernel.jacobi(field.h, lr, True, n)
+				else:
+					kernel.redblack(field.h, omega, True, n)
+			elif method == "jacobi":
+				stencil.jacobiSweep(field.h, h_next, lr)
+				field.h, h_next = h_next, field.h
+			elif method == "mg":
+				mg.vcycle(field.h, clip = True)
+				field.h[field.h > 0] = 0.
+			else:
+				stencil.redblack(field.h, omega)
+			itr += n; stats.iterations += n
+
+			if (tol is not None) and (itr%check == 0):
+				stats.residual = stencil.residualNorm(field.h)
+				stats.history.append((stats.iterations, stats.residual))
+				if stats.residual < tol:
+					stats.converged = True
+					break
+	else:
+		field.h, itr = sparse.solve(stencil, field.h, method, precond, 1e-8 if (tol is None) else tol, clip = True)
+		stats.iterations += itr
+		stats.residual = stencil.residualNorm(field.h)
+		stats.converged = bool(stats.residual < (1e-8 if (tol is None) else tol)) #h <= 0の制約を含めた残差で判定
+
+	if (method in STENCIL_METHODS) and (not stats.converged):
+		stats.residual = stencil.residualNorm(field.h)
+
+
+"""
+process : h <= 0の制約付きのマルチグリッド法が収束したか確認
+input :
+	field -> <field class>
+	method -> <str> 線形ソルバ
+	tol -> <float> 相対残差ノルムの許容値
+	stats -> <Stats class>
+Note : method == "mg"でh = 0の制約が効いているセル(h >= 0)があり、tolを満たさない場合は未収束のhを返さずに終了する
+"""
+def checkConstrained(field, method, tol, stats):
+	if (method != "mg") or (tol is None) or stats.converged or field.dead_flag:
+		return
+
+	if np.any(field.h >= 0.):
+		print("Error@piRichards.solver.linalg.checkConstrained")
+		print("method <mg> did not converge under the constraint h <= 0 (residual = " + str(stats.residual) + "). Increase iteration or use method <lu> or <sor>.")
+		sys.exit()
+
+
+"""
+process : 定常解析
 input :
 	field -> <field class>
 	q -> <ndarray> 地表面フラックス。(Nx, Ny)なshape
 	top -> "zero" or "flux"
 	bottom -> "free" or "zero"
 	Tp -> <float> 蒸散量
-	iteration -> <int> 反復回数
-	lr -> <float> 緩和係数
-output : なし。fieldのattが更新
+	iteration -> <int> 最大反復回数 (STENCIL_METHODSのみ。method == "mg"ではV-cycle数)
+	lr -> <float> 緩和係数 (method == "jacobi"のみ)
+	method -> <str> "jacobi" : ヤコビ法, "rbgs" : red-black Gauss-Seidel法, "sor" : red-black SOR法,
+		"mg" : 幾何マルチグリッド法 (piRichards.solver.multigrid), "lu", "cg", "bicgstab" : 疎行列ソルバ (piRichards.solver.sparse)
+	precond -> <str> 疎行列ソルバ(反復法)の前処理。None, "ilu", "amg" or "mg"
+	tol -> <float> 相対残差ノルムの許容値。if None -> iteration回だけ反復 (反復法では1e-8)
+	check -> <int> 残差を確認するスイープ間隔 (method == "mg"では毎V-cycle)
+	omega -> <float> SOR法の緩和係数。if None -> 最適値を推定
+	backend -> <str> "numpy" or "numba"。"numba" -> 係数の作成及びヤコビ法、red-black法をnumbaのfused kernelで計算 (numbaが無い場合は"numpy")
+	workers -> <int> ヤコビ法、red-black法(rbgs, sor)のプロセス数。workers > 1 -> x方向のスラブに領域分割して並列計算 (piRichards.solver.parallel)
+	decomposition -> <Decomposition class> 使用する領域分割 (createDecomposition)。if None -> getDecompositionで作成済みの領域分割を使い回す
+output : <Stats class> fieldのattが更新
 Note :
 -- 計算が発散した場合、例外処理が発動しfield.dead_flagがTrueになる
+-- workers > 1の場合、領域分割のプロセスは呼び出し後も残る。closeDecompositions (decompositionを渡した場合はDecomposition.close)で終了する
+-- method == "mg"でh = 0の制約が効いた状態でtolを満たさない場合はエラーで終了する (checkConstrained)
 """
-def run_Steady(field, q = None, top = "flux", bottom = "free", Tp = None, iteration = 1000, lr = 0.9):
-	dx, dy, dz = field.size #計算格子サイズ
-	h_extend = np.ones((field.shape[0]+2, field.shape[1]+2, field.shape[2]+2))*np.nan
-	K_extend = np.ones((field.shape[0]+2, field.shape[1]+2, field.shape[2]+2))*np.nan
+def run_Steady(field, q = None, top = "flux", bottom = "free", Tp = None, iteration = 1000, lr = 0.9, method = "jacobi", precond = "ilu", tol = None, check = 10, omega = None, backend = "numpy", workers = 1, decomposition = None):
+	checkMethod(method, precond); backend = kernels.checkBackend(backend)
+	stats = Stats(method); start = time.perf_counter()
 
 	try:
-		S = field.getS(Tp); K = field.getK()
-		K_extend[1:-1,1:-1,1:-1] = K
-		if top == "zero":
-			K_extend[np.array(field.topNode[0])+1, np.array(field.topNode[1])+1, np.array(field.topNode[2])] = field.k[field.topNode[0], field.topNode[1], field.topNode[2]]
-
-		if bottom == "zero":
-			K_extend[np.array(field.bottomNode[0])+1, np.array(field.bottomNode[1])+1, np.array(field.bottomNode[2])] = field.k[field.bottomNode[0], field.bottomNode[1], field.bottomNode[2]]
-
-		for itr in range(iteration):
-			h_extend[1:-1,1:-1,1:-1] = field.h
-			if top == "zero":
-				h_extend[np.array(field.topNode[0])+1, np.array(field.topNode[1])+1, np.array(field.topNode[2])] = 0.	
-
-			if bottom == "zero":
-				h_extend[np.array(field.bottomNode[0])+1, np.array(field.bottomNode[1])+1, np.array(field.bottomNode[2])] = 0.
-			
-			K_right = (K_extend[2:,1:-1,1:-1]+K_extend[1:-1,1:-1,1:-1])/2. #右境界のK値
-			a_right = K_right/(dx**2); a_right[np.isnan(a_right)] = 0. #右側係数
-			s_right = a_right*h_extend[2:, 1:-1, 1:-1]; s_right[np.isnan(s_right)] = 0.
-
-			K_left = (K_extend[:-2,1:-1,1:-1]+K_extend[1:-1,1:-1,1:-1])/2.
-			a_left = K_left/(dx**2); a_left[np.isnan(a_left)] = 0.
-			s_left = a_left*h_extend[:-2, 1:-1, 1:-1]; s_left[np.isnan(s_left)] = 0.
-
-			K_front = (K_extend[1:-1,2:,1:-1]+K_extend[1:-1,1:-1,1:-1])/2.
-			a_front = K_front/(dy**2); a_front[np.isnan(a_front)] = 0.
-			s_front = a_front*h_extend[1:-1, 2:, 1:-1]; s_front[np.isnan(s_front)] = 0.
-
-			K_back = (K_extend[1:-1,:-2,1:-1]+K_extend[1:-1,1:-1,1:-1])/2.
-			a_back = K_back/(dy**2); a_back[np.isnan(a_back)] = 0.
-			s_back = a_back*h_extend[1:-1, :-2, 1:-1]; s_back[np.isnan(s_back)] = 0.
-
-			K_up = (K_extend[1:-1,1:-1,2:]+K_extend[1:-1,1:-1,1:-1])/2.
-			a_up = K_up/(dz**2); a_up[np.isnan(a_up)] = 0.
-			s_up = a_up*h_extend[1:-1, 1:-1, 2:]; s_up[np.isnan(s_up)] = 0.
-			b_up = K_up/dz; b_up[np.isnan(b_up)] = 0.
-			if top == "flux":
-				b_up[field.topNode[0], field.topNode[1], field.topNode[2]] = q[field.topNode[0], field.topNode[1]]/dz
-			
-			K_down = (K_extend[1:-1,1:-1,:-2]+K_extend[1:-1,1:-1,1:-1])/2.
-			a_down = K_down/(dz**2); a_down[np.isnan(a_down)] = 0.
-			s_down = a_down*h_extend[1:-1, 1:-1,:-2]; s_down[np.isnan(s_down)] = 0.
-			b_down = -K_down/dz; b_down[np.isnan(b_down)] = 0.
-			b_down[field.bottomNode[0], field.bottomNode[1], field.bottomNode[2]] = -K[field.bottomNode[0], field.bottomNode[1], field.bottomNode[2]]/dz
-
-			a_i = a_right+a_left+a_front+a_back+a_up+a_down
-			h_next = (s_right+s_left+s_front+s_back+s_up+s_down+S+b_up+b_down)/a_i
-			field.h = (1.-lr)*field.h+lr*h_next
-			field.h[field.h > 0] = 0.
+		decomposition = getDecomposition(field, method, workers, backend) if (decomposition is None) else decomposition
+		stencil = createStencil(field, q, top, bottom, Tp, backend = backend) #<Stencil> 反復中は係数固定
+		solveStencil(field, stencil, iteration, lr, method, precond, tol, check, stats, omega, backend, decomposition)
 
 	except:
 		field.dead_flag = True
@@ -76,9 +268,15 @@ def run_Steady(field, q = None, top = "flux", bottom = "free", Tp = None, iterat
 	if np.min(field.h) < -1e+100:
 		field.dead_flag = True
 
+	checkConstrained(field, method, tol, stats)
+	stats.time = time.perf_counter()-start
+	stats.time_per_iteration = stats.time/max(stats.iterations, 1)
+
+	return stats
+
 
 """
-process : ヤコビ法による非定常解析
+process : 非定常解析
 input :
 	field -> <field class>
 	dt -> <float> 時間刻み
@@ -86,71 +284,66 @@ input :
 	top -> "zero" or "flux"
 	bottom -> "free" or "zero"
 	Tp -> <float> 蒸散量
-	iteration -> <int> 反復回数
-	lr -> <float> 緩和係数
-output : なし。fieldのattが更新
+	iteration -> <int> 最大反復回数 (STENCIL_METHODSのみ。method == "mg"ではV-cycle数)
+	lr -> <float> 緩和係数 (method == "jacobi"のみ)
+	method -> <str> "jacobi" : ヤコビ法, "rbgs" : red-black Gauss-Seidel法, "sor" : red-black SOR法,
+		"mg" : 幾何マルチグリッド法 (piRichards.solver.multigrid), "lu", "cg", "bicgstab" : 疎行列ソルバ (piRichards.solver.sparse)
+	precond -> <str> 疎行列ソルバ(反復法)の前処理。None, "ilu", "amg" or "mg"
+	tol -> <float> 相対残差ノルムの許容値。if None -> iteration回だけ反復 (反復法では1e-8)
+	check -> <int> 残差を確認するスイープ間隔
+	nonlinear -> <str> 非線形反復法。"picard" : 修正Picard法, "newton" : Newton法
+	nl_iteration -> <int> 非線形反復の最大回数
+	nl_tol -> <float> 非線形反復の収束判定値。max|h_next-h| < nl_tol [m]
+	omega -> <float> SOR法の緩和係数。if None -> 最適値を推定
+	backend -> <str> "numpy" or "numba"。"numba" -> 係数の作成及びヤコビ法、red-black法をnumbaのfused kernelで計算 (numbaが無い場合は"numpy")
+	workers -> <int> ヤコビ法、red-black法(rbgs, sor)のプロセス数。workers > 1 -> x方向のスラブに領域分割して並列計算 (piRichards.solver.parallel)
+	decomposition -> <Decomposition class> 使用する領域分割 (createDecomposition)。if None -> getDecompositionで作成済みの領域分割を使い回す
+output : <Stats class> fieldのattが更新
 Note :
 -- 計算が発散した場合、例外処理が発動しfield.dead_flagがTrueになる
+-- workers > 1の場合、領域分割のプロセスは呼び出し後も残る。closeDecompositions (decompositionを渡した場合はDecomposition.close)で終了する
+-- 各非線形反復でK, Cwを現在の反復値から再計算する。nl_iteration == 1のときは初期値のK, Cwで固定した従来の計算と同じ
+-- 修正Picard法は質量保存形 Cw*(h_next-h)/dt+(theta(h)-theta_before)/dt = div(K*grad(h_next+z))+S を解く
+-- Newton法のJacobianは非対称であるため、method == "cg"の場合は"bicgstab"を用いる
+-- Newton法のJacobianはM行列とは限らずマルチグリッド法単体では発散し得るため、method == "mg"の場合はマルチグリッド前処理付き"bicgstab"を用いる (scipyがある場合)
+-- method == "mg"でh = 0の制約が効いた状態でtolを満たさない場合はエラーで終了する (checkConstrained)
 """
-def run_Unsteady(field, dt, q = None, top = "flux", bottom = "free", Tp = None, iteration = 20, lr = 0.9):
-	dx, dy, dz = field.size #計算格子サイズ
-	h_before = field.h.copy() #現時刻のマトリックポテンシャル
-	h_extend = np.ones((field.shape[0]+2, field.shape[1]+2, field.shape[2]+2))*np.nan
-	K_extend = np.ones((field.shape[0]+2, field.shape[1]+2, field.shape[2]+2))*np.nan
+def run_Unsteady(field, dt, q = None, top = "flux", bottom = "free", Tp = None, iteration = 20, lr = 0.9, method = "jacobi", precond = "ilu", tol = None, check = 10, nonlinear = "picard", nl_iteration = 1, nl_tol = 1e-5, omega = None, backend = "numpy", workers = 1, decomposition = None):
+	checkMethod(method, precond); checkNonlinear(nonlinear); backend = kernels.checkBackend(backend)
+	stats = Stats(method); start = time.perf_counter()
+	linear = method; linear_precond = precond #<str> 線形ソルバと前処理
+	if (nonlinear == "newton") and (method == "cg"):
+		linear = "bicgstab"
+	elif (nonlinear == "newton") and (method == "mg") and (sparse is not None):
+		linear = "bicgstab"; linear_precond = "mg"
 
 	try:
-		Cw = field.getCw(); S = field.getS(Tp); K = field.getK()
-		K_extend[1:-1,1:-1,1:-1] = K
-		if top == "zero":
-			K_extend[np.array(field.topNode[0])+1, np.array(field.topNode[1])+1, np.array(field.topNode[2])] = field.k[field.topNode[0], field.topNode[1], field.topNode[2]]
-
-		if bottom == "zero":
-			K_extend[np.array(field.bottomNode[0])+1, np.array(field.bottomNode[1])+1, np.array(field.bottomNode[2])] = field.k[field.bottomNode[0], field.bottomNode[1], field.bottomNode[2]]
-
-		for itr in range(iteration):
-			h_extend[1:-1,1:-1,1:-1] = field.h
-			if top == "zero":
-				h_extend[np.array(field.topNode[0])+1, np.array(field.topNode[1])+1, np.array(field.topNode[2])] = 0.	
-
-			if bottom == "zero":
-				h_extend[np.array(field.bottomNode[0])+1, np.array(field.bottomNode[1])+1, np.array(field.bottomNode[2])] = 0.
-			
-			K_right = (K_extend[2:,1:-1,1:-1]+K_extend[1:-1,1:-1,1:-1])/2. #右境界のK値
-			a_right = K_right/(dx**2); a_right[np.isnan(a_right)] = 0. #右側係数
-			s_right = a_right*h_extend[2:, 1:-1, 1:-1]; s_right[np.isnan(s_right)] = 0.
-
-			K_left = (K_extend[:-2,1:-1,1:-1]+K_extend[1:-1,1:-1,1:-1])/2.
-			a_left = K_left/(dx**2); a_left[np.isnan(a_left)] = 0.
-			s_left = a_left*h_extend[:-2, 1:-1, 1:-1]; s_left[np.isnan(s_left)] = 0.
-
-			K_front = (K_extend[1:-1,2:,1:-1]+K_extend[1:-1,1:-1,1:-1])/2.
-			a_front = K_front/(dy**2); a_front[np.isnan(a_front)] = 0.
-			s_front = a_front*h_extend[1:-1, 2:, 1:-1]; s_front[np.isnan(s_front)] = 0.
-
-			K_back = (K_extend[1:-1,:-2,1:-1]+K_extend[1:-1,1:-1,1:-1])/2.
-			a_back = K_back/(dy**2); a_back[np.isnan(a_back)] = 0.
-			s_back = a_back*h_extend[1:-1, :-2, 1:-1]; s_back[np.isnan(s_back)] = 0.
-
-			K_up = (K_extend[1:-1,1:-1,2:]+K_extend[1:-1,1:-1,1:-1])/2.
-			a_up = K_up/(dz**2); a_up[np.isnan(a_up)] = 0.
-			s_up = a_up*h_extend[1:-1, 1:-1, 2:]; s_up[np.isnan(s_up)] = 0.
-			b_up = K_up/dz; b_up[np.isnan(b_up)] = 0.
-			if top == "flux":
-				b_up[field.topNode[0], field.topNode[1], field.topNode[2]] = q[field.topNode[0], field.topNode[1]]/dz
-			
-			K_down = (K_extend[1:-1,1:-1,:-2]+K_extend[1:-1,1:-1,1:-1])/2.
-			a_down = K_down/(dz**2); a_down[np.isnan(a_down)] = 0.
-			s_down = a_down*h_extend[1:-1, 1:-1,:-2]; s_down[np.isnan(s_down)] = 0.
-			b_down = -K_down/dz; b_down[np.isnan(b_down)] = 0.
-			b_down[field.bottomNode[0], field.bottomNode[1], field.bottomNode[2]] = -K[field.bottomNode[0], field.bottomNode[1], field.bottomNode[2]]/dz
-
-			a_i = Cw/dt+a_right+a_left+a_front+a_back+a_up+a_down
-			h_next = (Cw/dt*h_before+s_right+s_left+s_front+s_back+s_up+s_down+S+b_up+b_down)/a_i
-			field.h = (1.-lr)*field.h+lr*h_next
-			field.h[field.h > 0] = 0.
+		if (decomposition is None) or (linear not in ("jacobi", "rbgs", "sor")):
+			decomposition = getDecomposition(field, linear, workers, backend)
+		theta_before = field.getTheta() #現時刻の体積含水率
+		for nl_itr in range(nl_iteration):
+			h_old = field.h.copy() #<np array> 非線形反復の現在値
+			if nonlinear == "newton":
+				stencil = createJacobian(field, dt, theta_before, q, top, bottom, Tp, backend)
+			else:
+				stencil = createStencil(field, q, top, bottom, Tp, dt, h_old, backend) #<Stencil> 現在値で線形化
+				stencil.b -= (field.getTheta()-theta_before)/dt
+
+			solveStencil(field, stencil, iteration, lr, linear, linear_precond, tol, check, stats, omega, backend, decomposition)
+			stats.nl_iterations += 1
+			stats.increment = np.nanmax(np.abs(field.h-h_old))
+			if stats.increment < nl_tol:
+				stats.nl_converged = True
+				break
 
 	except:
 		field.dead_flag = True
 
 	if np.min(field.h) < -1e+100:
-		field.dead_flag = True
\ No newline at end of file
+		field.dead_flag = True
+
+	checkConstrained(field, linear, tol, stats)
+	stats.time = time.perf_counter()-start
+	stats.time_per_iteration = stats.time/max(stats.iterations, 1)
+
+	return stats
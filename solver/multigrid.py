@@ -0,0 +1,272 @@
+import numpy as np
+from piRichards.solver.stencil import Stencil, SLICES, extend
+
+try:
+	import scipy.sparse.linalg as spla
+except ImportError:
+	spla = None #scipyが無い場合、最粗格子はスムーザーで解く
+
+#####制約付きのV-cycle(Multigrid.vcycleConstrained)で固定するセルを更新する条件。残差が1/REDUCTION以下に減少、もしくは1回のV-cycleでSTALL倍以下に減少しない(停滞)
+REDUCTION = 10.
+STALL = 0.5
+
+
+"""
+process : 配列を粗格子セルごとのブロックに並べ替える
+input :
+	X -> <np array> (Nx, Ny, Nz)なshape
+	factor -> <tuple of int> 各軸の粗視化倍率 (1 or 2)
+	shape_c -> <tuple of int> 粗格子の格子数
+output : <np array> (Nx_c, fx, Ny_c, fy, Nz_c, fz)なshape。端数は0で埋める
+"""
+def blocks(X, factor, shape_c):
+	pad = [(0, f*nc-n) for n, f, nc in zip(X.shape, factor, shape_c)]
+	X = np.pad(X, pad)
+	return X.reshape((shape_c[0], factor[0], shape_c[1], factor[1], shape_c[2], factor[2]))
+
+
+"""
+process : Stencilを粗視化
+input : stencil -> <Stencil class>
+output :
+	stencil_c -> <Stencil class> 粗格子のStencil。bは0
+	factor -> <tuple of int> 各軸の粗視化倍率
+Note :
+-- 子セルのうち1つでも活性であれば粗格子セルは活性
+-- 面の係数は粗格子の面を横切る細格子の係数の和を子セル数と面に垂直な軸の倍率で割った値 (再離散化に相当)
+-- 時間項及びDirichlet境界の寄与(diagのうち活性セル間の結合以外)は子セルの平均
+"""
+def coarsen(stencil):
+	shape = stencil.shape
+	factor = tuple(2 if n > 1 else 1 for n in shape)
+	shape_c = tuple(-(-n//f) for n, f in zip(shape, factor))
+	children = factor[0]*factor[1]*factor[2] #<int> 子セル数
+	voxel = stencil.voxel
+
+	#####活性セル間の結合とそれ以外の対角項
+	active_extend = extend(voxel, False)
+	a_inner = np.stack([np.where(active_extend[SLICES[d]], stencil.a[d], 0.) for d in range(6)])
+	diag0 = np.where(voxel, stencil.diag-np.sum(a_inner, axis = 0), 0.)
+
+	voxel_c = np.sum(blocks(voxel, factor, shape_c), axis = (1, 3, 5)) > 0
+	diag0_c = np.sum(blocks(diag0, factor, shape_c), axis = (1, 3, 5))/children
+
+	a_c = np.zeros((6,)+shape_c)
+	for d in range(6):
+		axis = d//2 #<int> 面に垂直な軸
+		local = [slice(None)]*6
+		local[2*axis+1] = slice(factor[axis]-1, factor[axis]) if (d%2 == 0) else slice(0, 1) #粗格子の面に接する子セル
+		a_c[d] = np.sum(blocks(a_inner[d], factor, shape_c)[tuple(local)], axis = (1, 3, 5))/children/factor[axis]
+
+	a_c[:, ~voxel_c] = 0.
+	diag_c = np.where(voxel_c, diag0_c+np.sum(a_c, axis = 0), np.nan)
+
+	return Stencil(voxel_c, a_c, diag_c, np.zeros(shape_c)), factor
+
+
+"""
+class : ボクセル格子上の幾何マルチグリッド法
+att :
+	levels -> <list of Stencil> 各レベルのStencil。levels[0]が細格子
+	factors -> <list of tuple> 各レベル間の粗視化倍率
+	pre, post -> <int> 前後平滑化の回数 (red-black Gauss-Seidel法)
+	lu -> <SuperLU> 最粗格子のLU分解。scipyが無い場合None
+	options -> <tuple> (coarsest, pre, post, max_level)。constrainで使う
+	fixed -> <np array> h = 0に固定したセル (h <= 0の制約付きのV-cycleのみ)。if None -> 未作成
+	constrained -> <Multigrid class> fixedのセルをh = 0のDirichlet境界としたMultigrid。固定するセルが無い場合None
+	norm, norm_before -> <float> 固定するセルを更新した時点及び直前のV-cycle後の残差ノルム (fixedのセルを除く)
+Note :
+-- levels[0]は入力Stencilとa, diagを共有する別オブジェクトであり、bを書き換えても入力Stencilには影響しない
+-- 入力がActiveStencilの場合、levels[0]は(Nx, Ny, Nz)なshapeに変換したStencil。vcycleは(N, )なshapeのhも受け付ける
+-- 制限は子セルの平均、延長は区分定数補間。延長を転置した制限と対称な平滑化により、V-cycleは対称な前処理として使える
+"""
+class Multigrid:
+	"""
+	input :
+		stencil -> <Stencil class> 細格子のStencil
+		coarsest -> <int> 最粗格子の活性セル数の上限
+		pre, post -> <int> 前後平滑化の回数
+		max_level -> <int> 最大レベル数
+	"""
+	def __init__(self, stencil, coarsest = 500, pre = 2, post = 2, max_level = 20):
+		self.levels = [stencil.toDense()]
+		self.cells = getattr(stencil, "cells", None) #<Cells class> ActiveStencilの場合のみ
+		self.factors = []
+		self.pre = pre; self.post = post
+		self.options = (coarsest, pre, post, max_level)
+		self.fixed = None; self.constrained = None
+		self.norm = None; self.norm_before = None
+
+		while (len(self.levels) < max_level) and (np.count_nonzero(self.levels[-1].voxel) > coarsest) and (max(self.levels[-1].shape) > 1):
+			stencil_c, factor = coarsen(self.levels[-1])
+			self.levels.append(stencil_c); self.factors.append(factor)
+
+		self.lu = None
+		if spla is not None:
+			from piRichards.solver.sparse import assemble
+			try:
+				self.lu = spla.splu(assemble(self.levels[-1])[0].tocsc())
+			except RuntimeError:
+				self.lu = None #特異な場合はスムーザーで解く
+
+	def __len__(self):
+		return len(self.levels)
+
+	"""
+	process : 細格子(level)の配列を粗格子(level+1)へ制限 (子セルの平均)
+	"""
+	def restrict(self, X, level):
+		factor = self.factors[level]
+		children = factor[0]*factor[1]*factor[2]
+		X = np.where(self.levels[level].voxel, X, 0.)
+		return np.sum(blocks(X, factor, self.levels[level+1].shape), axis = (1, 3, 5))/children
+
+	"""
+	process : 粗格子(level+1)の配列を細格子(level)へ延長 (区分定数補間)
+	"""
+	def prolong(self, X, level):
+		factor = self.factors[level]; shape = self.levels[level].shape
+		for axis in range(3):
+			X = np.repeat(X, factor[axis], axis = axis)
+
+		return np.where(self.levels[level].voxel, X[:shape[0], :shape[1], :shape[2]], 0.)
+
+	"""
+	process : 最粗格子を解く
+	"""
+	def solveCoarsest(self, h):
+		stencil = self.levels[-1]
+		if self.lu is not None:
+			h[stencil.voxel] = self.lu.solve(stencil.b[stencil.voxel])
+		else:
+			for itr in range(50):
+				stencil.redblack(h, 1., False)
+
+		return h
+
+	"""
+	process : h = 0に固定するセルを設定し、固定したセルをDirichlet境界としたMultigridを作成
+	input : fixed -> <np array> (Nx, Ny, Nz)なshape。h = 0に固定するセル
+	Note : 固定したセルはvoidセルと同様に扱う(隣接セルからはh = 0のゴーストセル)。粗格子も固定したセルを除いて作成するため、粗格子補正が制約と矛盾しない
+	"""
+	def constrain(self, fixed):
+		stencil = self.levels[0]
+		self.fixed = fixed
+		if np.any(fixed):
+			voxel = stencil.voxel*(~fixed)
+			a = np.where(voxel, stencil.a, 0.); diag = np.where(voxel, stencil.diag, np.nan)
+			self.constrained = Multigrid(Stencil(voxel, a, diag, stencil.b), *self.options)
+		else:
+			self.constrained = None
+
+	"""
+	process : 固定したセル(fixed)を除いた残差ノルム
+	"""
+	def freeNorm(self, r):
+		return np.sqrt(np.sum(np.where(self.fixed, 0., r)**2))
+
+	"""
+	process : h <= 0の制約付きのV-cycle (有効制約法)
+	input : h -> <np array> (Nx, Ny, Nz)なshapeの細格子の現在値。直接更新される
+	output : <np array> 更新後のh
+	Note :
+	-- 固定したセル(fixed)をh = 0とした線形問題をV-cycleで解き、残差が1/REDUCTION以下に減少もしくは停滞(STALL)した時点で固定するセルを更新する
+	-- h > 0のセルは毎回0にするため、固定するセルが正しくなるまで線形問題の残差は停滞する
+	-- 固定するセルはh > 0のセル、及び固定したセルのうちhを増加させる向きの残差(r >= 0)のセル (piRichards.solver.sparse.solveと同じ)
+	-- 固定するセルは呼び出し間で保持する。初回は現在のhからh >= 0かつr > 0のセルを固定する
+	"""
+	def vcycleConstrained(self, h):
+		stencil = self.levels[0]
+		if self.fixed is None:
+			self.constrain((h >= 0.)*(stencil.residual(h) > 0.))
+
+		h[self.fixed] = 0.
+		if self.norm is None:
+			self.norm = self.norm_before = self.freeNorm(stencil.residual(h))
+
+		if self.constrained is None:
+			self.vcycle(h)
+		else:
+			self.constrained.levels[0].b = stencil.b
+			self.constrained.vcycle(h)
+
+		r = stencil.residual(h)
+		norm = self.freeNorm(r)
+		fixed = stencil.voxel*((h > 0.)+self.fixed*(r >= 0.))
+		h[h > 0] = 0.
+		if ((norm <= self.norm/REDUCTION) or (norm >= STALL*self.norm_before)) and (not np.array_equal(fixed, self.fixed)):
+			self.constrain(fixed); self.norm = None
+		self.norm_before = norm
+
+		return h
+
+	"""
+	process : V-cycle
+	input :
+		h -> <np array> levelの現在値。直接更新される。levels[level].bが右辺 (level == 0では入力Stencilと同じレイアウトでもよい)
+		level -> <int> レベル
+		clip -> <bool> True -> h <= 0の制約付きで解く (細格子のみ。vcycleConstrained)
+	output : <np array> 更新後のh
+	"""
+	def vcycle(self, h, level = 0, clip = False):
+		if (level == 0) and (self.cells is not None) and (h.ndim == 1):
+			h[:] = self.vcycle(self.cells.toDense(h), 0, clip)[self.cells.voxel]
+			return h
+
+		if clip and (level == 0):
+			return self.vcycleConstrained(h)
+
+		stencil = self.levels[level]
+		if level == len(self.levels)-1:
+			return self.solveCoarsest(h)
+
+		for itr in range(self.pre):
+			stencil.redblack(h, 1., False)
+
+		#####粗格子補正
+		stencil_c = self.levels[level+1]
+		stencil_c.b = self.restrict(stencil.residual(h), level)
+		e = self.vcycle(np.zeros(stencil_c.shape), level+1)
+		h[stencil.voxel] += self.prolong(e, level)[stencil.voxel]
+
+		for itr in range(self.post):
+			stencil.redblack(h, 1., False, reverse = True)
+
+		return h
+
+	"""
+	process : Full Multigrid (FMG)による初期解の作成
+	input :
+		cycles -> <int> 各レベルでのV-cycle回数
+		clip -> <bool> True -> 細格子はh <= 0の制約付きで解く (vcycleConstrained)
+	output : <np array> 細格子の解 (voidセルはnp.nan)
+	"""
+	def fmg(self, cycles = 1, clip = False):
+		b = [self.levels[0].b]
+		for level in range(len(self.levels)-1):
+			b.append(self.restrict(b[-1], level))
+
+		stencil = self.levels[-1]; stencil.b = b[-1]
+		h = self.solveCoarsest(np.zeros(stencil.shape))
+		for level in reversed(range(len(self.levels)-1)):
+			stencil = self.levels[level]; stencil.b = b[level]
+			h = self.prolong(h, level)
+			for itr in range(cycles):
+				self.vcycle(h, level, clip)
+
+		if clip and (len(self.levels) == 1):
+			self.vcycle(h, 0, clip)
+
+		return np.where(self.levels[0].voxel, h, np.nan)
+
+	"""
+	process : 前処理として1回のV-cycleを適用 (初期値0)
+	input : r -> <np array> (N, )なshape。活性セルの残差
+	output : <np array> (N, )なshape。近似解
+	"""
+	def precondition(self, r):
+		stencil = self.levels[0]
+		stencil.b = np.zeros(stencil.shape); stencil.b[stencil.voxel] = r
+		e = self.vcycle(np.zeros(stencil.shape))
+
+		return e[stencil.voxel]
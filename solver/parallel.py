@@ -0,0 +1,244 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from piRichards.solver.stencil import kernelIndex
+from piRichards.solver import kernels
+
+
+"""
+process : 共有メモリ上に配列を作成
+input :
+	shape -> <tuple> 配列のshape
+	dtype -> <dtype>
+output :
+	shm -> <SharedMemory>
+	X -> <np array> shm上の配列 (0で初期化)
+"""
+def createShared(shape, dtype = float):
+	shm = shared_memory.SharedMemory(create = True, size = max(int(np.prod(shape))*np.dtype(dtype).itemsize, 1))
+	X = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+	X[...] = 0
+	return shm, X
+
+
+"""
+process : 活性セルをx方向のスラブに分割
+input :
+	x -> <np array> (N, )なshape。活性セルのx座標
+	workers -> <int> スラブ数
+output : <list of np array> 各スラブの活性セル番号
+Note : 各スラブの活性セル数がほぼ等しくなるようにx方向の境界を決める
+"""
+def splitSlabs(x, workers):
+	count = np.cumsum(np.bincount(x)) #<np array> x <= iの活性セル数
+	bounds = np.searchsorted(count, np.arange(1, workers)*count[-1]/workers, side = "right")
+	slab = np.searchsorted(bounds, x, side = "right") #<np array> 各活性セルのスラブ番号
+
+	return [np.flatnonzero(slab == w) for w in range(workers)]
+
+
+"""
+process : 各プロセスでスラブのスイープを行う
+input :
+	rank -> <int> スラブ番号
+	names -> <dict> 共有メモリの名前
+	N, size_pad -> <int> 活性セル数、ゴーストセル付き配列の要素数
+	cells -> <np array> スラブの活性セル番号
+	index_pad, nb -> kernelIndexの出力 (スラブのみ)
+	parity -> <np array> スラブの活性セルの色 (True : red)
+	barrier -> <Barrier> スイープ毎の同期
+	conn -> <Connection> 親プロセスとの通信
+	backend -> <str> "numpy" or "numba"
+Note :
+-- スラブ境界の隣接セル(ゴーストセル)の値は共有メモリ上の隣のスラブの値を直接参照する。スイープ毎(red-black法では色毎)にbarrierで同期することで、ゴーストセルの交換に相当する
+"""
+def worker(rank, names, N, size_pad, cells, index_pad, nb, parity, barrier, conn, backend):
+	shms = {key : shared_memory.SharedMemory(name = name) for key, name in names.items()}
+	pads = [np.ndarray((size_pad, ), dtype = float, buffer = shms["h_pad"].buf), np.ndarray((size_pad, ), dtype = float, buffer = shms["work_pad"].buf)]
+	A = np.ndarray((6, N), dtype = float, buffer = shms["a"].buf)
+	D = np.ndarray((N, ), dtype = float, buffer = shms["diag"].buf)
+	B = np.ndarray((N, ), dtype = float, buffer = shms["b"].buf)
+	red = np.flatnonzero(parity); black = np.flatnonzero(~parity)
+	colors = ((red, index_pad[red], nb[:, red]), (black, index_pad[black], nb[:, black]))
+
+	try:
+		while True:
+			command = conn.recv()
+			if command[0] == "stop":
+				break
+			elif command[0] == "load":
+				a = np.ascontiguousarray(A[:, cells]); diag = D[cells].copy()
+				conn.send("done")
+				continue
+
+			method, sweeps, relax, clip, current = command
+			b = B[cells].copy()
+			if method == "jacobi":
+				for sweep in range(sweeps):
+					h_pad = pads[(current+sweep)%2]; out_pad = pads[(current+sweep+1)%2]
+					if backend == "numba":
+						kernels.fusedJacobi(h_pad, out_pad, index_pad, nb, a, diag, b, relax, clip, 1)
+					else:
+						s = np.zeros(len(cells))
+						for d in range(6):
+							s += a[d]*h_pad[nb[d]]
+
+						h_new = (1.-relax)*h_pad[index_pad]+relax*((s+b)/diag)
+						out_pad[index_pad] = np.minimum(h_new, 0.) if clip else h_new
+					barrier.wait()
+			else:
+				h_pad = pads[current] #red-black法はh_padを直接更新する
+				for sweep in range(sweeps):
+					for color, color_pad, color_nb in colors:
+						s = b[color].copy()
+						for d in range(6):
+							s += a[d, color]*h_pad[color_nb[d]]
+
+						h_new = (1.-relax)*h_pad[color_pad]+relax*s/diag[color]
+						h_pad[color_pad] = np.minimum(h_new, 0.) if clip else h_new
+						barrier.wait()
+
+			conn.send("done")
+	except Exception as e:
+		barrier.abort()
+		conn.send("error : " + repr(e))
+	finally:
+		for shm in shms.values():
+			shm.close()
+
+
+"""
+class : 領域分割による多プロセスの反復解法 (ヤコビ法、red-black法)
+att :
+	workers -> <int> プロセス数 (スラブ数)
+	index, index_pad, nb -> kernelIndexの出力
+	h_pad, work_pad -> <np array> 共有メモリ上のゴーストセル付きのh
+	a, diag, b -> <np array> 共有メモリ上の活性セルの係数
+	current -> <int> 最新のhを格納した作業配列 (0 : h_pad, 1 : work_pad)
+	closed -> <bool> True -> closeで終了済み
+Note :
+-- 活性セルをx方向のスラブに分割し、各スラブを1プロセスが担当する。プロセスは作成時に起動し、closeまで使い回す
+-- 係数は共有メモリ上に置き、loadでStencilを切り替える (非線形反復毎に係数が変わってもプロセスは再起動しない)
+-- jacobi, redblackはpiRichards.solver.kernels.Kernelと同じ呼び出し方であり、結果も一致する
+-- backend == "numba"の場合、ヤコビ法の各スラブの更新はfused kernel (piRichards.solver.kernels.fusedJacobi)で計算する
+-- いずれかのプロセスでスイープが失敗するとbarrierが破棄され全プロセスが終了するため、commandはcloseしてから例外を送出する
+"""
+class Decomposition:
+	"""
+	input :
+		layout -> <np array> voxel (密な配列) or <Cells class>
+		workers -> <int> プロセス数
+		backend -> <str> "numpy" or "numba"
+	"""
+	def __init__(self, layout, workers = 2, backend = "numpy"):
+		self.workers = workers
+		self.layout = layout
+		self.index, self.index_pad, self.nb, size_pad = kernelIndex(layout)
+		N = len(self.index)
+		coords = layout.coords if hasattr(layout, "coords") else np.unravel_index(self.index, layout.shape)
+		parity = ((coords[0]+coords[1]+coords[2])%2 == 0)
+
+		self.shms = {}
+		self.shms["h_pad"], self.h_pad = createShared((size_pad, ))
+		self.shms["work_pad"], self.work_pad = createShared((size_pad, ))
+		self.shms["a"], self.a = createShared((6, N))
+		self.shms["diag"], self.diag = createShared((N, ))
+		self.shms["b"], self.b = createShared((N, ))
+		self.current = 0
+		self.closed = False
+
+		names = {key : shm.name for key, shm in self.shms.items()}
+		#####numbaのスレッドプール起動後のforkは安全でないため、forkserver (無い場合はspawn)でプロセスを起動
+		context = mp.get_context("forkserver" if ("forkserver" in mp.get_all_start_methods()) else "spawn")
+		self.barrier = context.Barrier(workers) #子プロセスの起動(spawn)まで親プロセスでも保持する
+		self.conns = []; self.processes = []
+		for rank, cells in enumerate(splitSlabs(coords[0], workers)):
+			conn, child = context.Pipe()
+			process = context.Process(target = worker, args = (rank, names, N, size_pad, cells, self.index_pad[cells], np.ascontiguousarray(self.nb[:, cells]), parity[cells], self.barrier, child, backend), daemon = True)
+			process.start()
+			self.conns.append(conn); self.processes.append(process)
+
+	"""
+	process : 終了済み(closed)でないか確認。終了済みの場合は共有メモリを参照せずに例外を送出する
+	"""
+	def checkOpen(self):
+		if self.closed:
+			raise RuntimeError("decomposition is closed")
+
+	"""
+	process : 全プロセスにコマンドを送り、終了を待つ
+	"""
+	def command(self, command):
+		for conn in self.conns:
+			conn.send(command)
+
+		errors = [message for message in [conn.recv() for conn in self.conns] if message != "done"]
+		if len(errors) > 0:
+			self.close()
+			raise RuntimeError("parallel sweep failed (" + errors[0] + ")")
+
+	"""
+	process : Stencilの係数を共有メモリに書き込む
+	input : stencil -> <Stencil class> or <ActiveStencil class> (作成時と同じレイアウト)
+	"""
+	def load(self, stencil):
+		self.checkOpen()
+		self.stencil = stencil
+		self.a[...] = stencil.a.reshape((6, -1))[:, self.index]
+		self.diag[...] = stencil.diag.reshape(-1)[self.index]
+		self.command(("load", ))
+
+	"""
+	process : hを共有メモリに書き込み、各スラブでsweeps回更新してhに書き戻す
+	input :
+		method -> <str> "jacobi" or "redblack"
+		h -> <np array> Stencilと同じレイアウトの現在値。直接更新される
+		relax -> <float> 緩和係数 (lr or omega)
+		clip -> <bool> True -> h > 0を0にする
+		sweeps -> <int> スイープ数
+	output : <np array> 更新後のh
+	"""
+	def sweep(self, method, h, relax, clip, sweeps):
+		self.checkOpen()
+		pads = (self.h_pad, self.work_pad)
+		pads[self.current][self.index_pad] = h.reshape(-1)[self.index]
+		self.b[...] = np.broadcast_to(self.stencil.b, self.stencil.shape).reshape(-1)[self.index]
+		self.command((method, sweeps, float(relax), clip, self.current))
+
+		if method == "jacobi":
+			self.current = (self.current+sweeps)%2
+		h.reshape(-1)[self.index] = pads[self.current][self.index_pad]
+		return h
+
+	"""
+	process : 緩和付きヤコビ法でsweeps回更新 (piRichards.solver.kernels.Kernel.jacobiと同じ)
+	"""
+	def jacobi(self, h, lr = 1., clip = True, sweeps = 1):
+		return self.sweep("jacobi", h, lr, clip, sweeps)
+
+	"""
+	process : red-black順序のGauss-Seidel法(omega > 1 -> SOR法)でsweeps回更新 (piRichards.solver.kernels.Kernel.redblackと同じ)
+	"""
+	def redblack(self, h, omega = 1., clip = True, sweeps = 1):
+		return self.sweep("redblack", h, omega, clip, sweeps)
+
+	"""
+	process : プロセスを終了し、共有メモリを解放
+	"""
+	def close(self):
+		if self.closed:
+			return
+
+		self.closed = True
+		for conn, process in zip(self.conns, self.processes):
+			try:
+				conn.send(("stop", ))
+			except (BrokenPipeError, OSError):
+				pass
+			process.join(timeout = 10)
+			if process.is_alive():
+				process.terminate()
+
+		for shm in self.shms.values():
+			shm.close(); shm.unlink()
+		self.shms = {}
@@ -0,0 +1,162 @@
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+import sys
+
+try:
+	import pyamg
+except ImportError:
+	pyamg = None
+
+METHODS = ("lu", "cg", "bicgstab")
+PRECONDS = (None, "ilu", "amg", "mg")
+
+
+"""
+process : 解法と前処理の指定を確認
+input :
+	method -> <str> "lu", "cg" or "bicgstab"
+	precond -> <str> None, "ilu", "amg" or "mg"
+"""
+def checkMethod(method, precond = None):
+	if method not in METHODS:
+		print("Error@piRichards.solver.sparse.checkMethod")
+		print("method <" + str(method) + "> is not supported.")
+		sys.exit()
+
+	if (method != "lu") and (precond not in PRECONDS):
+		print("Error@piRichards.solver.sparse.checkMethod")
+		print("precond <" + str(precond) + "> is not supported.")
+		sys.exit()
+
+	if (method != "lu") and (precond == "amg") and (pyamg is None):
+		print("Error@piRichards.solver.sparse.checkMethod")
+		print("precond <amg> requires pyamg.")
+		sys.exit()
+
+
+"""
+process : Stencilから活性セル(voxel == True)のみの連立一次方程式 A*h = bを作成
+input : stencil -> <Stencil class> or <ActiveStencil class>
+output :
+	A -> <scipy csr_matrix> (N, N)なshape。Nは活性セル数
+	b -> <np array> (N, )なshape
+Note :
+-- 行の順番はvoxel[voxel]の順番 (C order)
+-- Dirichlet境界(ゴーストセル)は値が0であるため、行列には現れない
+"""
+def assemble(stencil):
+	diag = stencil.compact(stencil.diag)
+	N = len(diag) #<int> 活性セル数
+	neighbor = stencil.neighborIndex() #<np array> 隣接セル番号
+
+	rows = [np.arange(N)]; cols = [np.arange(N)]; vals = [diag]
+	for d in range(6):
+		nb = neighbor[d]
+		a = stencil.compact(stencil.a[d])
+		mask = (nb >= 0)*(a != 0.)
+		rows.append(np.arange(N)[mask]); cols.append(nb[mask]); vals.append(-a[mask])
+
+	A = sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape = (N, N))
+
+	return A, stencil.compact(np.broadcast_to(stencil.b, stencil.shape))
+
+
+"""
+process : 前処理の作成
+input :
+	A -> <scipy csr_matrix>
+	precond -> <str> None, "ilu", "amg" or "mg"
+	symmetric -> <bool> True -> 対称な前処理を作成 (共役勾配法用)
+	stencil -> <Stencil class> precond == "mg"のときのみ必要
+output : <LinearOperator> or None
+Note :
+-- 不完全LU分解(ILU(0)相当)は非対称であるため、symmetric == TrueのときはL*D*L^Tの形に対称化して用いる
+"""
+def createPreconditioner(A, precond = "ilu", symmetric = False, stencil = None):
+	if precond == "ilu":
+		ilu = spla.spilu(A.tocsc(), drop_tol = 0., fill_factor = 1., permc_spec = "NATURAL", diag_pivot_thresh = 0.)
+		if not symmetric:
+			return spla.LinearOperator(A.shape, ilu.solve)
+
+		L = spla.splu(ilu.L.tocsc(), permc_spec = "NATURAL", diag_pivot_thresh = 0.); D = ilu.U.diagonal()
+		return spla.LinearOperator(A.shape, lambda r: L.solve(L.solve(r)/D, trans = "T"))
+	elif precond == "amg":
+		return pyamg.smoothed_aggregation_solver(A).aspreconditioner()
+	elif precond == "mg":
+		from piRichards.solver.multigrid import Multigrid
+		return spla.LinearOperator(A.shape, Multigrid(stencil).precondition)
+	else:
+		return None
+
+
+"""
+process : 連立一次方程式 A*x = bを解く
+input :
+	A -> <scipy csr_matrix>, b -> <np array>
+	x0 -> <np array> 初期値 (反復法のみ使用)
+	その他 -> solveと同じ
+output : x -> <np array>, itr -> <int> 反復回数 (LU分解では1)
+"""
+def solveLinear(A, b, x0, method, precond, tol, maxiter, stencil):
+	if method == "lu":
+		return spla.splu(A.tocsc()).solve(b), 1
+
+	itr = [0]
+	def count(xk):
+		itr[0] += 1
+
+	M = createPreconditioner(A, precond, method == "cg", stencil)
+	krylov = spla.cg if (method == "cg") else spla.bicgstab
+	x, info = krylov(A, b, x0 = x0, rtol = tol, maxiter = maxiter, M = M, callback = count)
+	if info != 0:
+		raise RuntimeError("sparse solver did not converge")
+
+	return x, itr[0]
+
+
+"""
+process : Stencilの連立一次方程式を疎行列ソルバで解く
+input :
+	stencil -> <Stencil class>
+	h -> <np array> 初期値 (反復法のみ使用)
+	method -> <str> "lu" : 疎LU分解, "cg" : 共役勾配法, "bicgstab" : BiCGSTAB法
+	precond -> <str> 反復法の前処理。None, "ilu", "amg" or "mg"
+	tol -> <float> 反復法の相対残差の許容値
+	maxiter -> <int> 反復法の最大反復回数
+	clip -> <bool> True -> h <= 0の制約付きで解く (ヤコビ法等のh > 0を0にする反復の収束先と同じ解)
+	max_active -> <int> clip == Trueのときの有効制約集合の更新回数の上限
+output :
+	h_new -> <np array> stencilと同じレイアウトの解。voidセルはnp.nan
+	itr -> <int> 反復回数の合計 (LU分解では解いた回数)
+Note :
+-- 反復法が収束しなかった場合、例外を送出する
+-- clip == Trueの場合、h = 0に固定するセル(有効制約)の集合を更新しながら解き直す (primal-dual active set法)
+	解がh > 0となったセルを固定し、固定したセルのうち残差b-A*hが負(hを減少させる向き)のセルは固定を解除する。集合が変化しなければ終了
+-- 固定したセルの行と列は単位行列に置き換える (対称性を保つため、共役勾配法でも使える)
+"""
+def solve(stencil, h = None, method = "lu", precond = "ilu", tol = 1e-8, maxiter = None, clip = False, max_active = 50):
+	A, b = assemble(stencil)
+	x = None if (h is None) else np.nan_to_num(stencil.compact(h))
+	fixed = np.zeros(len(b), dtype = bool) #<np array> h = 0に固定したセル
+
+	itr = 0
+	for active_itr in range(max_active if clip else 1):
+		if np.any(fixed):
+			free = sp.diags((~fixed).astype(float))
+			A_fixed = free@A@free+sp.diags(fixed.astype(float)); b_fixed = np.where(fixed, 0., b)
+		else:
+			A_fixed = A; b_fixed = b
+
+		x, n = solveLinear(A_fixed.tocsr(), b_fixed, x, method, precond, tol, maxiter, stencil)
+		itr += n
+		if not clip:
+			break
+
+		fixed_next = (x > 0.)+(fixed*(b-A@x >= 0.))
+		x = np.minimum(x, 0.)
+		if np.array_equal(fixed_next, fixed):
+			break
+		fixed = fixed_next
+
+	return stencil.expand(x), itr
@@ -0,0 +1,544 @@
+import numpy as np
+
+#####隣接セルの方向。 (right, left, front, back, up, down)の順
+DIRECTIONS = ("right", "left", "front", "back", "up", "down")
+
+#####拡張配列(ゴーストセル付き)から各方向の隣接セルを取り出すスライス
+SLICES = (
+	(Ellipsis, slice(2, None), slice(1, -1), slice(1, -1)),
+	(Ellipsis, slice(None, -2), slice(1, -1), slice(1, -1)),
+	(Ellipsis, slice(1, -1), slice(2, None), slice(1, -1)),
+	(Ellipsis, slice(1, -1), slice(None, -2), slice(1, -1)),
+	(Ellipsis, slice(1, -1), slice(1, -1), slice(2, None)),
+	(Ellipsis, slice(1, -1), slice(1, -1), slice(None, -2)))
+
+INNER = (Ellipsis, slice(1, -1), slice(1, -1), slice(1, -1))
+
+
+"""
+process : 配列の周囲にゴーストセルを1層追加
+input :
+	X -> <np array> (..., Nx, Ny, Nz)なshape
+	ghost -> <float> ゴーストセルの値
+output : <np array> (..., Nx+2, Ny+2, Nz+2)なshape
+"""
+def extend(X, ghost = np.nan):
+	X_extend = np.full(X.shape[:-3] + (X.shape[-3]+2, X.shape[-2]+2, X.shape[-1]+2), ghost)
+	X_extend[INNER] = X
+	return X_extend
+
+
+"""
+class : 7点ステンシルによる離散化Richards式の係数を格納したクラス
+	diag*h[i] = sum(a[d]*h[nb(i, d)]) + b
+att :
+	voxel -> <np array> (Nx, Ny, Nz)なshape
+	a -> <np array> (6, ..., Nx, Ny, Nz)なshape。各方向(DIRECTIONS)の係数。voidセル側は0
+	diag -> <np array> 対角項
+	b -> <np array> ソース項 (重力項、境界フラックス、蒸散、時間項を含む)
+Note :
+-- 係数はcreateStencilで一度だけ計算し、反復中は使い回す。
+-- voidセルではdiag, bがnp.nanとなるため、更新後のhもnp.nanとなる。
+"""
+class Stencil:
+	def __init__(self, voxel, a, diag, b):
+		self.voxel = voxel
+		self.a = a
+		self.diag = diag
+		self.b = b
+		self.shape = voxel.shape
+
+	"""
+	process : 隣接セルの寄与 sum(a[d]*h[nb(i, d)])を計算
+	input : h -> <np array> マトリックポテンシャル
+	output : <np array>
+	Note : ゴーストセル(h=0のDirichlet境界)及びvoidセルの値は0として扱う。
+	"""
+	def neighbor(self, h):
+		h_extend = extend(np.where(self.voxel, h, 0.), 0.)
+		s = np.zeros(h.shape)
+		for d in range(6):
+			s += self.a[d]*h_extend[SLICES[d]]
+
+		return s
+
+	"""
+	process : ヤコビ法による更新値を計算
+	input : h -> <np array> 現在のマトリックポテンシャル
+	output : <np array> 更新後のマトリックポテンシャル
+	"""
+	def jacobi(self, h):
+		return (self.neighbor(h)+self.b)/self.diag
+
+	"""
+	process : 緩和付きヤコビ法で1スイープ更新 (配列を新たに確保しない)
+		out = (1-lr)*h+lr*jacobi(h)
+	input :
+		h -> <np array> 現在のマトリックポテンシャル
+		out -> <np array> hと同じshapeの更新値の格納先。hとは別の配列
+		lr -> <float> 緩和係数
+		clip -> <bool> True -> 更新後にh > 0を0にする
+	output : <np array> out
+	Note :
+	-- 作業配列(self.buffers)は初回呼び出し時に作成し、以降のスイープで使い回す
+	-- 演算順序はjacobiと同じであり、結果は一致する
+	"""
+	def jacobiSweep(self, h, out, lr = 1., clip = True):
+		if not hasattr(self, "buffers"):
+			self.buffers = self.createBuffers()
+
+		h_pad, tmp = self.buffers
+		self.loadPad(h_pad, h)
+		for d in range(6):
+			self.neighborTerm(h_pad, d, tmp)
+			if d == 0:
+				np.copyto(out, tmp)
+			else:
+				np.add(out, tmp, out = out)
+
+		np.add(out, self.b, out = out)
+		np.divide(out, self.diag, out = out)
+		np.multiply(out, lr, out = out)
+		np.multiply(h, 1.-lr, out = tmp)
+		np.add(tmp, out, out = out)
+		if clip:
+			np.minimum(out, 0., out = out)
+
+		return out
+
+	"""
+	process : 作業配列を作成
+	output : (h_pad, tmp)
+		h_pad -> <np array> ゴーストセル付きのh。voidセル及びゴーストセルは常に0
+		tmp -> <np array> hと同じshapeの一時配列
+	Note : 係数が(6, M, Nx, Ny, Nz)なshape(アンサンブル)の場合は先頭の次元Mを含めて作成
+	"""
+	def createBuffers(self):
+		shape = self.a.shape[1:]
+		return np.zeros(shape[:-3]+tuple(n+2 for n in shape[-3:])), np.empty(shape)
+
+	"""
+	process : hの活性セルの値を作業配列h_padに書き込む
+	"""
+	def loadPad(self, h_pad, h):
+		np.copyto(h_pad[INNER], h, where = self.voxel)
+
+	"""
+	process : 作業配列h_padの活性セルの値をhに書き戻す
+	"""
+	def storePad(self, h_pad, h):
+		np.copyto(h, h_pad[INNER], where = self.voxel)
+
+	"""
+	process : 方向dの隣接セルの寄与a[d]*h[nb(i, d)]をoutに計算
+	"""
+	def neighborTerm(self, h_pad, d, out):
+		np.multiply(self.a[d], h_pad[SLICES[d]], out = out)
+
+	"""
+	process : red-black順序によるGauss-Seidel法(omega > 1 -> SOR法)で1スイープ更新
+	input :
+		h -> <np array> (Nx, Ny, Nz)なshapeの現在のマトリックポテンシャル。直接更新される
+		omega -> <float> 緩和係数。1 -> Gauss-Seidel法
+		clip -> <bool> True -> 各色の更新後にh > 0を0にする
+		reverse -> <bool> True -> black, redの順に更新 (対称なスムーザー用)
+	output : <np array> 更新後のh
+	Note :
+	-- (i+j+k)の偶奇で色分けし、同色セルは互いに隣接しないため色ごとにベクトル化して更新できる
+	-- 各色の活性セル番号とa, diagは初回呼び出し時に作成する。以降a, diagを変更しても反映されない (bは毎回参照する)
+	-- ゴーストセル付きのhはjacobiSweepと共通の作業配列(self.buffers)を使い回す
+	"""
+	def redblack(self, h, omega = 1., clip = True, reverse = False):
+		if not hasattr(self, "colors"):
+			self.colors = self.createColors()
+
+		if not hasattr(self, "buffers"):
+			self.buffers = self.createBuffers()
+
+		b_flat = np.broadcast_to(self.b, self.shape).reshape(-1)
+		self.loadPad(self.buffers[0], h)
+		h_pad = self.buffers[0].reshape(-1)
+		for index, index_pad, nb, a, diag in (reversed(self.colors) if reverse else self.colors):
+			s = b_flat[index].copy()
+			for d in range(6):
+				s += a[d]*h_pad[nb[d]]
+
+			h_color = (1.-omega)*h_pad[index_pad]+omega*s/diag
+			h_pad[index_pad] = np.minimum(h_color, 0.) if clip else h_color
+
+		self.storePad(self.buffers[0], h)
+
+		return h
+
+	"""
+	process : red-black順序の各色について、活性セル番号、作業配列上の番号及び係数を作成
+	output : <list of tuple> 各色の(セル番号, 作業配列(h_pad)上のセル番号, 各方向の隣接セルの作業配列上の番号, a, diag)
+	"""
+	def createColors(self):
+		shape_extend = tuple(n+2 for n in self.shape)
+		sx = shape_extend[1]*shape_extend[2]; sy = shape_extend[2]
+		offsets = (sx, -sx, sy, -sy, 1, -1) #DIRECTIONSの順
+
+		i, j, k = np.indices(self.shape)
+		parity = ((i+j+k)%2 == 0)
+		colors = []
+		for color in (parity*self.voxel, (~parity)*self.voxel):
+			index = np.flatnonzero(color)
+			ci, cj, ck = np.unravel_index(index, self.shape)
+			index_extend = np.ravel_multi_index((ci+1, cj+1, ck+1), shape_extend)
+			nb = [index_extend+offsets[d] for d in range(6)]
+			colors.append((index, index_extend, nb, self.a.reshape((6, -1))[:, index], self.diag.reshape(-1)[index]))
+
+		return colors
+
+	"""
+	process : SOR法の最適緩和係数を推定
+		omega = 2/(1+sqrt(1-rho^2))。rhoはヤコビ法の反復行列のスペクトル半径で、べき乗法により推定
+	input : iteration -> <int> べき乗法の反復回数
+	output : <float> omega (1 <= omega < 2)
+	"""
+	def estimateOmega(self, iteration = 50):
+		v = np.where(self.voxel, np.random.default_rng(0).random(self.shape), 0.) #大域の乱数列を消費しないよう固定した乱数で初期化
+		rho = 0.
+		for itr in range(iteration):
+			v_norm = np.linalg.norm(v)
+			if v_norm == 0.:
+				break
+			v = np.divide(self.neighbor(v/v_norm), self.diag, out = np.zeros(self.shape), where = self.voxel) #voidセル(diag = np.nan)では割り算しない
+			rho = np.linalg.norm(v)
+
+		rho = min(rho, 1.-1e-12)
+		return 2./(1.+np.sqrt(1.-rho**2))
+
+	"""
+	process : 残差 b+sum(a[d]*h[nb(i, d)])-diag*hを計算
+	input : h -> <np array> マトリックポテンシャル
+	output : <np array> voidセルは0
+	"""
+	def residual(self, h):
+		r = self.neighbor(h)+self.b-self.diag*h
+		return np.where(self.voxel, r, 0.)
+
+	"""
+	process : 相対残差ノルム ||r||/||b||を計算
+	input : h -> <np array> マトリックポテンシャル
+	output : <float>
+	Note :
+	-- h > 0のクリップが効いているセル(h >= 0かつhを増加させる向きの残差)は除外する
+	-- hが(M, ...)なshape(アンサンブル)の場合はメンバー毎のノルムを(M, )なshapeで返す
+	"""
+	def residualNorm(self, h):
+		r = self.residual(h)
+		r[(h >= 0.)*(r > 0.)] = 0.
+		b = np.where(self.voxel, self.b, 0.)
+		if r.ndim > len(self.shape):
+			axes = tuple(range(r.ndim-len(self.shape), r.ndim))
+			b_norm = np.sqrt(np.sum(np.broadcast_to(b, r.shape)**2, axis = axes))
+			return np.sqrt(np.sum(r**2, axis = axes))/np.maximum(b_norm, 1e-300)
+
+		return np.linalg.norm(r)/max(np.linalg.norm(b), 1e-300)
+
+	"""
+	process : Stencilと同じレイアウトの配列から活性セルの値を(N, )なshapeで取得
+	"""
+	def compact(self, X):
+		return X[self.voxel]
+
+	"""
+	process : 活性セルの値(N, )をStencilと同じレイアウトの配列に変換。voidセルはnp.nan
+	"""
+	def expand(self, x):
+		X = np.full(self.shape, np.nan)
+		X[self.voxel] = x
+		return X
+
+	"""
+	process : 活性セルの各方向の隣接セルの活性セル番号を作成
+	output : <np array> (6, N)なshape。隣接セルがvoidセルもしくはゴーストセルの場合は-1
+	Note : 活性セル番号はvoxel[voxel]の順番 (C order)
+	"""
+	def neighborIndex(self):
+		order = np.full(self.shape, -1); order[self.voxel] = np.arange(np.count_nonzero(self.voxel))
+		order_extend = extend(order, -1).astype(int)
+		return np.stack([order_extend[SLICES[d]][self.voxel] for d in range(6)])
+
+	"""
+	process : (Nx, Ny, Nz)なshapeのStencilを取得 (a, diag, bは共有する別オブジェクト)
+	output : <Stencil class>
+	"""
+	def toDense(self):
+		return Stencil(self.voxel, self.a, self.diag, self.b)
+
+
+"""
+class : 活性セルのみを1次元配列で保持するStencil (activeField用)
+att :
+	cells -> <Cells class> 活性セルの番号付け
+	voxel -> <np array> (N, )なshape。全てTrue
+	a -> <np array> (6, N)なshape
+	diag, b -> <np array> (N, )なshape
+Note :
+-- 隣接セルの値はcells.neighborによる番号表で取得する。voidセルの計算、np.nanの処理は行わない
+"""
+class ActiveStencil(Stencil):
+	def __init__(self, cells, a, diag, b):
+		Stencil.__init__(self, cells.mask, a, diag, b)
+		self.cells = cells
+
+	def neighbor(self, h):
+		h_nb = self.cells.neighbors(h, 0.)
+		s = np.zeros(h.shape)
+		for d in range(6):
+			s += self.a[d]*h_nb[d]
+
+		return s
+
+	def createBuffers(self):
+		return np.zeros(self.cells.size_pad), np.empty(self.cells.N)
+
+	def loadPad(self, h_pad, h):
+		np.copyto(h_pad[:self.cells.N], h)
+
+	def storePad(self, h_pad, h):
+		np.copyto(h, h_pad[:self.cells.N])
+
+	def neighborTerm(self, h_pad, d, out):
+		np.take(h_pad, self.cells.neighbor[d], out = out)
+		np.multiply(self.a[d], out, out = out)
+
+	def createColors(self):
+		i, j, k = self.cells.coords
+		parity = ((i+j+k)%2 == 0)
+		colors = []
+		for color in (parity, ~parity):
+			index = np.flatnonzero(color)
+			nb = [self.cells.neighbor[d][index] for d in range(6)]
+			colors.append((index, index, nb, self.a[:, index], self.diag[index]))
+
+		return colors
+
+	def compact(self, X):
+		return np.asarray(X)
+
+	def expand(self, x):
+		return x
+
+	def neighborIndex(self):
+		return np.where(self.cells.neighbor < self.cells.N, self.cells.neighbor, -1)
+
+	def toDense(self):
+		cells = self.cells
+		a = np.stack([cells.toDense(self.a[d], 0.) for d in range(6)])
+		b = cells.toDense(np.broadcast_to(self.b, (cells.N,)))
+		return Stencil(cells.voxel, a, cells.toDense(self.diag), b)
+
+
+"""
+process : fieldのレイアウトに応じて配列にゴーストセルを追加
+	field -> (Nx+2, Ny+2, Nz+2)なshape, activeField -> (N+1+T+B, )なshape
+input :
+	field -> <field class> or <activeField class>
+	X -> <np array> fieldと同じレイアウトの配列
+	ghost -> <float> ゴーストセルの値
+"""
+def pad(field, X, ghost = np.nan):
+	return field.cells.pad(X, ghost) if hasattr(field, "cells") else extend(X, ghost)
+
+
+"""
+process : padした配列から方向dの隣接セルの値を取得
+"""
+def shift(field, X_pad, d):
+	return X_pad[field.cells.neighbor[d]] if hasattr(field, "cells") else X_pad[SLICES[d]]
+
+
+"""
+process : 上面セル、底面セルの番号を取得
+input : where -> "top" or "bottom"
+output :
+	node -> fieldと同じレイアウトの配列における番号
+	ghost -> padした配列におけるゴーストセル(上面セルの上、底面セルの下)の番号
+"""
+def boundaryIndex(field, where):
+	if hasattr(field, "cells"):
+		return (field.cells.top, field.cells.topGhost) if (where == "top") else (field.cells.bottom, field.cells.bottomGhost)
+
+	node = field.topNode if (where == "top") else field.bottomNode
+	return (Ellipsis,)+tuple(node), (Ellipsis, np.array(node[0])+1, np.array(node[1])+1, np.array(node[2])) #先頭の次元(アンサンブル)はそのまま
+
+
+"""
+process : fieldのレイアウトに応じたStencilを作成
+"""
+def layoutStencil(field, a, diag, b):
+	return ActiveStencil(field.cells, a, diag, b) if hasattr(field, "cells") else Stencil(field.voxel, a, diag, b)
+
+
+"""
+process : 透過率分布にゴーストセルを追加。Dirichlet境界(h=0)のゴーストセルには飽和透過率を与える
+input :
+	field -> <field class> or <activeField class>
+	top -> "zero" or "flux"
+	bottom -> "free" or "zero"
+output :
+	K -> <np array> fieldと同じレイアウト
+	K_pad -> <np array> ゴーストセル付きの透過率 (pad)。voidセルはnp.nan
+"""
+def padK(field, top = "flux", bottom = "free"):
+	K = field.getK()
+	K_pad = pad(field, K)
+	if top == "zero":
+		node, ghost = boundaryIndex(field, "top")
+		K_pad[ghost] = field.k[node]
+
+	if bottom == "zero":
+		node, ghost = boundaryIndex(field, "bottom")
+		K_pad[ghost] = field.k[node]
+
+	return K, K_pad
+
+
+"""
+process : 透過率と隣接セルの透過率を計算
+input : padKと同じ
+output :
+	K -> <np array> fieldと同じレイアウト
+	K_nb -> <list of np array> 各方向(DIRECTIONS)の隣接セルの透過率。voidセルはnp.nan
+"""
+def neighborK(field, top = "flux", bottom = "free"):
+	K, K_pad = padK(field, top, bottom)
+	return K, [shift(field, K_pad, d) for d in range(6)]
+
+
+"""
+process : fused kernel (piRichards.solver.kernels)用の番号表を作成
+input : layout -> <np array> voxel (密な配列) or <Cells class>
+output :
+	index -> <np array> (N, )なshape。活性セルのレイアウト上のflat index
+	index_pad -> <np array> (N, )なshape。活性セルのゴーストセル付き配列(pad)上のflat index
+	nb -> <np array> (6, N)なshape。各方向の隣接セルのpad上のflat index
+	size_pad -> <int> padの要素数
+"""
+def kernelIndex(layout):
+	if hasattr(layout, "neighbor"):
+		index = np.arange(layout.N)
+		return index, index, layout.neighbor, layout.size_pad
+
+	shape_extend = tuple(n+2 for n in layout.shape)
+	sx = shape_extend[1]*shape_extend[2]; sy = shape_extend[2]
+	index = np.flatnonzero(layout)
+	ci, cj, ck = np.unravel_index(index, layout.shape)
+	index_pad = np.ravel_multi_index((ci+1, cj+1, ck+1), shape_extend)
+	nb = index_pad[np.newaxis]+np.array([sx, -sx, sy, -sy, 1, -1])[:, np.newaxis] #DIRECTIONSの順
+
+	return index, index_pad, nb, int(np.prod(shape_extend))
+
+
+"""
+process : fieldからStencilを作成
+input :
+	field -> <field class> or <activeField class>
+	q -> <ndarray> 地表面フラックス。(Nx, Ny)なshape
+	top -> "zero" or "flux"
+	bottom -> "free" or "zero"
+	Tp -> <float> 蒸散量
+	dt -> <float> 時間刻み。if None -> 定常解析
+	h_before -> <np array> 前時刻のマトリックポテンシャル。if None -> field.h
+	backend -> <str> "numpy" or "numba" (piRichards.solver.kernels.createStencil)
+output : <Stencil class> activeFieldの場合は<ActiveStencil class>
+"""
+def createStencil(field, q = None, top = "flux", bottom = "free", Tp = None, dt = None, h_before = None, backend = "numpy"):
+	if backend == "numba":
+		from piRichards.solver import kernels
+		return kernels.createStencil(field, q, top, bottom, Tp, dt, h_before)
+
+	dx, dy, dz = field.size #計算格子サイズ
+	spacing = (dx, dx, dy, dy, dz, dz)
+
+	S = field.getS(Tp); K, K_nb = neighborK(field, top, bottom)
+	top_node = boundaryIndex(field, "top")[0]; bottom_node = boundaryIndex(field, "bottom")[0]
+
+	#####各面の係数
+	a = np.zeros((6,)+K.shape)
+	for d in range(6):
+		K_face = (K_nb[d]+K)/2.
+		a[d] = K_face/(spacing[d]**2)
+	a[np.isnan(a)] = 0.
+
+	#####重力項及び境界フラックス
+	b_up = (K_nb[4]+K)/2./dz; b_up[np.isnan(b_up)] = 0.
+	if top == "flux":
+		b_up[top_node] = q[..., field.topNode[0], field.topNode[1]]/dz
+
+	b_down = -(K_nb[5]+K)/2./dz; b_down[np.isnan(b_down)] = 0.
+	b_down[bottom_node] = -K[bottom_node]/dz
+
+	diag = np.sum(a, axis = 0)
+	b = S+b_up+b_down
+
+	#####時間項
+	if dt is not None:
+		Cw = field.getCw()
+		h_before = field.h if (h_before is None) else h_before
+		diag = Cw/dt+diag
+		b = Cw/dt*h_before+b
+
+	return layoutStencil(field, a, diag, b)
+
+
+"""
+process : Newton法の線形化方程式をStencilとして作成
+	F(h) = (theta(h)-theta_before)/dt-R(h)。R(h)は定常の残差
+	J*h_next = J*h-F(h)をdiag*h_next = sum(a[d]*h_next[nb(i, d)])+bの形で表す
+input :
+	field -> <field class> or <activeField class>。field.hは現在の反復値
+	dt -> <float> 時間刻み
+	theta_before -> <np array> 前時刻の体積含水率
+	q, top, bottom, Tp, backend -> createStencilと同じ
+output : <Stencil class> activeFieldの場合は<ActiveStencil class>
+Note :
+-- 透過率の微分dK/dhはvan Genuchtenモデルの解析解(field.getdK)を用いる
+-- ソース項(蒸散)のhに対する微分は考慮しない
+-- Jacobianは非対称であり、係数aは負になり得る
+"""
+def createJacobian(field, dt, theta_before, q = None, top = "flux", bottom = "free", Tp = None, backend = "numpy"):
+	dx, dy, dz = field.size #計算格子サイズ
+	spacing = (dx, dx, dy, dy, dz, dz)
+	stencil = createStencil(field, q, top, bottom, Tp, backend = backend) #<Stencil> Kを固定した定常の係数
+	h = field.h
+	active = stencil.voxel #<np array> fieldと同じレイアウトの活性セル
+
+	K, K_nb = neighborK(field, top, bottom)
+	dK = field.getdK(0.); dK_pad = pad(field, dK, 0.)
+	h_pad = pad(field, np.where(active, h, 0.), 0.)
+	active_pad = pad(field, active, False)
+
+	#####dR_i/dK_i及びdR_i/dK_j (jは隣接セル)
+	dR_self = np.zeros(h.shape)
+	a = stencil.a.copy()
+	for d in range(6):
+		face = ~np.isnan(K_nb[d]) #<np array> 面が存在する(隣接セルがactive or Dirichlet境界)
+		dh = (shift(field, h_pad, d)-h)/(2.*spacing[d]**2)
+		dR_self += np.where(face, dh, 0.)
+
+		dR_nb = dh + (1./(2.*dz) if (d == 4) else (-1./(2.*dz) if (d == 5) else 0.))
+		a[d] += np.where(shift(field, active_pad, d), shift(field, dK_pad, d)*dR_nb, 0.)
+
+	#####重力項のdb_i/dK_i
+	face_up = ~np.isnan(K_nb[4]); face_down = ~np.isnan(K_nb[5])
+	if top == "flux":
+		face_up[boundaryIndex(field, "top")[0]] = False
+
+	db_down = -1.*face_down/(2.*dz)
+	db_down[boundaryIndex(field, "bottom")[0]] = -1./dz
+	dR_self += face_up/(2.*dz)+db_down
+
+	a[:, ~active] = 0.
+	diag = field.getCw()/dt+stencil.diag-dK*dR_self
+
+	#####右辺 : J*h-F(h)
+	F = (field.getTheta()-theta_before)/dt-stencil.residual(h)
+	stencil_J = layoutStencil(field, a, diag, 0.)
+	stencil_J.b = diag*h-stencil_J.neighbor(h)-F
+
+	return stencil_J
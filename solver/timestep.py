@@ -0,0 +1,108 @@
+import numpy as np
+import sys
+from piRichards.solver.linalg import run_Unsteady
+
+#####終了時刻もしくはチェックポイントの直前に残る時間がmax(dt_min, SLIVER*dt)未満となる場合は、残りの時間をステップに含める
+SLIVER = 0.1
+
+"""
+class : simulateで採択された時間ステップの履歴
+att :
+	t -> <list of float> 各ステップ終了時刻 [s]
+	dt -> <list of float> 時間刻み [s]
+	nl_iterations -> <list of int> 非線形反復回数
+	iterations -> <list of int> 線形ソルバの反復回数
+	rejected -> <list of tuple> 棄却されたステップの(開始時刻, 時間刻み)
+"""
+class History:
+	def __init__(self):
+		self.t = []
+		self.dt = []
+		self.nl_iterations = []
+		self.iterations = []
+		self.rejected = []
+
+	def __len__(self):
+		return len(self.t)
+
+	"""
+	process : 採択されたステップを記録
+	input :
+		t -> <float> ステップ終了時刻
+		dt -> <float> 時間刻み
+		stats -> <Stats class> run_Unsteadyの出力
+	"""
+	def append(self, t, dt, stats):
+		self.t.append(t); self.dt.append(dt)
+		self.nl_iterations.append(stats.nl_iterations); self.iterations.append(stats.iterations)
+
+
+"""
+process : 適応時間刻みによる非定常解析
+input :
+	field -> <field class>
+	t_end -> <float> 終了時刻 [s]
+	forcing -> <function> 時刻t [s]を受け取り、(q, Tp)を返す関数。if None -> q, Tp = None (top == "flux"の場合は必須)
+	t -> <float> 開始時刻 [s]
+	dt -> <float> 初期時間刻み [s]
+	dt_min, dt_max -> <float> 時間刻みの下限と上限 [s]
+	grow -> <float> 非線形反復がfast回以下で収束したときの時間刻みの拡大率
+	shrink -> <float> 非線形反復がslow回以上、もしくは発散したときの時間刻みの縮小率
+	fast, slow -> <int> 時間刻みを拡大、縮小する非線形反復回数の閾値
+	checkpoints -> <list of float> 必ずステップの終了時刻とする時刻 (降雨の開始時刻、観測時刻等)
+	callback -> <function> 採択された各ステップ後にcallback(field, t)を呼ぶ
+	top, bottom, method, precond, iteration, lr, tol, nonlinear, nl_iteration, nl_tol, backend, workers, decomposition -> run_Unsteadyの引数
+output : <History class> fieldのattが更新
+Note :
+-- 非線形反復が収束しない、もしくはfield.dead_flagがTrueとなった場合、hをステップ開始時の値に戻し、時間刻みを縮小して再計算する
+-- dt_minでも収束しない場合は計算を打ち切り、field.dead_flagをTrueとする
+-- forcingはステップ終了時刻で評価する (陰解法)
+-- 終了時刻、チェックポイントの直前にmax(dt_min, SLIVER*dt)未満のステップが残らないよう、手前のステップを伸ばす (dt_maxを超える場合は残りを2等分)
+-- workers > 1の場合、全ステップで同じ領域分割のプロセスを使い回す (piRichards.solver.linalg.getDecomposition)
+"""
+def simulate(field, t_end, forcing = None, t = 0., dt = 60., dt_min = 1., dt_max = 86400., grow = 1.5, shrink = 0.5, fast = 3, slow = 8, checkpoints = None,
+		callback = None, top = "flux", bottom = "free", method = "jacobi", precond = "ilu", iteration = 20, lr = 0.9, tol = None, nonlinear = "picard", nl_iteration = 20, nl_tol = 1e-5, backend = "numpy", workers = 1, decomposition = None):
+	history = History()
+	checkpoints = [] if (checkpoints is None) else sorted(checkpoints)
+	dt = min(max(dt, dt_min), dt_max)
+
+	while (t_end-t) > 1e-9*max(abs(t_end), 1.) and (not field.dead_flag):
+		#####次の終了時刻もしくはチェックポイントを越えない時間刻み。直前に微小なステップが残る場合は伸ばす(dt_maxを超える場合は2等分)
+		t_next = min([tc for tc in checkpoints if tc > t] + [t_end])
+		remain = t_next-t
+		if remain-dt >= max(dt_min, SLIVER*dt):
+			dt_step = dt
+		else:
+			dt_step = remain if (remain <= dt_max) else remain/2.
+
+		q, Tp = (None, None) if (forcing is None) else forcing(t+dt_step)
+		if (top == "flux") and (q is None):
+			print("Error@piRichards.solver.timestep.simulate")
+			print("top <flux> requires forcing that returns q at t = " + str(t+dt_step) + ".")
+			sys.exit()
+		h_saved = field.h.copy() #<np array> 再計算用のステップ開始時のh
+		stats = run_Unsteady(field, dt_step, q, top, bottom, Tp, iteration, lr, method, precond, tol, nonlinear = nonlinear, nl_iteration = nl_iteration, nl_tol = nl_tol, backend = backend, workers = workers, decomposition = decomposition)
+
+		if field.dead_flag or (not stats.nl_converged) or np.any(np.isnan(field.toActive(field.h))):
+			#####ステップを棄却し、時間刻みを縮小
+			history.rejected.append((t, dt_step))
+			field.h = h_saved
+			if dt_step <= dt_min:
+				field.dead_flag = True
+			else:
+				field.dead_flag = False
+				dt = max(dt_step*shrink, dt_min)
+			continue
+
+		t += dt_step
+		history.append(t, dt_step, stats)
+		if callback is not None:
+			callback(field, t)
+
+		#####非線形反復回数に応じて時間刻みを調整
+		if stats.nl_iterations <= fast:
+			dt = min(max(dt, dt_step)*grow, dt_max)
+		elif stats.nl_iterations >= slow:
+			dt = max(dt_step*shrink, dt_min)
+
+	return history